@@ -40,7 +40,7 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
@@ -73,7 +73,7 @@ class AdminHandlers:
             await query.edit_message_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await query.edit_message_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
@@ -147,9 +147,10 @@ class AdminHandlers:
             remaining_days = subscription_info.get("remaining_days", "غير محدد")
 
             # Get user statistics
-            total_users = self.subscription_service.get_total_users_count()
-            active_users = self.subscription_service.get_active_users_count()
-            admin_users = self.subscription_service.get_admin_users_count()
+            counts = await self.subscription_service.get_users_counts_async()
+            total_users = counts['total']
+            active_users = counts['active']
+            admin_users = counts['admins']
 
             keyboard = [
                 [InlineKeyboardButton("🔙 رجوع", callback_data="admin_back")]
@@ -269,7 +270,7 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
@@ -288,7 +289,7 @@ class AdminHandlers:
             days = int(context.args[1])
 
             # Add subscription to user
-            success = self.subscription_service.add_subscription(target_user_id, days)
+            success = await self.subscription_service.add_subscription_async(target_user_id, days)
 
             if success:
                 await update.message.reply_text(
@@ -319,7 +320,7 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
@@ -337,7 +338,7 @@ class AdminHandlers:
             target_user_id = int(context.args[0])
 
             # Remove subscription from user
-            success = self.subscription_service.remove_subscription(target_user_id)
+            success = await self.subscription_service.remove_subscription_async(target_user_id)
 
             if success:
                 await update.message.reply_text(
@@ -368,7 +369,7 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
@@ -386,7 +387,7 @@ class AdminHandlers:
             target_user_id = int(context.args[0])
 
             # Get user information
-            target_user = self.subscription_service.get_user(target_user_id)
+            target_user = await self.subscription_service.get_user_async(target_user_id)
 
             if target_user:
                 has_subscription = target_user.has_active_subscription()
@@ -439,14 +440,14 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
 
         try:
             # Get active users
-            active_users = self.subscription_service.get_active_users()
+            active_users = await self.subscription_service.get_active_users_async()
 
             if active_users:
                 message = "👥 *قائمة المستخدمين النشطين:*\n\n"
@@ -490,7 +491,7 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
@@ -507,28 +508,28 @@ class AdminHandlers:
         message_text = " ".join(context.args)
 
         try:
-            # Get all users
-            all_users = self.subscription_service.get_all_users()
+            # Count users, the recipients are streamed from the database below
+            total_users = await self.subscription_service.get_total_users_count_async()
 
-            if all_users:
+            if total_users:
                 # Send status message
                 status_message = await update.message.reply_text(
-                    f"⏳ جاري إرسال الرسالة الجماعية إلى {len(all_users)} مستخدم..."
+                    f"⏳ جاري إرسال الرسالة الجماعية إلى {total_users} مستخدم..."
                 )
 
                 # Send broadcast message
                 success_count = 0
                 fail_count = 0
 
-                for user in all_users:
+                async for recipient_id in self.subscription_service.iter_user_ids_async():
                     try:
                         await context.bot.send_message(
-                            chat_id=user.user_id,
+                            chat_id=recipient_id,
                             text=message_text
                         )
                         success_count += 1
                     except Exception as e:
-                        logger.error(f"Error sending broadcast to user {user.user_id}: {str(e)}")
+                        logger.error(f"Error sending broadcast to user {recipient_id}: {str(e)}")
                         fail_count += 1
 
                 # Update status message
@@ -556,7 +557,7 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
@@ -681,16 +682,17 @@ class AdminHandlers:
             await update.message.reply_text("خطأ: خدمة الاشتراك غير متاحة.")
             return
 
-        user = self.subscription_service.get_user(user_id)
+        user = await self.subscription_service.get_user_async(user_id)
         if not user or not user.is_admin:
             await update.message.reply_text("⛔ عذراً، هذا الأمر متاح للمشرفين فقط.")
             return
 
         try:
             # Get user statistics
-            total_users = self.subscription_service.get_total_users_count()
-            active_users = self.subscription_service.get_active_users_count()
-            admin_users = self.subscription_service.get_admin_users_count()
+            counts = await self.subscription_service.get_users_counts_async()
+            total_users = counts['total']
+            active_users = counts['active']
+            admin_users = counts['admins']
 
             # Get subscription statistics
             subscription_info = subscription_manager.get_subscription_info()
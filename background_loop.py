@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class BackgroundLoop:
+    """
+    حلقة أحداث واحدة طويلة العمر تعمل في خيط خلفي مشترك
+
+    تُشغَّل جميع مهام النشر كـ coroutines على هذه الحلقة بدلاً من إنشاء
+    خيط وحلقة جديدة لكل مهمة، ويمكن استدعاؤها بأمان من أي خيط آخر.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                instance = super(BackgroundLoop, cls).__new__(cls)
+                instance.loop = asyncio.new_event_loop()
+                instance.thread = threading.Thread(
+                    target=instance._run_forever,
+                    name='posting-loop',
+                    daemon=True
+                )
+                instance.thread.start()
+                cls._instance = instance
+        return cls._instance
+
+    def _run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        logger.info("Shared posting event loop started")
+        self.loop.run_forever()
+
+    def in_loop_thread(self):
+        """Check if the caller is running on the shared loop thread"""
+        return threading.current_thread() is self.thread
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the shared loop from any thread
+
+        Returns:
+            concurrent.futures.Future for the coroutine result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_async(self, coro):
+        """Await a coroutine on the shared loop from another event loop"""
+        if self.in_loop_thread():
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def call_soon(self, callback, *args):
+        """Run a plain callback on the shared loop thread"""
+        self.loop.call_soon_threadsafe(callback, *args)
@@ -2,6 +2,7 @@ import os
 import sys
 import logging
 from config import BOT_TOKEN as TELEGRAM_BOT_TOKEN
+from telegram import Update
 from telegram.ext import ApplicationBuilder, MessageHandler, filters
 from start_help_handlers import StartHelpHandlers
 from auth_handlers import AuthHandlers
@@ -111,13 +112,18 @@ class Bot:
         try:
             logger.info("Starting bot polling...")
             self.is_running = True
-            self.application.run_polling(drop_pending_updates=True)
+            # chat_member updates are only delivered when requested explicitly
+            self.application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
         except Exception as e:
             logger.error(f"Error in bot polling: {str(e)}", exc_info=True)
             self.is_running = False
         finally:
             # Ensure flag is reset if polling stops for any reason
             self.is_running = False
+
+            # Don't lose buffered posting writes when polling stops
+            self.posting_service.flush_writes()
+            self.posting_service.save_active_tasks()
             logger.info("Bot polling has stopped")
 
 def main():
@@ -1,23 +1,33 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.ext import ContextTypes, MessageHandler, filters
+from telegram.ext import ContextTypes, MessageHandler, ChatMemberHandler, filters
 import asyncio
 import logging
 import json
 import os
 import datetime
-import threading
-
-# إنشاء متغير عام للتحكم في الوصول إلى قاعدة البيانات
-channel_lock = threading.Lock()
+import time
+from config import (
+    CHANNEL_MEMBER_CACHE_SECONDS, CHANNEL_NON_MEMBER_CACHE_SECONDS, CHANNEL_MEMBERSHIP_CACHE_MAX_ENTRIES,
+    CHANNEL_CHECK_MAX_CONCURRENT
+)
 
 logger = logging.getLogger(__name__)
 
 class EnhancedChannelSubscription:
+    # حالات العضوية التي تعني أن المستخدم مشترك في القناة
+    MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
     def __init__(self):
         self.required_channel = None
         self.middleware_handler = None
         self.is_mandatory = False
         self.expiry_date = None
+        # نتائج التحقق من العضوية: user_id -> (مشترك؟, وقت انتهاء الصلاحية)
+        self.membership_cache = {}
+        # عمليات التحقق الجارية، الطلبات المتزامنة لنفس المستخدم تنتظر نفس العملية
+        self.pending_checks = {}
+        # يحد من طلبات get_chat_member المتزامنة، يُنشأ عند أول استخدام على حلقة الأحداث
+        self.check_slots = None
         self.settings_file = os.path.join(os.path.dirname(__file__), 'channel_settings.json')
         self.load_settings()
 
@@ -27,6 +37,8 @@ class EnhancedChannelSubscription:
             channel = f'@{channel}'
         self.required_channel = channel
         self.is_mandatory = bool(channel)
+        # نتائج العضوية السابقة تخص القناة القديمة
+        self.membership_cache.clear()
 
         # تعيين تاريخ انتهاء الاشتراك الإجباري إذا تم تحديد المدة
         if duration_days is not None and duration_days > 0:
@@ -144,13 +156,69 @@ class EnhancedChannelSubscription:
         except Exception as e:
             logger.error(f"خطأ أثناء تحميل إعدادات الاشتراك الإجباري: {str(e)}")
 
-    async def check_user_subscription(self, user_id, bot):
-        """التحقق من اشتراك المستخدم في القناة المطلوبة"""
+    def get_cached_membership(self, user_id):
+        """نتيجة العضوية المحفوظة للمستخدم، أو None إذا لم تكن محفوظة أو انتهت صلاحيتها"""
+        entry = self.membership_cache.get(user_id)
+        if entry is None:
+            return None
+
+        is_subscribed, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self.membership_cache[user_id]
+            return None
+        return is_subscribed
+
+    def cache_membership(self, user_id, is_subscribed):
+        """حفظ نتيجة العضوية، صلاحية غير المشترك أقصر حتى يُقبل فور اشتراكه"""
+        ttl = CHANNEL_MEMBER_CACHE_SECONDS if is_subscribed else CHANNEL_NON_MEMBER_CACHE_SECONDS
+        self.membership_cache.pop(user_id, None)
+        if len(self.membership_cache) >= CHANNEL_MEMBERSHIP_CACHE_MAX_ENTRIES:
+            # حذف أقدم نتيجة، القاموس يحافظ على ترتيب الإضافة
+            del self.membership_cache[next(iter(self.membership_cache))]
+        self.membership_cache[user_id] = (is_subscribed, time.monotonic() + ttl)
+
+    def is_required_chat(self, chat):
+        """التحقق مما إذا كانت المحادثة هي القناة المطلوبة (باسم المستخدم أو المعرف)"""
+        channel = (self.required_channel or '').lower()
+        if chat.username and channel == f"@{chat.username.lower()}":
+            return True
+        return channel == str(chat.id)
+
+    async def check_user_subscription(self, user_id, bot, force=False):
+        """
+        التحقق من اشتراك المستخدم في القناة المطلوبة
+
+        تُستخدم النتيجة المحفوظة إن وجدت، وforce=True يتجاهلها ويسأل Telegram مباشرة
+        """
         if not self.is_mandatory_subscription():
             return True
 
+        if not force:
+            is_subscribed = self.get_cached_membership(user_id)
+            if is_subscribed is not None:
+                return is_subscribed
+
+        # التحقق المتزامن لنفس المستخدم ينتظر الطلب الجاري بدلاً من إرسال طلب جديد
+        pending = self.pending_checks.get(user_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self.fetch_membership(user_id, bot))
+            self.pending_checks[user_id] = pending
+            pending.add_done_callback(lambda task: self.finish_check(user_id, task))
+
+        # shield: إلغاء أحد المنتظرين لا يلغي الطلب على الآخرين
+        return await asyncio.shield(pending)
+
+    def finish_check(self, user_id, task):
+        if self.pending_checks.get(user_id) is task:
+            del self.pending_checks[user_id]
+
+    async def fetch_membership(self, user_id, bot):
+        """سؤال Telegram عن عضوية المستخدم وحفظ النتيجة"""
+        if self.check_slots is None:
+            self.check_slots = asyncio.Semaphore(CHANNEL_CHECK_MAX_CONCURRENT)
+
         try:
-            with channel_lock:
+            async with self.check_slots:
                 # التحقق من نوع bot وإنشاء كائن Bot إذا كان رقمًا أو نصًا
                 if isinstance(bot, (int, str)):
                     # إذا كان bot عبارة عن رقم أو نص، قم بإنشاء كائن bot جديد
@@ -159,12 +227,13 @@ class EnhancedChannelSubscription:
                     chat_member = await temp_bot.get_chat_member(chat_id=self.required_channel, user_id=user_id)
                 else:
                     chat_member = await bot.get_chat_member(chat_id=self.required_channel, user_id=user_id)
-                    
-                # التحقق من حالة العضوية
-                status = chat_member.status
-                # المستخدم مشترك إذا كان عضواً أو مشرفاً أو مالكاً
-                is_subscribed = status in ['member', 'administrator', 'creator']
-                return is_subscribed
+
+            # التحقق من حالة العضوية
+            status = chat_member.status
+            # المستخدم مشترك إذا كان عضواً أو مشرفاً أو مالكاً
+            is_subscribed = status in self.MEMBER_STATUSES
+            self.cache_membership(user_id, is_subscribed)
+            return is_subscribed
         except Exception as e:
             logger.error(f"خطأ أثناء التحقق من اشتراك المستخدم {user_id}: {str(e)}")
             # في حالة حدوث خطأ، نفترض أن المستخدم غير مشترك
@@ -204,6 +273,17 @@ class EnhancedChannelSubscription:
             logger.error(f"خطأ أثناء التحقق من صلاحيات البوت: {str(e)}")
             return False, f"حدث خطأ أثناء التحقق من صلاحيات البوت: {str(e)}"
 
+    async def chat_member_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """تحديث نتيجة العضوية المحفوظة عند اشتراك مستخدم في القناة المطلوبة أو مغادرته لها"""
+        member_update = update.chat_member
+        if not member_update or not self.is_mandatory_subscription():
+            return
+        if not self.is_required_chat(member_update.chat):
+            return
+
+        new_member = member_update.new_chat_member
+        self.cache_membership(new_member.user.id, new_member.status in self.MEMBER_STATUSES)
+
     async def subscription_middleware(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """وسيط للتحقق من اشتراك المستخدم قبل معالجة الرسائل"""
         # تجاهل التحديثات التي ليست رسائل أو أوامر
@@ -226,10 +306,7 @@ class EnhancedChannelSubscription:
         # التحقق من المشرف (المشرفون معفون من التحقق)
         try:
             from subscription_service import SubscriptionService
-            subscription_service = SubscriptionService()
-            db_user = subscription_service.get_user(user_id)
-            is_admin = db_user and db_user.is_admin
-            if is_admin:
+            if SubscriptionService().is_admin(user_id):
                 return
         except Exception as e:
             logger.error(f"خطأ أثناء التحقق من حالة المشرف: {str(e)}")
@@ -285,11 +362,7 @@ def auto_channel_subscription_required(func):
         # التحقق من المشرف (المشرفون معفون من التحقق)
         try:
             from subscription_service import SubscriptionService
-            subscription_service = SubscriptionService()
-            db_user = subscription_service.get_user(user_id)
-            is_admin = db_user and db_user.is_admin
-
-            if is_admin:
+            if SubscriptionService().is_admin(user_id):
                 return await func(self, update, context, *args, **kwargs)
         except Exception as e:
             logger.error(f"خطأ أثناء التحقق من حالة المشرف: {str(e)}")
@@ -333,4 +406,10 @@ def setup_enhanced_subscription(application):
         group=-1  # أولوية عالية لضمان تنفيذ الوسيط قبل معالجة الرسائل
     )
 
+    # تحديثات العضوية في القناة (تصل فقط إذا كان البوت مشرفاً فيها)
+    application.add_handler(
+        ChatMemberHandler(subscription_manager.chat_member_update, ChatMemberHandler.CHAT_MEMBER),
+        group=-1
+    )
+
     return subscription_manager
@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from telethon import TelegramClient, events
+from telethon.sessions import StringSession
+from telethon.tl.types import UpdateUser, UpdateUserName
+from background_loop import BackgroundLoop
+from config import (
+    CLIENT_POOL_MAX_CONNECTIONS, CLIENT_POOL_IDLE_SECONDS,
+    CLIENT_POOL_HEALTH_CHECK_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+class ClientUnavailable(Exception):
+    """The pool is full or the connection failed, the session itself may still be valid"""
+
+class PooledClient:
+    """عميل Telethon متصل ومصرح له لحساب مستخدم واحد"""
+    def __init__(self, user_id, session_string, client):
+        self.user_id = user_id
+        self.session_string = session_string
+        self.client = client
+        self.borrowers = 0
+        self.pinned = 0
+        # Handlers registered through the pool, moved to the replacement client with the pins
+        self.handlers = []
+        self.last_used = time.monotonic()
+        self.last_checked = time.monotonic()
+        # هوية الحساب من get_me: id و username و first_name بأحرف صغيرة
+        self.identity = None
+
+    def is_idle(self):
+        return self.borrowers == 0 and self.pinned == 0
+
+class ClientPool:
+    """
+    مجمع عملاء Telethon مشترك، عميل واحد متصل لكل مستخدم
+
+    يعيش المجمع على حلقة الأحداث المشتركة (BackgroundLoop)، لذلك يجب استدعاء
+    جميع الدوال غير المتزامنة من تلك الحلقة، مثلاً عبر BackgroundLoop().run_async().
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                instance = super(ClientPool, cls).__new__(cls)
+                instance.loop_runner = BackgroundLoop()
+                instance.entries = {}
+                # عملاء تم استبدالهم وما زالوا مستخدمين، يُغلقون عند آخر إرجاع: client -> entry
+                instance.retired = {}
+                # تثبيتات ومعالجات عميل تم استبداله، ينقلها العميل الجديد للمستخدم: user_id -> (pinned, handlers)
+                instance.carried = {}
+                instance.max_connections = CLIENT_POOL_MAX_CONNECTIONS
+                instance.idle_seconds = CLIENT_POOL_IDLE_SECONDS
+                instance.health_check_seconds = CLIENT_POOL_HEALTH_CHECK_SECONDS
+                instance._user_locks = {}
+                instance._available = None
+                instance._evictor = None
+                cls._instance = instance
+        return cls._instance
+
+    def _get_user_lock(self, user_id):
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._user_locks[user_id] = lock
+        return lock
+
+    def _get_available_condition(self):
+        if self._available is None:
+            self._available = asyncio.Condition()
+        return self._available
+
+    def _start_evictor(self):
+        if self._evictor is None or self._evictor.done():
+            self._evictor = asyncio.get_running_loop().create_task(self._evict_idle_clients())
+
+    async def _notify_available(self):
+        condition = self._get_available_condition()
+        async with condition:
+            condition.notify_all()
+
+    async def acquire(self, user_id, session_string, api_id, api_hash, timeout=60):
+        """
+        Borrow the connected client of a user, creating it if needed
+
+        Returns:
+            Authorized TelegramClient, or None if the session is not authorized
+        Raises:
+            ClientUnavailable if the pool is full or the client couldn't connect
+        """
+        self._start_evictor()
+
+        async with self._get_user_lock(user_id):
+            entry = self.entries.get(user_id)
+
+            # A new login replaces the old session
+            if entry is not None and entry.session_string != session_string:
+                await self._retire_entry(entry)
+                entry = None
+
+            if entry is not None:
+                if not await self._check_health(entry):
+                    await self._retire_entry(entry)
+                    return None
+            else:
+                if not await self._wait_for_slot(timeout):
+                    logger.warning(f"Client pool is full, no connection available for user {user_id}")
+                    raise ClientUnavailable("client pool is full")
+
+                client = TelegramClient(StringSession(session_string), api_id, api_hash)
+                logger.info(f"Opening pooled client for user {user_id}")
+                try:
+                    await client.connect()
+                except Exception as e:
+                    logger.error(f"Could not connect pooled client for user {user_id}: {str(e)}")
+                    await self._notify_available()
+                    raise ClientUnavailable(str(e))
+
+                if not await client.is_user_authorized():
+                    logger.error(f"User {user_id} is not authorized")
+                    await client.disconnect()
+                    await self._notify_available()
+                    return None
+
+                entry = PooledClient(user_id, session_string, client)
+                self.entries[user_id] = entry
+                self._track_identity(entry)
+                self._take_over(entry)
+
+            entry.borrowers += 1
+            entry.last_used = time.monotonic()
+            return entry.client
+
+    def _find_entry(self, user_id, client):
+        # The client may belong to an entry that was replaced while it was borrowed
+        entry = self.entries.get(user_id)
+        if entry is not None and entry.client is client:
+            return entry
+        return self.retired.get(client)
+
+    async def _returned(self, entry):
+        if not entry.is_idle():
+            return
+        if self.retired.pop(entry.client, None) is not None:
+            await self._close_entry(entry)
+        else:
+            await self._notify_available()
+
+    async def release(self, user_id, client):
+        """Return a borrowed client to the pool"""
+        entry = self._find_entry(user_id, client)
+        if entry is None:
+            return
+
+        entry.borrowers = max(0, entry.borrowers - 1)
+        entry.last_used = time.monotonic()
+        await self._returned(entry)
+
+    @asynccontextmanager
+    async def client(self, user_id, session_string, api_id, api_hash):
+        """Borrow a client for the duration of an async with block"""
+        client = await self.acquire(user_id, session_string, api_id, api_hash)
+        try:
+            yield client
+        finally:
+            if client is not None:
+                await self.release(user_id, client)
+
+    def pin(self, user_id):
+        """
+        Keep a user's client open regardless of idle time (e.g. auto-response)
+
+        The pin belongs to the user, if the client is replaced the new one keeps it
+        """
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            entry.pinned += 1
+
+    async def unpin(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is not None and entry.pinned:
+            entry.pinned -= 1
+            entry.last_used = time.monotonic()
+            await self._returned(entry)
+            return
+
+        # The client was replaced and no new one has connected yet
+        pinned, handlers = self.carried.get(user_id, (0, []))
+        if pinned > 1 or handlers:
+            self.carried[user_id] = (max(0, pinned - 1), handlers)
+        else:
+            self.carried.pop(user_id, None)
+
+    def add_event_handler(self, user_id, callback, event):
+        """
+        Register an event handler on a user's client that follows it when the pool replaces the client
+
+        Returns:
+            False if the user has no pooled client
+        """
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return False
+        entry.client.add_event_handler(callback, event)
+        entry.handlers.append((callback, event))
+        return True
+
+    def remove_event_handler(self, user_id, callback):
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            entry.client.remove_event_handler(callback)
+            entry.handlers = [handler for handler in entry.handlers if handler[0] is not callback]
+
+        if user_id in self.carried:
+            pinned, handlers = self.carried[user_id]
+            self.carried[user_id] = (pinned, [handler for handler in handlers if handler[0] is not callback])
+
+    def _carry_over(self, entry):
+        """Detach the pins and handlers of a client being replaced so its replacement takes them"""
+        if not entry.pinned and not entry.handlers:
+            return
+
+        for callback, event in entry.handlers:
+            entry.client.remove_event_handler(callback, event)
+
+        pinned, handlers = self.carried.get(entry.user_id, (0, []))
+        self.carried[entry.user_id] = (pinned + entry.pinned, handlers + entry.handlers)
+        logger.info(f"Pooled client for user {entry.user_id} was replaced, its pins and handlers move to the next one")
+        entry.pinned = 0
+        entry.handlers = []
+
+    def _take_over(self, entry):
+        carried = self.carried.pop(entry.user_id, None)
+        if carried is None:
+            return
+
+        entry.pinned, entry.handlers = carried
+        for callback, event in entry.handlers:
+            entry.client.add_event_handler(callback, event)
+
+    async def get_identity(self, user_id):
+        """
+        Get the account identity of a pooled client, calling get_me only once
+
+        Returns:
+            Dict with id, username and lowercase first_name, or None if the user has no pooled client
+        """
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+
+        if entry.identity is None:
+            me = await entry.client.get_me()
+            if me is None:
+                return None
+            entry.identity = {
+                'id': me.id,
+                'username': me.username,
+                'first_name': (me.first_name or '').lower()
+            }
+        return entry.identity
+
+    def _track_identity(self, entry):
+        """Forget the cached identity when the account changes its name or username"""
+        async def on_user_update(update):
+            if entry.identity is not None and update.user_id == entry.identity['id']:
+                entry.identity = None
+
+        entry.client.add_event_handler(on_user_update, events.Raw(types=(UpdateUser, UpdateUserName)))
+
+    async def _check_health(self, entry):
+        """
+        Reconnect a dropped client and re-check authorization periodically
+
+        Returns:
+            True if the client is usable, False if the session is no longer authorized
+        Raises:
+            ClientUnavailable if the client couldn't reconnect
+        """
+        try:
+            if not entry.client.is_connected():
+                logger.info(f"Reconnecting pooled client for user {entry.user_id}")
+                await entry.client.connect()
+                entry.last_checked = 0
+
+            if time.monotonic() - entry.last_checked >= self.health_check_seconds:
+                if not await entry.client.is_user_authorized():
+                    logger.error(f"Pooled session for user {entry.user_id} is no longer authorized")
+                    return False
+                entry.last_checked = time.monotonic()
+
+            return True
+        except Exception as e:
+            logger.error(f"Health check failed for user {entry.user_id}: {str(e)}")
+            raise ClientUnavailable(str(e))
+
+    async def _wait_for_slot(self, timeout):
+        """Make room for a new connection, evicting the least recently used idle client"""
+        condition = self._get_available_condition()
+        deadline = time.monotonic() + timeout
+
+        while len(self.entries) + len(self.retired) >= self.max_connections:
+            # An entry whose user lock is held may be mid-acquire (e.g. in _check_health)
+            # with no borrowers yet, closing it would hand that acquire a dead client
+            idle_entries = [
+                entry for entry in self.entries.values()
+                if entry.is_idle() and not self._get_user_lock(entry.user_id).locked()
+            ]
+            if idle_entries:
+                oldest = min(idle_entries, key=lambda entry: entry.last_used)
+                async with self._get_user_lock(oldest.user_id):
+                    if oldest.is_idle() and self.entries.get(oldest.user_id) is oldest:
+                        await self._close_entry(oldest)
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            try:
+                async with condition:
+                    await asyncio.wait_for(condition.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+
+        return True
+
+    async def _retire_entry(self, entry):
+        """Replace a user's client, closing it now or when its last borrower lets go"""
+        if self.entries.get(entry.user_id) is entry:
+            del self.entries[entry.user_id]
+        self._carry_over(entry)
+
+        if entry.is_idle():
+            await self._close_entry(entry)
+        else:
+            logger.info(f"Pooled client for user {entry.user_id} is in use, closing it once released")
+            self.retired[entry.client] = entry
+
+    async def _close_entry(self, entry):
+        if self.entries.get(entry.user_id) is entry:
+            del self.entries[entry.user_id]
+
+        try:
+            await entry.client.disconnect()
+        except Exception as e:
+            logger.error(f"Error disconnecting pooled client for user {entry.user_id}: {str(e)}")
+
+        logger.info(f"Closed pooled client for user {entry.user_id}")
+        await self._notify_available()
+
+    async def _evict_idle_clients(self):
+        """Disconnect clients nobody has used for idle_seconds"""
+        while True:
+            await asyncio.sleep(max(1, min(self.idle_seconds, 60)))
+
+            now = time.monotonic()
+            for entry in list(self.entries.values()):
+                if entry.is_idle() and now - entry.last_used >= self.idle_seconds:
+                    async with self._get_user_lock(entry.user_id):
+                        if entry.is_idle() and self.entries.get(entry.user_id) is entry:
+                            await self._close_entry(entry)
@@ -24,3 +24,55 @@ REQUIRED_CHANNEL_USERNAME = os.getenv("REQUIRED_CHANNEL_USERNAME", "")
 # معلومات API تيليجرام
 API_ID = int(os.getenv("API_ID", "12345"))
 API_HASH = os.getenv("API_HASH", "0123456789abcdef0123456789abcdef")
+
+# إعدادات مجمع عملاء Telethon المشترك بين النشر والردود التلقائية وجلب المجموعات
+CLIENT_POOL_MAX_CONNECTIONS = int(os.getenv("CLIENT_POOL_MAX_CONNECTIONS", "200"))
+CLIENT_POOL_IDLE_SECONDS = int(os.getenv("CLIENT_POOL_IDLE_SECONDS", "900"))
+CLIENT_POOL_HEALTH_CHECK_SECONDS = int(os.getenv("CLIENT_POOL_HEALTH_CHECK_SECONDS", "300"))
+# مهلة إعادة محاولة دورة النشر عندما يكون المجمع ممتلئاً أو تعذر الاتصال (بالثواني)
+CLIENT_POOL_RETRY_SECONDS = int(os.getenv("CLIENT_POOL_RETRY_SECONDS", "60"))
+
+# مدة صلاحية فهرس كيانات المجموعات المخزن لكل حساب (بالثواني)
+ENTITY_INDEX_TTL_SECONDS = int(os.getenv("ENTITY_INDEX_TTL_SECONDS", "86400"))
+
+# مهلة إعادة المحاولة للمجموعات التي تعذر الوصول إليها (تتضاعف مع كل فشل)
+RESOLVE_RETRY_BASE_SECONDS = int(os.getenv("RESOLVE_RETRY_BASE_SECONDS", "600"))
+RESOLVE_RETRY_MAX_SECONDS = int(os.getenv("RESOLVE_RETRY_MAX_SECONDS", "86400"))
+
+# حدود إرسال النشر لكل حساب (دلو الرموز والتوازي والتأخير العشوائي)
+POSTING_RATE_PER_MINUTE = int(os.getenv("POSTING_RATE_PER_MINUTE", "20"))
+POSTING_BURST = int(os.getenv("POSTING_BURST", "5"))
+POSTING_CONCURRENCY = int(os.getenv("POSTING_CONCURRENCY", "3"))
+POSTING_JITTER_SECONDS = float(os.getenv("POSTING_JITTER_SECONDS", "1.5"))
+POSTING_FLOOD_WAIT_RETRIES = int(os.getenv("POSTING_FLOOD_WAIT_RETRIES", "3"))
+
+# أقصى عدد من دورات النشر التي يشغلها المجدول في نفس الوقت
+POSTING_MAX_CONCURRENT_TASKS = int(os.getenv("POSTING_MAX_CONCURRENT_TASKS", "50"))
+
+# تجميع كتابات الرسائل المرسلة وتحديثات الحالة (عدد العناصر وأقصى عمر بالثواني قبل التفريغ)
+WRITE_BUFFER_MAX_ITEMS = int(os.getenv("WRITE_BUFFER_MAX_ITEMS", "200"))
+WRITE_BUFFER_MAX_AGE_SECONDS = float(os.getenv("WRITE_BUFFER_MAX_AGE_SECONDS", "5"))
+
+# إعدادات SQLite: مهلة انتظار القفل (ملي ثانية)، وضع synchronous، حجم الذاكرة المؤقتة (KiB) وحجم mmap (بايت)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "20000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", "268435456"))
+
+# عدد خيوط قاعدة البيانات التي تنفذ استعلامات المعالجات غير المتزامنة
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+# عدد الصفوف التي يقرأها find في كل دفعة عند المرور على النتائج
+DB_FIND_BATCH_SIZE = int(os.getenv("DB_FIND_BATCH_SIZE", "500"))
+
+# ذاكرة عضوية القناة المطلوبة: صلاحية نتيجة المشترك وغير المشترك (ثوانٍ) وأقصى عدد من المستخدمين
+CHANNEL_MEMBER_CACHE_SECONDS = int(os.getenv("CHANNEL_MEMBER_CACHE_SECONDS", "600"))
+CHANNEL_NON_MEMBER_CACHE_SECONDS = int(os.getenv("CHANNEL_NON_MEMBER_CACHE_SECONDS", "30"))
+CHANNEL_MEMBERSHIP_CACHE_MAX_ENTRIES = int(os.getenv("CHANNEL_MEMBERSHIP_CACHE_MAX_ENTRIES", "50000"))
+
+# أقصى عدد من طلبات get_chat_member الجارية في نفس الوقت للتحقق من الاشتراك
+CHANNEL_CHECK_MAX_CONCURRENT = int(os.getenv("CHANNEL_CHECK_MAX_CONCURRENT", "20"))
+
+# ذاكرة سجلات المستخدمين في SubscriptionService: مدة الصلاحية (ثوانٍ) وأقصى عدد من المستخدمين
+USER_CACHE_SECONDS = int(os.getenv("USER_CACHE_SECONDS", "300"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
@@ -0,0 +1,9 @@
+import pytest
+from db import Database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, fully migrated database in a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Database, '_instance', None)
+    return Database()
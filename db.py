@@ -1,358 +1,173 @@
 import sqlite3
 import os
 import json
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from migrations import run_migrations
+from config import (
+    SQLITE_BUSY_TIMEOUT_MS, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE,
+    DB_EXECUTOR_WORKERS, DB_FIND_BATCH_SIZE
+)
 
 class Database:
     _instance = None
+
+    # Timestamp columns stored as integer epoch seconds, CollectionWrapper converts
+    # datetimes to and from them
+    EPOCH_COLUMNS = {
+        'users': ('subscription_end', 'created_at', 'updated_at'),
+        'subscriptions': ('created_at',),
+        'referrals': ('created_at', 'updated_at'),
+        'messages': ('timestamp',),
+        'active_tasks': ('start_time', 'last_activity'),
+    }
     
+    # Unique key of each table that update_one(upsert=True) turns into INSERT ... ON CONFLICT
+    UNIQUE_KEYS = {
+        'users': ('user_id',),
+        'settings': ('type',),
+        'group_entities': ('user_id', 'group_id'),
+        'groups': ('user_id', 'group_id'),
+        'responses': ('user_id', 'response_type'),
+    }
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(Database, cls).__new__(cls)
             # Create data directory if it doesn't exist
             os.makedirs('data', exist_ok=True)
-            # Connect to SQLite database (will be created if it doesn't exist)
-            cls._instance.conn = sqlite3.connect('data/telegram_bot.db', check_same_thread=False)
-            cls._instance.conn.row_factory = sqlite3.Row
-            cls._instance.cursor = cls._instance.conn.cursor()
-            # Initialize database tables
-            cls._instance._init_tables()
+            cls._instance.db_path = 'data/telegram_bot.db'
+            # One connection and cursor per thread, see the conn/cursor properties
+            cls._instance._local = threading.local()
+            cls._instance._connections = {}
+            cls._instance._connections_lock = threading.Lock()
+            # Writes from every thread go through this lock one at a time
+            cls._instance.write_lock = threading.RLock()
+            # Threads that run queries for async callers, started on first use
+            cls._instance._executor = None
+            cls._instance._executor_lock = threading.Lock()
+            # Connect to SQLite database (will be created if it doesn't exist) and
+            # switch it to WAL once, the journal mode is stored in the file
+            cls._instance.conn.execute('PRAGMA journal_mode = WAL')
+            # Bring the schema up to date, a single version check once it is
+            run_migrations(cls._instance)
         return cls._instance
     
-    def _init_tables(self):
-        # Create users table with phone_code_hash column
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            is_admin INTEGER DEFAULT 0,
-            referral_code TEXT,
-            referred_by INTEGER,
-            subscription_end TEXT,
-            api_id INTEGER,
-            api_hash TEXT,
-            phone_number TEXT,
-            phone_code_hash TEXT,
-            code_request_time TEXT,
-            code_resend_attempts INTEGER DEFAULT 0,
-            code_input_attempts INTEGER DEFAULT 0,
-            session_string TEXT,
-            telegram_user_id INTEGER,
-            telegram_username TEXT,
-            telegram_first_name TEXT,
-            telegram_last_name TEXT,
-            auto_response_active INTEGER DEFAULT 0,
-            created_at TEXT,
-            updated_at TEXT,
-            FOREIGN KEY (referred_by) REFERENCES users (user_id) ON DELETE SET NULL
-        )
-        ''')
-        
-        # Create responses table for auto-responses
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS responses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            response_type TEXT,
-            response_text TEXT,
-            is_active INTEGER DEFAULT 1,
-            created_at TEXT,
-            updated_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # Check if phone_code_hash column exists in users table, add it if not
-        try:
-            self.cursor.execute("SELECT phone_code_hash FROM users LIMIT 1")
-        except sqlite3.OperationalError:
-            # Column doesn't exist, add it
-            self.cursor.execute("ALTER TABLE users ADD COLUMN phone_code_hash TEXT")
-            print("Added phone_code_hash column to users table")
-            
-        # Check if code_request_time column exists in users table, add it if not
-        try:
-            self.cursor.execute("SELECT code_request_time FROM users LIMIT 1")
-        except sqlite3.OperationalError:
-            # Column doesn't exist, add it
-            self.cursor.execute("ALTER TABLE users ADD COLUMN code_request_time TEXT")
-            print("Added code_request_time column to users table")
-            
-        # Check if code_resend_attempts column exists in users table, add it if not
-        try:
-            self.cursor.execute("SELECT code_resend_attempts FROM users LIMIT 1")
-        except sqlite3.OperationalError:
-            # Column doesn't exist, add it
-            self.cursor.execute("ALTER TABLE users ADD COLUMN code_resend_attempts INTEGER DEFAULT 0")
-            print("Added code_resend_attempts column to users table")
-            
-        # Check if code_input_attempts column exists in users table, add it if not
-        try:
-            self.cursor.execute("SELECT code_input_attempts FROM users LIMIT 1")
-        except sqlite3.OperationalError:
-            # Column doesn't exist, add it
-            self.cursor.execute("ALTER TABLE users ADD COLUMN code_input_attempts INTEGER DEFAULT 0")
-            print("Added code_input_attempts column to users table")
-            
-        # Check if auto_response_active column exists in users table, add it if not
-        try:
-            self.cursor.execute("SELECT auto_response_active FROM users LIMIT 1")
-        except sqlite3.OperationalError:
-            # Column doesn't exist, add it
-            self.cursor.execute("ALTER TABLE users ADD COLUMN auto_response_active INTEGER DEFAULT 0")
-            print("Added auto_response_active column to users table")
-        
-        # Create subscriptions table
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            days INTEGER,
-            added_by INTEGER,
-            created_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
-            FOREIGN KEY (added_by) REFERENCES users (user_id) ON DELETE SET NULL
-        )
-        ''')
-        
-        # Create sessions table
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            api_id INTEGER,
-            api_hash TEXT,
-            phone TEXT,
-            phone_code_hash TEXT,
-            session_string TEXT,
-            created_at TEXT,
-            updated_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            # Room for every compiled statement of the collection wrappers
+            cached_statements=256
         )
-        ''')
-        
-        # Create groups table
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS groups (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            group_id TEXT,
-            title TEXT,
-            blacklisted INTEGER DEFAULT 0,
-            created_at TEXT,
-            updated_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # تصحيح: تغيير نوع عمود group_id من INTEGER إلى TEXT للتوافق مع الكود
-        try:
-            self.cursor.execute("ALTER TABLE groups RENAME TO groups_old")
-            self.cursor.execute('''
-            CREATE TABLE groups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                group_id TEXT,
-                title TEXT,
-                blacklisted INTEGER DEFAULT 0,
-                created_at TEXT,
-                updated_at TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-            )
-            ''')
-            self.cursor.execute("INSERT INTO groups SELECT * FROM groups_old")
-            self.cursor.execute("DROP TABLE groups_old")
-            print("Fixed group_id column type in groups table")
-        except sqlite3.OperationalError:
-            # إذا فشلت العملية، فقد تكون الجداول غير موجودة أو تم إصلاحها بالفعل
-            pass
-        
-        # تصحيح: إعادة إنشاء جدول posts مع توحيد اسم المفتاح الأساسي إلى id بدلاً من _id
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            message TEXT,
-            group_ids TEXT,
-            delay_seconds INTEGER DEFAULT 0,
-            exact_time TEXT,
-            total_groups INTEGER DEFAULT 0,
-            progress INTEGER DEFAULT 0,
-            successful_posts INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'pending',
-            error TEXT,
-            start_time TEXT,
-            created_at TEXT,
-            updated_at TEXT,
-            completed_at TEXT,
-            timing_type TEXT DEFAULT 'delay',
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # تصحيح: نقل البيانات من الجدول القديم إلى الجديد إذا كان موجوداً
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        # Negative cache_size is in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        return conn
+    
+    @property
+    def conn(self):
+        """SQLite connection of the calling thread, opened on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.cursor = conn.cursor()
+            with self._connections_lock:
+                self._close_dead_connections()
+                self._connections[threading.get_ident()] = conn
+        return conn
+    
+    @property
+    def cursor(self):
+        """Cursor of the calling thread, never shared with another thread"""
+        if getattr(self._local, 'cursor', None) is None:
+            self.conn
+        return self._local.cursor
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work for the calling thread
+
+        Collection writes inside the block are committed once when it exits, or
+        rolled back together if it raises. Blocks can be nested, only the
+        outermost one commits. The writer lock is held for the whole block.
+        """
+        depth = getattr(self._local, 'transaction_depth', 0)
+        if depth == 0:
+            self.write_lock.acquire()
+        self._local.transaction_depth = depth + 1
         try:
-            self.cursor.execute("SELECT _id FROM posts LIMIT 1")
-            # إذا نجح الاستعلام، فهذا يعني أن الجدول القديم موجود
-            print("Migrating data from old posts table to new format")
-            
-            # إنشاء جدول مؤقت للنقل
-            self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS posts_new (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                message TEXT,
-                group_ids TEXT,
-                delay_seconds INTEGER DEFAULT 0,
-                exact_time TEXT,
-                total_groups INTEGER DEFAULT 0,
-                progress INTEGER DEFAULT 0,
-                successful_posts INTEGER DEFAULT 0,
-                status TEXT DEFAULT 'pending',
-                error TEXT,
-                start_time TEXT,
-                created_at TEXT,
-                updated_at TEXT,
-                completed_at TEXT,
-                timing_type TEXT DEFAULT 'delay',
-                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-            )
-            ''')
-            
-            # نقل البيانات مع تحويل أنواع البيانات
-            self.cursor.execute('''
-            INSERT INTO posts_new (
-                id, user_id, message, group_ids, delay_seconds, exact_time, 
-                total_groups, progress, successful_posts, status, error, 
-                start_time, created_at, updated_at, completed_at, timing_type
-            )
-            SELECT 
-                _id, 
-                CAST(user_id AS INTEGER), 
-                message, 
-                group_ids, 
-                CAST(COALESCE(delay_seconds, 0) AS INTEGER), 
-                exact_time,
-                CAST(COALESCE(total, 0) AS INTEGER),
-                CAST(COALESCE(progress, 0) AS INTEGER),
-                CAST(COALESCE(successful_posts, 0) AS INTEGER),
-                status,
-                error,
-                start_time,
-                created_at,
-                updated_at,
-                completed_at,
-                COALESCE(timing_type, 'delay')
-            FROM posts
-            ''')
-            
-            # حذف الجدول القديم
-            self.cursor.execute("DROP TABLE posts")
-            
-            # إعادة تسمية الجدول الجديد
-            self.cursor.execute("ALTER TABLE posts_new RENAME TO posts")
-            
-            print("Successfully migrated posts table data")
-        except sqlite3.OperationalError:
-            # إذا فشل الاستعلام، فهذا يعني أن الجدول القديم غير موجود أو تم إصلاحه بالفعل
-            pass
-        
-        # تصحيح: إنشاء جدول messages مع توحيد المفاتيح الأساسية والخارجية
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            post_id INTEGER,
-            group_id TEXT,
-            message_id INTEGER,
-            timestamp TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
-            FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # تصحيح: إنشاء جدول active_tasks مع توحيد المفاتيح الأساسية والخارجية
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS active_tasks (
-            task_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            post_id INTEGER,
-            message TEXT,
-            group_ids TEXT,
-            delay_seconds INTEGER DEFAULT 0,
-            exact_time TEXT,
-            status TEXT DEFAULT 'pending',
-            start_time TEXT,
-            last_activity TEXT,
-            message_count INTEGER DEFAULT 0,
-            message_id INTEGER,
-            is_recurring INTEGER DEFAULT 1,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
-            FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # Create scheduled_posts table
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS scheduled_posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            message TEXT,
-            interval INTEGER,
-            is_active INTEGER DEFAULT 1,
-            created_at TEXT,
-            updated_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # Create post_groups table (for many-to-many relationship)
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS post_groups (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            post_id INTEGER,
-            group_id INTEGER,
-            FOREIGN KEY (post_id) REFERENCES scheduled_posts (id) ON DELETE CASCADE,
-            FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # Create referrals table
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS referrals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            referrer_id INTEGER,
-            referred_id INTEGER,
-            is_subscribed INTEGER DEFAULT 0,
-            reward_given INTEGER DEFAULT 0,
-            created_at TEXT,
-            updated_at TEXT,
-            FOREIGN KEY (referrer_id) REFERENCES users (user_id) ON DELETE CASCADE,
-            FOREIGN KEY (referred_id) REFERENCES users (user_id) ON DELETE CASCADE
-        )
-        ''')
-        
-        # Create settings table
-        self.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            type TEXT UNIQUE,
-            value TEXT,
-            created_at TEXT,
-            updated_at TEXT
-        )
-        ''')
-        
-        # Commit the changes
-        self.conn.commit()
+            yield self
+        except BaseException:
+            self._local.transaction_depth = depth
+            if depth == 0:
+                try:
+                    self.conn.rollback()
+                finally:
+                    self.write_lock.release()
+            raise
+        else:
+            self._local.transaction_depth = depth
+            if depth == 0:
+                try:
+                    self.conn.commit()
+                finally:
+                    self.write_lock.release()
+    
+    def in_transaction(self):
+        return getattr(self._local, 'transaction_depth', 0) > 0
+    
+    def commit(self):
+        """Commit the calling thread's writes, unless a transaction() block will commit them"""
+        if not self.in_transaction():
+            self.conn.commit()
+    
+    def _close_dead_connections(self):
+        # Caller holds _connections_lock
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in list(self._connections):
+            if ident not in alive:
+                try:
+                    self._connections.pop(ident).close()
+                except sqlite3.Error:
+                    pass
     
     def get_collection(self, collection_name):
         # This method is for compatibility with the MongoDB version
         # It returns a CollectionWrapper that mimics MongoDB collection methods
         return CollectionWrapper(self, collection_name)
     
+    def get_async_collection(self, collection_name):
+        # Same collection with awaitable methods, for code running on an event loop
+        return AsyncCollectionWrapper(self.get_collection(collection_name))
+    
+    @property
+    def executor(self):
+        """Database threads that keep SQLite I/O off the event loops"""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=DB_EXECUTOR_WORKERS,
+                        thread_name_prefix='db'
+                    )
+        return self._executor
+    
+    async def run_async(self, func, *args, **kwargs):
+        """Run a blocking database function on the database threads and await its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+    
     def get_next_id(self, collection_name):
         """
         الحصول على المعرف التالي للمجموعة المحددة
@@ -362,6 +177,7 @@ class Database:
             'subscriptions': 'subscriptions',
             'sessions': 'sessions',
             'groups': 'groups',
+            'group_entities': 'group_entities',
             'posts': 'posts',
             'scheduled_posts': 'scheduled_posts',
             'post_groups': 'post_groups',
@@ -389,10 +205,21 @@ class Database:
             return 1
     
     def close(self):
-        if hasattr(self, 'conn') and self.conn:
-            self.conn.close()
+        with self._connections_lock:
+            for conn in self._connections.values():
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
 
 class CollectionWrapper:
+    # Compiled SQL text by (table, operation, query shape), shared by all wrappers so
+    # the same statement text is reused and sqlite3's statement cache hits
+    _sql_cache = {}
+    SQL_CACHE_MAX_ENTRIES = 1024
+    
     def __init__(self, db, collection_name):
         self.db = db
         self.collection_name = collection_name
@@ -401,6 +228,7 @@ class CollectionWrapper:
             'subscriptions': 'subscriptions',
             'sessions': 'sessions',
             'groups': 'groups',
+            'group_entities': 'group_entities',
             'posts': 'posts',
             'scheduled_posts': 'scheduled_posts',
             'post_groups': 'post_groups',
@@ -409,95 +237,75 @@ class CollectionWrapper:
             'messages': 'messages'
         }
         self.table_name = self.table_map.get(collection_name, collection_name)
+        self.epoch_columns = frozenset(db.EPOCH_COLUMNS.get(self.table_name, ()))
+    
+    def _compile(self, operation, shape, build):
+        # Return the cached SQL of an operation for this query shape, building it once
+        key = (self.table_name, operation, shape)
+        sql = self._sql_cache.get(key)
+        if sql is None:
+            # $in lists of every length are distinct shapes, don't let them grow forever
+            if len(self._sql_cache) >= self.SQL_CACHE_MAX_ENTRIES:
+                self._sql_cache.clear()
+            sql = build()
+            self._sql_cache[key] = sql
+        return sql
     
     def find_one(self, query):
         # Convert MongoDB-style query to SQLite query
-        where_clause, params = self._build_where_clause(query)
+        shape, where_clause, params = self._where(query)
         
         # Build and execute the query
-        sql = f"SELECT * FROM {self.table_name} WHERE {where_clause} LIMIT 1"
+        sql = self._compile('find_one', shape, lambda: f"SELECT * FROM {self.table_name} WHERE {where_clause} LIMIT 1")
         try:
             self.db.cursor.execute(sql, params)
             result = self.db.cursor.fetchone()
             
             if result:
                 # Convert SQLite row to dict
-                return dict(result)
+                return self._document(result)
             return None
         except sqlite3.Error as e:
             print(f"Error in find_one for {self.table_name}: {str(e)}")
             print(f"Query: {sql}, Params: {params}")
             return None
     
-    def find(self, query=None):
-        # If no query is provided, return all documents
-        if query is None:
-            query = {}
-        
-        # Convert MongoDB-style query to SQLite query
-        where_clause, params = self._build_where_clause(query)
+    def find(self, query=None, projection=None, sort=None, limit=0, skip=0, after=None,
+             batch_size=DB_FIND_BATCH_SIZE):
+        """
+        Find documents matching the query, returns a lazy Cursor of dicts
         
-        # Build and execute the query
-        try:
-            if where_clause:
-                sql = f"SELECT * FROM {self.table_name} WHERE {where_clause}"
-            else:
-                sql = f"SELECT * FROM {self.table_name}"
-            
-            self.db.cursor.execute(sql, params)
-            results = self.db.cursor.fetchall()
-            
-            # Convert SQLite rows to dicts
-            return [dict(row) for row in results]
-        except sqlite3.Error as e:
-            print(f"Error in find for {self.table_name}: {str(e)}")
-            print(f"Query: {sql if 'sql' in locals() else 'Not built yet'}, Params: {params}")
-            return []
+        projection: field names or {field: 1} to select only those columns
+        sort: a field name or [(field, 1 / -1), ...]
+        limit, skip: return at most limit documents after skipping skip, 0 is no limit
+        after: keyset cursor, only documents past this value of the first sort field
+        (of rowid, the id column of most tables, when there is no sort)
+        """
+        return Cursor(self, query, projection, sort, limit, skip, after, batch_size)
     
     def insert_one(self, document):
-        # Prepare columns and values
-        columns = []
-        placeholders = []
-        values = []
-        
-        for key, value in document.items():
-            columns.append(key)
-            placeholders.append('?')
-            
-            # Convert complex types to SQLite-compatible types
-            if isinstance(value, list):
-                # Convert lists to JSON strings
-                values.append(json.dumps(value))
-            elif isinstance(value, dict):
-                # Convert dictionaries to JSON strings
-                values.append(json.dumps(value))
-            elif value is None:
-                # Keep None as is
-                values.append(value)
-            elif isinstance(value, (int, float, str, bool)):
-                # Basic types are fine
-                values.append(value)
-            else:
-                # Convert anything else to string
-                values.append(str(value))
-        
         # Build and execute the query
         try:
-            columns_str = ', '.join(columns)
-            placeholders_str = ', '.join(placeholders)
-            sql = f"INSERT INTO {self.table_name} ({columns_str}) VALUES ({placeholders_str})"
+            sql, values = self._insert_statement(document)
             
-            self.db.cursor.execute(sql, values)
-            self.db.conn.commit()
-            
-            # Return an object with inserted_id
-            return InsertOneResult(self.db.cursor.lastrowid)
+            with self.db.write_lock:
+                self.db.cursor.execute(sql, values)
+                self.db.commit()
+                
+                # Return an object with inserted_id
+                return InsertOneResult(self.db.cursor.lastrowid)
         except sqlite3.Error as e:
+            self._rollback()
             print(f"Error in insert_one for {self.table_name}: {str(e)}")
             print(f"SQL: {sql if 'sql' in locals() else 'Not built yet'}")
-            print(f"Values: {values}")
+            print(f"Values: {values if 'values' in locals() else document}")
             return InsertOneResult(None)
     
+    def insert_many(self, documents):
+        """Insert documents in one transaction, documents with the same fields share one executemany"""
+        result = self.bulk_write([InsertOne(document) for document in documents])
+        return InsertManyResult(result.inserted_count)
+    
     def insert(self, document):
         """
         طريقة insert لتكون متوافقة مع الكود الذي يستخدمها
@@ -507,92 +315,254 @@ class CollectionWrapper:
         return result.inserted_id
     
     def update_one(self, query, update, upsert=False):
-        # Check if document exists
-        where_clause, where_params = self._build_where_clause(query)
         try:
-            check_sql = f"SELECT COUNT(*) FROM {self.table_name} WHERE {where_clause}"
-            self.db.cursor.execute(check_sql, where_params)
-            exists = self.db.cursor.fetchone()[0] > 0
-            
-            if exists:
-                # Document exists, perform update
-                set_clause, set_params = self._build_set_clause(update.get('$set', {}))
-                unset_clause, unset_params = self._build_unset_clause(update.get('$unset', {}))
-                
-                if set_clause and unset_clause:
-                    sql = f"UPDATE {self.table_name} SET {set_clause}, {unset_clause} WHERE {where_clause}"
-                    params = set_params + unset_params + where_params
-                elif set_clause:
-                    sql = f"UPDATE {self.table_name} SET {set_clause} WHERE {where_clause}"
-                    params = set_params + where_params
-                elif unset_clause:
-                    sql = f"UPDATE {self.table_name} SET {unset_clause} WHERE {where_clause}"
-                    params = unset_params + where_params
-                else:
-                    return UpdateResult(0, 0)
-                
-                self.db.cursor.execute(sql, params)
-                self.db.conn.commit()
-                return UpdateResult(self.db.cursor.rowcount, 0)
-            elif upsert:
-                # Document doesn't exist and upsert is True, perform insert
-                document = {**query, **update.get('$set', {})}
-                return self.insert_one(document)
-            else:
-                # Document doesn't exist and upsert is False
-                return UpdateResult(0, 0)
+            # Update and insert under the writer lock so two upserts can't both insert
+            with self.db.write_lock:
+                result = self._apply_update(query, update, upsert)
+                self.db.commit()
+                return result
         except sqlite3.Error as e:
+            self._rollback()
             print(f"Error in update_one for {self.table_name}: {str(e)}")
-            print(f"Query: {check_sql if 'check_sql' in locals() else 'Not built yet'}")
-            print(f"Params: {where_params}")
+            print(f"Query: {query}, Update: {update}")
             return UpdateResult(0, 0)
     
-    def delete_one(self, query):
-        # Convert MongoDB-style query to SQLite query
-        where_clause, params = self._build_where_clause(query)
+    def update_many(self, query, update, upsert=False):
+        """Update every document matching the query with one UPDATE statement"""
+        # update_one already updates all matching rows, the statement is the same
+        return self.update_one(query, update, upsert)
+    
+    def _apply_update(self, query, update, upsert):
+        # Run an update without committing, caller holds the writer lock
+        set_fields = update.get('$set', {})
+        unset_fields = update.get('$unset', {})
+        
+        # One INSERT ... ON CONFLICT DO UPDATE when the query is the table's unique key
+        if upsert and self._is_unique_key(query):
+            existed = self._exists(query)
+            sql, values = self._upsert_statement(query, set_fields, unset_fields)
+            self.db.cursor.execute(sql, values)
+            if existed:
+                return UpdateResult(self.db.cursor.rowcount, 0)
+            return UpdateResult(0, self.db.cursor.lastrowid)
         
+        sql, params = self._update_statement(query, set_fields, unset_fields)
+        if sql is not None:
+            self.db.cursor.execute(sql, params)
+            modified_count = self.db.cursor.rowcount
+            if modified_count > 0 or not upsert:
+                return UpdateResult(modified_count, 0)
+        elif not upsert:
+            return UpdateResult(0, 0)
+        elif self._exists(query):
+            # Nothing to set, only insert when no document matches
+            return UpdateResult(0, 0)
+        
+        # Document doesn't exist and upsert is True, perform insert
+        sql, values = self._insert_statement({**query, **set_fields})
+        self.db.cursor.execute(sql, values)
+        return UpdateResult(0, self.db.cursor.lastrowid)
+    
+    def _exists(self, query):
+        shape, where_clause, params = self._where(query)
+        sql = self._compile('exists', shape, lambda: f"SELECT 1 FROM {self.table_name} WHERE {where_clause} LIMIT 1")
+        self.db.cursor.execute(sql, params)
+        return self.db.cursor.fetchone() is not None
+    
+    def _is_unique_key(self, query):
+        keys = self.db.UNIQUE_KEYS.get(self.table_name)
+        if not keys or set(query) != set(keys):
+            return False
+        return not any(isinstance(value, dict) for value in query.values())
+    
+    def _insert_statement(self, document):
+        columns = tuple(document)
+        sql = self._compile('insert', columns, lambda: (
+            f"INSERT INTO {self.table_name} ({', '.join(columns)}) "
+            f"VALUES ({', '.join(['?'] * len(columns))})"
+        ))
+        return sql, [self._column_value(key, document[key]) for key in columns]
+    
+    def _update_statement(self, query, set_fields, unset_fields):
+        # Returns (None, []) when there is nothing to set
+        if not set_fields and not unset_fields:
+            return None, []
+        
+        shape, where_clause, where_params = self._where(query)
+        set_clause, set_params = self._build_set_clause(set_fields)
+        unset_clause, unset_params = self._build_unset_clause(unset_fields)
+        
+        update_shape = (tuple(set_fields), tuple(unset_fields), shape)
+        sql = self._compile('update', update_shape, lambda: (
+            f"UPDATE {self.table_name} SET "
+            f"{', '.join(clause for clause in (set_clause, unset_clause) if clause)} "
+            f"WHERE {where_clause}"
+        ))
+        return sql, set_params + unset_params + where_params
+    
+    def _upsert_statement(self, query, set_fields, unset_fields):
+        keys = self.db.UNIQUE_KEYS[self.table_name]
+        document = {**query, **set_fields}
+        columns = tuple(document)
+        update_columns = tuple(key for key in set_fields if key not in keys)
+        unset_columns = tuple(key for key in unset_fields if key not in document)
+        
+        def build():
+            assignments = [f"{key} = excluded.{key}" for key in update_columns]
+            assignments += [f"{key} = NULL" for key in unset_columns]
+            if assignments:
+                conflict_action = f"DO UPDATE SET {', '.join(assignments)}"
+            else:
+                conflict_action = "DO NOTHING"
+            return (
+                f"INSERT INTO {self.table_name} ({', '.join(columns)}) "
+                f"VALUES ({', '.join(['?'] * len(columns))}) "
+                f"ON CONFLICT ({', '.join(keys)}) {conflict_action}"
+            )
+        
+        sql = self._compile('upsert', (columns, update_columns, unset_columns), build)
+        return sql, [self._column_value(key, document[key]) for key in columns]
+    
+    def _delete_statement(self, query, just_one=False):
+        shape, where_clause, params = self._where(query)
+        if just_one:
+            sql = self._compile('delete_one', shape, lambda: f"DELETE FROM {self.table_name} WHERE {where_clause} LIMIT 1")
+        else:
+            sql = self._compile('delete_many', shape, lambda: f"DELETE FROM {self.table_name} WHERE {where_clause}")
+        return sql, params
+    
+    def delete_one(self, query):
         # Build and execute the query
         try:
-            sql = f"DELETE FROM {self.table_name} WHERE {where_clause} LIMIT 1"
-            self.db.cursor.execute(sql, params)
-            self.db.conn.commit()
-            return DeleteResult(self.db.cursor.rowcount)
+            sql, params = self._delete_statement(query, just_one=True)
+            with self.db.write_lock:
+                self.db.cursor.execute(sql, params)
+                self.db.commit()
+                return DeleteResult(self.db.cursor.rowcount)
         except sqlite3.Error as e:
+            self._rollback()
             print(f"Error in delete_one for {self.table_name}: {str(e)}")
             print(f"SQL: {sql if 'sql' in locals() else 'Not built yet'}")
-            print(f"Params: {params}")
+            print(f"Query: {query}")
             return DeleteResult(0)
     
     def delete_many(self, query):
-        # Convert MongoDB-style query to SQLite query
-        where_clause, params = self._build_where_clause(query)
-        
         # Build and execute the query
         try:
-            sql = f"DELETE FROM {self.table_name} WHERE {where_clause}"
-            self.db.cursor.execute(sql, params)
-            self.db.conn.commit()
-            return DeleteResult(self.db.cursor.rowcount)
+            sql, params = self._delete_statement(query)
+            with self.db.write_lock:
+                self.db.cursor.execute(sql, params)
+                self.db.commit()
+                return DeleteResult(self.db.cursor.rowcount)
         except sqlite3.Error as e:
+            self._rollback()
             print(f"Error in delete_many for {self.table_name}: {str(e)}")
             print(f"SQL: {sql if 'sql' in locals() else 'Not built yet'}")
-            print(f"Params: {params}")
+            print(f"Query: {query}")
             return DeleteResult(0)
     
+    def bulk_write(self, operations):
+        """
+        Run InsertOne/UpdateOne/UpdateMany/DeleteOne/DeleteMany operations in one transaction
+        
+        Consecutive operations that compile to the same statement are sent with one
+        executemany. On error everything is rolled back and all counts are 0.
+        """
+        operations = list(operations)
+        for operation in operations:
+            if not isinstance(operation, (InsertOne, UpdateOne, DeleteOne)):
+                raise TypeError(f"Unsupported bulk operation: {operation!r}")
+        
+        counts = {'inserted': 0, 'modified': 0, 'deleted': 0}
+        # Statement being batched: [sql, counter, params list, unique keys of its upserts]
+        batch = None
+        
+        def flush():
+            if batch is None:
+                return
+            sql, counter, params, upsert_keys = batch
+            if counter != 'upserted':
+                self.db.cursor.executemany(sql, params)
+                counts[counter] += max(self.db.cursor.rowcount, 0)
+                return
+            
+            # rowcount counts inserted and updated rows alike, keys missing beforehand are the inserts
+            inserted = 0
+            seen = set()
+            for query in upsert_keys:
+                key = tuple(sorted(query.items()))
+                if key not in seen:
+                    seen.add(key)
+                    inserted += not self._exists(query)
+            self.db.cursor.executemany(sql, params)
+            counts['inserted'] += inserted
+            counts['modified'] += max(self.db.cursor.rowcount - inserted, 0)
+        
+        try:
+            with self.db.write_lock:
+                for operation in operations:
+                    if isinstance(operation, InsertOne):
+                        sql, params = self._insert_statement(operation.document)
+                        counter = 'inserted'
+                    elif isinstance(operation, (UpdateOne, UpdateMany)):
+                        if operation.upsert and not self._is_unique_key(operation.query):
+                            # Whether it inserts depends on the update, run it on its own
+                            flush()
+                            batch = None
+                            result = self._apply_update(operation.query, operation.update, True)
+                            counts['modified'] += max(result.modified_count, 0)
+                            if result.upserted_id:
+                                counts['inserted'] += 1
+                            continue
+                        
+                        set_fields = operation.update.get('$set', {})
+                        unset_fields = operation.update.get('$unset', {})
+                        if operation.upsert:
+                            sql, params = self._upsert_statement(operation.query, set_fields, unset_fields)
+                            counter = 'upserted'
+                        else:
+                            sql, params = self._update_statement(operation.query, set_fields, unset_fields)
+                            if sql is None:
+                                continue
+                            counter = 'modified'
+                    elif isinstance(operation, (DeleteOne, DeleteMany)):
+                        sql, params = self._delete_statement(
+                            operation.query, just_one=isinstance(operation, DeleteOne)
+                        )
+                        counter = 'deleted'
+                    
+                    upsert_key = operation.query if counter == 'upserted' else None
+                    if batch is not None and batch[0] == sql:
+                        batch[2].append(params)
+                        batch[3].append(upsert_key)
+                    else:
+                        flush()
+                        batch = [sql, counter, [params], [upsert_key]]
+                
+                flush()
+                self.db.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            print(f"Error in bulk_write for {self.table_name}: {str(e)}")
+            return BulkWriteResult(0, 0, 0)
+        except Exception:
+            # e.g. a value sqlite3 can't bind, don't leave earlier operations for the next commit
+            self._rollback()
+            raise
+        
+        return BulkWriteResult(counts['inserted'], counts['modified'], counts['deleted'])
+    
     def count_documents(self, query=None):
         # If no query is provided, count all documents
         if query is None:
             query = {}
         
         # Convert MongoDB-style query to SQLite query
-        where_clause, params = self._build_where_clause(query)
+        shape, where_clause, params = self._where(query)
         
         # Build and execute the query
         try:
-            if where_clause:
-                sql = f"SELECT COUNT(*) FROM {self.table_name} WHERE {where_clause}"
-            else:
-                sql = f"SELECT COUNT(*) FROM {self.table_name}"
+            sql = self._compile('count', shape, lambda: f"SELECT COUNT(*) FROM {self.table_name} WHERE {where_clause}")
             
             self.db.cursor.execute(sql, params)
             result = self.db.cursor.fetchone()
@@ -603,78 +573,200 @@ class CollectionWrapper:
             print(f"Params: {params}")
             return 0
     
-    def _build_where_clause(self, query):
-        # Build WHERE clause from MongoDB-style query
-        if not query:
-            return "1=1", []
+    def aggregate(self, fields, query=None, group_by=None):
+        """
+        Compute Count/Sum fields over the documents matching query in one SELECT
         
-        clauses = []
+        fields maps result names to Count(filter=None) or Sum(field, filter=None),
+        filtered fields become SUM(CASE WHEN ...). Without group_by returns one dict,
+        with group_by (a field name or a list of them) a list of dicts that also
+        hold the group fields.
+        """
+        if isinstance(group_by, str):
+            group_by = (group_by,)
+        group_by = tuple(group_by or ())
+        shape, where_clause, where_params = self._where(query or {})
+        
+        # Filters of the fields are compiled like queries, their params come first
+        expressions = []
         params = []
+        for name, field in fields.items():
+            if field.filter:
+                filter_shape, filter_clause, filter_params = self._where(field.filter)
+                params.extend(filter_params)
+            else:
+                filter_shape, filter_clause = None, None
+            expressions.append((name, type(field).__name__, field.field, filter_shape, filter_clause))
+        
+        def build():
+            columns = list(group_by)
+            for name, kind, column, _, filter_clause in expressions:
+                value = '1' if kind == 'Count' else column
+                if filter_clause:
+                    columns.append(f"COALESCE(SUM(CASE WHEN {filter_clause} THEN {value} ELSE 0 END), 0) AS {name}")
+                elif kind == 'Count':
+                    columns.append(f"COUNT(*) AS {name}")
+                else:
+                    columns.append(f"COALESCE(SUM({value}), 0) AS {name}")
+            sql = f"SELECT {', '.join(columns)} FROM {self.table_name} WHERE {where_clause}"
+            if group_by:
+                sql += f" GROUP BY {', '.join(group_by)}"
+            return sql
+        
+        aggregate_shape = (tuple(expression[:4] for expression in expressions), group_by, shape)
+        try:
+            sql = self._compile('aggregate', aggregate_shape, build)
+            self.db.cursor.execute(sql, params + where_params)
+            if group_by:
+                return [dict(row) for row in self.db.cursor.fetchall()]
+            return dict(self.db.cursor.fetchone())
+        except sqlite3.Error as e:
+            print(f"Error in aggregate for {self.table_name}: {str(e)}")
+            print(f"SQL: {sql if 'sql' in locals() else 'Not built yet'}")
+            print(f"Params: {params + where_params}")
+            if group_by:
+                return []
+            return {name: 0 for name in fields}
+
+    def _rollback(self):
+        # Called from except blocks. Inside db.transaction() re-raise the current
+        # error so the whole unit of work rolls back instead of committing part of it
+        if self.db.in_transaction():
+            raise
+        
+        # Don't leave a failed write holding the database write lock
+        try:
+            self.db.conn.rollback()
+        except sqlite3.Error:
+            pass
+    
+    def explain(self, query=None):
+        """Return the EXPLAIN QUERY PLAN details of find() with this query"""
+        where_clause, params = self._build_where_clause(query or {})
+        sql = f"SELECT * FROM {self.table_name} WHERE {where_clause}"
+        
+        cursor = self.db.conn.cursor()
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row['detail'] for row in cursor.fetchall()]
+    
+    # Comparison operators supported in queries
+    OPERATORS = {
+        '$eq': '=',
+        '$ne': '!=',
+        '$gt': '>',
+        '$gte': '>=',
+        '$lt': '<',
+        '$lte': '<=',
+        '$in': 'IN',
+        '$nin': 'NOT IN'
+    }
+    
+    def _where_shape(self, query):
+        # The query without its values: field names, operators and $in list lengths
+        shape = []
+        for key, value in query.items():
+            if isinstance(value, dict):
+                shape.append((key, tuple(
+                    (op, len(op_value) if op in ('$in', '$nin') else None)
+                    for op, op_value in value.items()
+                    if op in self.OPERATORS
+                )))
+            else:
+                shape.append((key, None))
+        return tuple(shape)
+    
+    def _where(self, query):
+        # Returns (shape, WHERE clause, params), the clause is compiled once per shape
+        if not query:
+            return (), "1=1", []
+        
+        shape = self._where_shape(query)
+        where_clause = self._compile('where', shape, lambda: self._compile_where(shape))
         
+        params = []
         for key, value in query.items():
             if isinstance(value, dict):
-                # Handle MongoDB operators
                 for op, op_value in value.items():
-                    if op == '$eq':
-                        clauses.append(f"{key} = ?")
-                        params.append(op_value)
-                    elif op == '$ne':
-                        clauses.append(f"{key} != ?")
-                        params.append(op_value)
-                    elif op == '$gt':
-                        clauses.append(f"{key} > ?")
-                        params.append(op_value)
-                    elif op == '$gte':
-                        clauses.append(f"{key} >= ?")
-                        params.append(op_value)
-                    elif op == '$lt':
-                        clauses.append(f"{key} < ?")
-                        params.append(op_value)
-                    elif op == '$lte':
-                        clauses.append(f"{key} <= ?")
-                        params.append(op_value)
-                    elif op == '$in':
-                        placeholders = ', '.join(['?'] * len(op_value))
-                        clauses.append(f"{key} IN ({placeholders})")
-                        params.extend(op_value)
-                    elif op == '$nin':
-                        placeholders = ', '.join(['?'] * len(op_value))
-                        clauses.append(f"{key} NOT IN ({placeholders})")
-                        params.extend(op_value)
+                    if op in ('$in', '$nin'):
+                        params.extend(self._param(key, item) for item in op_value)
+                    elif op in self.OPERATORS:
+                        params.append(self._param(key, op_value))
             else:
+                params.append(self._param(key, value))
+        
+        return shape, where_clause, params
+    
+    def _compile_where(self, shape):
+        clauses = []
+        for key, operators in shape:
+            if operators is None:
                 # Simple equality
                 clauses.append(f"{key} = ?")
-                params.append(value)
+                continue
+            
+            # Handle MongoDB operators
+            for op, length in operators:
+                if op in ('$in', '$nin'):
+                    placeholders = ', '.join(['?'] * length)
+                    clauses.append(f"{key} {self.OPERATORS[op]} ({placeholders})")
+                else:
+                    clauses.append(f"{key} {self.OPERATORS[op]} ?")
         
-        return ' AND '.join(clauses), params
+        return ' AND '.join(clauses) or "1=1"
+    
+    def _build_where_clause(self, query):
+        # Build WHERE clause from MongoDB-style query
+        _, where_clause, params = self._where(query)
+        return where_clause, params
+    
+    @staticmethod
+    def _to_sql_value(value):
+        # Convert complex types to SQLite-compatible types
+        if isinstance(value, (list, dict)):
+            # Convert lists and dictionaries to JSON strings
+            return json.dumps(value)
+        if value is None or isinstance(value, (int, float, str, bool)):
+            # Basic types are fine
+            return value
+        # Convert anything else to string
+        return str(value)
+    
+    @staticmethod
+    def _epoch_value(value):
+        # datetime (or ISO string) to integer epoch seconds, None and numbers pass through
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if isinstance(value, datetime):
+            return int(value.timestamp())
+        return value
+    
+    def _column_value(self, column, value):
+        if column in self.epoch_columns:
+            return self._epoch_value(value)
+        return self._to_sql_value(value)
+    
+    def _param(self, column, value):
+        # Query values are bound as given, except the ones compared to epoch columns
+        if column in self.epoch_columns:
+            return self._epoch_value(value)
+        return value
+    
+    def _document(self, row):
+        # Row to dict, epoch columns back to datetimes
+        document = dict(row)
+        for column in self.epoch_columns:
+            value = document.get(column)
+            if isinstance(value, int):
+                document[column] = datetime.fromtimestamp(value)
+        return document
     
     def _build_set_clause(self, update):
         # Build SET clause from MongoDB-style update
         if not update:
             return "", []
         
-        clauses = []
-        params = []
-        
-        for key, value in update.items():
-            clauses.append(f"{key} = ?")
-            
-            # Convert complex types to SQLite-compatible types
-            if isinstance(value, list):
-                # Convert lists to JSON strings
-                params.append(json.dumps(value))
-            elif isinstance(value, dict):
-                # Convert dictionaries to JSON strings
-                params.append(json.dumps(value))
-            elif value is None:
-                # Keep None as is
-                params.append(value)
-            elif isinstance(value, (int, float, str, bool)):
-                # Basic types are fine
-                params.append(value)
-            else:
-                # Convert anything else to string
-                params.append(str(value))
+        clauses = [f"{key} = ?" for key in update]
+        params = [self._column_value(key, value) for key, value in update.items()]
         
         return ', '.join(clauses), params
     
@@ -683,13 +775,168 @@ class CollectionWrapper:
         if not unset:
             return "", []
         
-        clauses = []
-        params = []
+        clauses = [f"{key} = NULL" for key in unset]
         
-        for key in unset:
-            clauses.append(f"{key} = NULL")
+        return ', '.join(clauses), []
+
+class AsyncCollectionWrapper:
+    """
+    نسخة غير متزامنة من CollectionWrapper
+
+    تنفذ الاستعلامات على خيوط قاعدة البيانات (Database.executor) حتى لا تحجب
+    حلقة أحداث البوت أثناء القراءة أو الكتابة على القرص.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+        self.db = collection.db
+    
+    async def find_one(self, query):
+        return await self.db.run_async(self.collection.find_one, query)
+    
+    async def find(self, query=None, **options):
+        # The cursor reads through the connection of the thread iterating it, so drain it there
+        return await self.db.run_async(lambda: list(self.collection.find(query, **options)))
+    
+    async def insert_one(self, document):
+        return await self.db.run_async(self.collection.insert_one, document)
+    
+    async def insert_many(self, documents):
+        return await self.db.run_async(self.collection.insert_many, documents)
+    
+    async def update_one(self, query, update, upsert=False):
+        return await self.db.run_async(self.collection.update_one, query, update, upsert)
+    
+    async def update_many(self, query, update, upsert=False):
+        return await self.db.run_async(self.collection.update_many, query, update, upsert)
+    
+    async def delete_one(self, query):
+        return await self.db.run_async(self.collection.delete_one, query)
+    
+    async def delete_many(self, query):
+        return await self.db.run_async(self.collection.delete_many, query)
+    
+    async def count_documents(self, query=None):
+        return await self.db.run_async(self.collection.count_documents, query)
+    
+    async def aggregate(self, fields, query=None, group_by=None):
+        return await self.db.run_async(self.collection.aggregate, fields, query, group_by)
+    
+    async def bulk_write(self, operations):
+        return await self.db.run_async(self.collection.bulk_write, operations)
+
+class Cursor:
+    """
+    Lazy result of CollectionWrapper.find
+    
+    Documents are read batch_size rows at a time. Unsorted scans page on rowid, so
+    no read stays open while the caller works through a batch; sorted scans step a
+    single statement with fetchmany.
+    """
+    def __init__(self, collection, query=None, projection=None, sort=None, limit=0, skip=0,
+                 after=None, batch_size=DB_FIND_BATCH_SIZE):
+        self.collection = collection
+        self.query = query or {}
+        self.columns = self._columns(projection)
+        self.sort = self._sort_keys(sort)
+        self.limit = limit
+        self.skip = skip
+        self.after = after
+        self.batch_size = batch_size
+    
+    @staticmethod
+    def _columns(projection):
+        if projection is None:
+            return None
+        if isinstance(projection, dict):
+            return tuple(field for field, include in projection.items() if include)
+        return tuple(projection)
+    
+    @staticmethod
+    def _sort_keys(sort):
+        if sort is None:
+            return ()
+        if isinstance(sort, str):
+            return ((sort, 1),)
+        return tuple((field, direction) for field, direction in sort)
+    
+    def __iter__(self):
+        started = False
+        try:
+            for document in (self._scan() if self.sort else self._pages()):
+                started = True
+                yield document
+        except sqlite3.Error as e:
+            print(f"Error in find for {self.collection.table_name}: {str(e)}")
+            print(f"Query: {self.query}")
+            # A failed first read looks like no results, as find always did. Once rows
+            # have been handed out, stopping quietly would pass for a complete result
+            if started:
+                raise
+    
+    def _select_list(self):
+        return ', '.join(self.columns) if self.columns else '*'
+    
+    def _pages(self):
+        collection = self.collection
+        shape, where_clause, params = collection._where(self.query)
+        sql = collection._compile('find_page', (shape, self.columns), lambda: (
+            f"SELECT rowid AS _rowid, {self._select_list()} FROM {collection.table_name} "
+            f"WHERE ({where_clause}) AND rowid > ? ORDER BY rowid LIMIT ? OFFSET ?"
+        ))
+        
+        last = self.after if self.after is not None else float('-inf')
+        remaining = self.limit or None
+        offset = self.skip
+        while True:
+            size = self.batch_size if remaining is None else min(self.batch_size, remaining)
+            cursor = collection.db.cursor
+            cursor.execute(sql, params + [last, size, offset])
+            rows = cursor.fetchall()
+            
+            for row in rows:
+                document = collection._document(row)
+                last = document.pop('_rowid')
+                yield document
+            
+            if len(rows) < size:
+                return
+            if remaining is not None:
+                remaining -= len(rows)
+                if remaining <= 0:
+                    return
+            offset = 0
+    
+    def _scan(self):
+        collection = self.collection
+        shape, where_clause, params = collection._where(self.query)
+        keyset = self.after is not None
+        
+        def build():
+            sql = f"SELECT {self._select_list()} FROM {collection.table_name} WHERE ({where_clause})"
+            if keyset:
+                field, direction = self.sort[0]
+                sql += f" AND {field} {'>' if direction >= 0 else '<'} ?"
+            order_by = ', '.join(
+                f"{field} {'ASC' if direction >= 0 else 'DESC'}" for field, direction in self.sort
+            )
+            return f"{sql} ORDER BY {order_by} LIMIT ? OFFSET ?"
         
-        return ', '.join(clauses), params
+        sql = collection._compile('find_sorted', (shape, self.columns, self.sort, keyset), build)
+        if keyset:
+            params = params + [collection._column_value(self.sort[0][0], self.after)]
+        
+        # Own cursor, the statement stays open across batches
+        cursor = collection.db.conn.cursor()
+        try:
+            cursor.execute(sql, params + [self.limit or -1, self.skip])
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield collection._document(row)
+        finally:
+            cursor.close()
 
 class InsertOneResult:
     def __init__(self, inserted_id):
@@ -703,3 +950,45 @@ class UpdateResult:
 class DeleteResult:
     def __init__(self, deleted_count):
         self.deleted_count = deleted_count
+
+class InsertManyResult:
+    def __init__(self, inserted_count):
+        self.inserted_count = inserted_count
+
+class BulkWriteResult:
+    def __init__(self, inserted_count, modified_count, deleted_count):
+        self.inserted_count = inserted_count
+        self.modified_count = modified_count
+        self.deleted_count = deleted_count
+
+# Operations for CollectionWrapper.bulk_write, named like their MongoDB counterparts
+class InsertOne:
+    def __init__(self, document):
+        self.document = document
+
+class UpdateOne:
+    def __init__(self, query, update, upsert=False):
+        self.query = query
+        self.update = update
+        self.upsert = upsert
+
+class UpdateMany(UpdateOne):
+    pass
+
+class DeleteOne:
+    def __init__(self, query):
+        self.query = query
+
+class DeleteMany(DeleteOne):
+    pass
+
+# Fields for CollectionWrapper.aggregate, filter is a query the counted rows must match
+class Count:
+    def __init__(self, filter=None):
+        self.field = None
+        self.filter = filter
+
+class Sum:
+    def __init__(self, field, filter=None):
+        self.field = field
+        self.filter = filter
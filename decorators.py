@@ -23,11 +23,8 @@ def admin_required(func):
     async def wrapped(self, update: Update, context: CallbackContext, *args, **kwargs):
         user_id = update.effective_user.id
 
-        # Get user from subscription service
-        user = self.subscription_service.get_user(user_id)
-
         # Check if user is admin
-        if user and user.is_admin:
+        if self.subscription_service.is_admin(user_id):
             return await func(self, update, context, *args, **kwargs)
         else:
             await update.effective_chat.send_message(
@@ -46,26 +43,28 @@ def subscription_required(func):
     async def wrapped(self, update: Update, context: CallbackContext, *args, **kwargs):
         user_id = update.effective_user.id
 
-        # Get user from subscription service
-        user = self.subscription_service.get_user(user_id)
+        # Admins and active subscribers are known without reading the database
+        is_admin = self.subscription_service.is_admin(user_id)
+        has_subscription = self.subscription_service.is_subscriber(user_id)
 
         # If user doesn't exist, create a new user with default username
-        if not user:
+        if not has_subscription and not await self.subscription_service.get_user_async(user_id):
             username = update.effective_user.username
             first_name = update.effective_user.first_name
             last_name = update.effective_user.last_name
-            user = self.subscription_service.create_user(user_id, username, first_name, last_name)
+            await self.subscription_service.create_user_async(user_id, username, first_name, last_name)
             logger.info(f"تم إنشاء مستخدم جديد: {user_id}")
+            is_admin = self.subscription_service.is_admin(user_id)
+            has_subscription = self.subscription_service.is_subscriber(user_id)
 
         # Check if user has active subscription or is admin
-        if user and (user.has_active_subscription() or user.is_admin):
-            # Check channel subscription automatically - FIX: Use subscription_manager instead of channel_subscription
-            is_subscribed = await subscription_manager.check_user_subscription(user_id, context.bot)
-            required_channel = subscription_manager.get_required_channel()
-
+        if has_subscription:
             # If user is admin, bypass channel subscription check
-            if user.is_admin:
+            if is_admin:
                 is_subscribed = True
+            else:
+                is_subscribed = await subscription_manager.check_user_subscription(user_id, context.bot)
+            required_channel = subscription_manager.get_required_channel()
 
             if is_subscribed:
                 # User is subscribed to the channel, proceed
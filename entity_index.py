@@ -0,0 +1,225 @@
+import logging
+from datetime import datetime, timedelta
+from telethon.tl.types import (
+    Channel, Chat, User,
+    InputPeerChannel, InputPeerChat, InputPeerUser
+)
+from db import Database, UpdateOne
+from config import (
+    ENTITY_INDEX_TTL_SECONDS, RESOLVE_RETRY_BASE_SECONDS, RESOLVE_RETRY_MAX_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+class GroupUnreachable(Exception):
+    """No resolution form reached the group or it refused the account for good, quarantine it"""
+
+class EntityIndex:
+    """
+    فهرس دائم لكيانات المجموعات لكل حساب مستخدم
+
+    يحفظ لكل (user_id, group_id) معرف النظير و access_hash ونوعه في جدول
+    group_entities، حتى يتم الإرسال مباشرة دون جلب جميع المحادثات في كل دورة.
+    كما يحفظ طريقة الحل التي نجحت آخر مرة، ويعزل المجموعات التي تعذر الوصول
+    إليها مع مهلة إعادة محاولة متزايدة.
+    """
+    def __init__(self, ttl_seconds=ENTITY_INDEX_TTL_SECONDS):
+        self.db = Database()
+        self.entities_collection = self.db.get_collection('group_entities')
+        self.ttl = timedelta(seconds=ttl_seconds)
+
+    def get(self, user_id, group_id):
+        """Get the cached entity row for a group, or None"""
+        return self.entities_collection.find_one({
+            'user_id': user_id,
+            'group_id': str(group_id)
+        })
+
+    def get_all(self, user_id):
+        """Get every cached entity row of an account, keyed by group_id"""
+        return {row['group_id']: row for row in self.entities_collection.find({'user_id': user_id})}
+
+    async def get_all_async(self, user_id):
+        """get_all on the database threads, for callers on the posting loop"""
+        return await self.db.run_async(self.get_all, user_id)
+
+    def is_fresh(self, row):
+        """Check whether a cached row is still within its TTL"""
+        if not row or not row.get('updated_at'):
+            return False
+        try:
+            updated_at = row['updated_at']
+            if isinstance(updated_at, str):
+                updated_at = datetime.fromisoformat(updated_at)
+            return datetime.now() - updated_at < self.ttl
+        except (TypeError, ValueError):
+            return False
+
+    def to_input_peer(self, row):
+        """Build a Telethon input peer from a cached row, or None if it is incomplete"""
+        if not row or row.get('peer_id') is None:
+            return None
+
+        peer_type = row.get('peer_type')
+        peer_id = int(row['peer_id'])
+        if peer_type == 'channel' and row.get('access_hash') is not None:
+            return InputPeerChannel(peer_id, int(row['access_hash']))
+        if peer_type == 'chat':
+            return InputPeerChat(peer_id)
+        if peer_type == 'user' and row.get('access_hash') is not None:
+            return InputPeerUser(peer_id, int(row['access_hash']))
+        return None
+
+    def _entity_fields(self, entity, resolve_method=None):
+        # Row fields of a resolved Telethon entity, None for entities that can't be posted to
+        if isinstance(entity, Channel):
+            peer_type = 'channel'
+        elif isinstance(entity, Chat):
+            peer_type = 'chat'
+        elif isinstance(entity, User):
+            peer_type = 'user'
+        else:
+            return None
+
+        update = {
+            'peer_id': entity.id,
+            'access_hash': getattr(entity, 'access_hash', None),
+            'peer_type': peer_type,
+            'title': getattr(entity, 'title', None),
+            'failure_count': 0,
+            'retry_after': None,
+            'updated_at': datetime.now()
+        }
+        if resolve_method:
+            update['resolve_method'] = resolve_method
+        return update
+
+    def store(self, user_id, group_id, entity, resolve_method=None):
+        """Save the peer of a resolved Telethon entity and the form that resolved it"""
+        update = self._entity_fields(entity, resolve_method)
+        if update is None:
+            return False
+
+        self.entities_collection.update_one(
+            {'user_id': user_id, 'group_id': str(group_id)},
+            {'$set': update},
+            upsert=True
+        )
+        return True
+
+    def store_many(self, user_id, entities, resolve_method=None):
+        """Save many resolved entities (group_id -> entity) in one transaction"""
+        operations = []
+        for group_id, entity in entities.items():
+            update = self._entity_fields(entity, resolve_method)
+            if update is not None:
+                operations.append(UpdateOne(
+                    {'user_id': user_id, 'group_id': str(group_id)},
+                    {'$set': update},
+                    upsert=True
+                ))
+        if operations:
+            self.entities_collection.bulk_write(operations)
+
+    async def store_async(self, user_id, group_id, entity, resolve_method=None):
+        """store on the database threads, for callers on the posting loop"""
+        return await self.db.run_async(self.store, user_id, group_id, entity, resolve_method)
+
+    def is_quarantined(self, row):
+        """Check whether a group is waiting out its retry backoff"""
+        if not row or not row.get('retry_after'):
+            return False
+        try:
+            retry_after = row['retry_after']
+            if isinstance(retry_after, str):
+                retry_after = datetime.fromisoformat(retry_after)
+            return datetime.now() < retry_after
+        except (TypeError, ValueError):
+            return False
+
+    def record_failure(self, user_id, group_id, row=None):
+        """
+        Quarantine a group that couldn't be reached by any resolution form
+
+        Returns:
+            datetime of the next retry
+        """
+        failure_count = int((row or {}).get('failure_count') or 0) + 1
+        backoff = min(
+            RESOLVE_RETRY_BASE_SECONDS * (2 ** (failure_count - 1)),
+            RESOLVE_RETRY_MAX_SECONDS
+        )
+        retry_after = datetime.now() + timedelta(seconds=backoff)
+
+        self.entities_collection.update_one(
+            {'user_id': user_id, 'group_id': str(group_id)},
+            {'$set': {
+                'failure_count': failure_count,
+                'retry_after': retry_after
+            }},
+            upsert=True
+        )
+        return retry_after
+
+    def has_failures(self, row):
+        """Check whether a row still carries a failure count or retry time"""
+        return bool(row and (row.get('failure_count') or row.get('retry_after')))
+
+    def clear_failures(self, user_id, group_id):
+        """Reset the backoff of a group that accepted a message again"""
+        self.entities_collection.update_one(
+            {'user_id': user_id, 'group_id': str(group_id)},
+            {'$set': {'failure_count': 0, 'retry_after': None}}
+        )
+
+    async def clear_failures_async(self, user_id, group_id):
+        """clear_failures on the database threads, for callers on the posting loop"""
+        await self.db.run_async(self.clear_failures, user_id, group_id)
+
+    async def record_failure_async(self, user_id, group_id, row=None):
+        """record_failure on the database threads, for callers on the posting loop"""
+        return await self.db.run_async(self.record_failure, user_id, group_id, row)
+
+    def invalidate(self, user_id, group_id):
+        """Mark a cached entity as stale so the next send resolves it again"""
+        self.entities_collection.update_one(
+            {'user_id': user_id, 'group_id': str(group_id)},
+            {'$set': {'updated_at': None}}
+        )
+
+    async def invalidate_async(self, user_id, group_id):
+        """invalidate on the database threads, for callers on the posting loop"""
+        await self.db.run_async(self.invalidate, user_id, group_id)
+
+    async def refresh_from_dialogs(self, client, user_id, group_ids, groups_by_id=None):
+        """
+        Scan the account dialogs once and index the requested groups
+
+        Only used when a group can't be resolved any other way.
+
+        Returns:
+            dict mapping group_id to entity for the groups that were found
+        """
+        wanted = {str(group_id) for group_id in group_ids}
+        titles = {}
+        for group_id in wanted:
+            group = (groups_by_id or {}).get(group_id)
+            if group and group.get('title'):
+                titles[group['title']] = group_id
+
+        found = {}
+        dialogs = await client.get_dialogs()
+        for dialog in dialogs:
+            dialog_id = str(dialog.id)
+            for key in (dialog_id, dialog_id.replace('-100', ''), dialog_id.lstrip('-')):
+                if key in wanted and key not in found:
+                    found[key] = dialog.entity
+
+            # Fall back to title matching like the original lookup did
+            if dialog.name in titles and titles[dialog.name] not in found:
+                found[titles[dialog.name]] = dialog.entity
+
+        await self.db.run_async(self.store_many, user_id, found, 'dialogs')
+
+        logger.info(f"Indexed {len(found)} of {len(wanted)} groups from dialogs for user {user_id}")
+        return found
@@ -37,7 +37,7 @@ class GroupHandlers:
         user_id = update.effective_user.id
 
         # Get user groups from database
-        groups = self.group_service.get_user_groups(user_id)
+        groups = await self.group_service.get_keyboard_groups_async(user_id)
 
         if not groups:
             # No groups found, offer to fetch them
@@ -178,11 +178,11 @@ class GroupHandlers:
                 return
 
             # Toggle blacklist status
-            success, is_blacklisted = self.group_service.toggle_group_blacklist(user_id, group_id)
+            success, is_blacklisted = await self.group_service.toggle_group_blacklist_async(user_id, group_id)
 
             if success:
                 # Get updated groups
-                groups = self.group_service.get_user_groups(user_id)
+                groups = await self.group_service.get_keyboard_groups_async(user_id)
 
                 # Update keyboard
                 await self.update_groups_keyboard(query, groups)
@@ -193,7 +193,7 @@ class GroupHandlers:
 
         elif data == "group_done":
             # User is done with group selection
-            active_groups = self.group_service.get_user_active_groups(user_id)
+            active_groups = await self.group_service.get_user_active_groups_async(user_id)
 
             await query.edit_message_text(
                 text=f"✅ تم حفظ إعدادات المجموعات بنجاح.\n\n"
@@ -203,11 +203,11 @@ class GroupHandlers:
 
         elif data == "group_select_all":
             # Select all groups (remove from blacklist)
-            success = self.group_service.select_all_groups(user_id)
+            success = await self.group_service.select_all_groups_async(user_id)
 
             if success:
                 # Get updated groups
-                groups = self.group_service.get_user_groups(user_id)
+                groups = await self.group_service.get_keyboard_groups_async(user_id)
 
                 # Update keyboard
                 await self.update_groups_keyboard(query, groups)
@@ -218,11 +218,11 @@ class GroupHandlers:
 
         elif data == "group_deselect_all":
             # Deselect all groups (add to blacklist)
-            success = self.group_service.deselect_all_groups(user_id)
+            success = await self.group_service.deselect_all_groups_async(user_id)
 
             if success:
                 # Get updated groups
-                groups = self.group_service.get_user_groups(user_id)
+                groups = await self.group_service.get_keyboard_groups_async(user_id)
 
                 # Update keyboard
                 await self.update_groups_keyboard(query, groups)
@@ -1,5 +1,6 @@
 import logging
-from db import Database
+from datetime import datetime
+from db import Database, UpdateOne
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -8,11 +9,24 @@ class GroupService:
     def __init__(self):
         self.db = Database()
         self.groups_collection = self.db.get_collection('groups')
+        self.async_groups_collection = self.db.get_async_collection('groups')
 
     def get_user_groups(self, user_id):
         """Get all groups for a user"""
         return list(self.groups_collection.find({'user_id': user_id}))
 
+    async def get_user_groups_async(self, user_id):
+        """Get all groups for a user without blocking the event loop"""
+        return list(await self.async_groups_collection.find({'user_id': user_id}))
+
+    async def get_keyboard_groups_async(self, user_id):
+        """Get only the group fields the groups keyboard shows, sorted by title"""
+        return await self.async_groups_collection.find(
+            {'user_id': user_id},
+            projection=['group_id', 'title', 'blacklisted'],
+            sort='title'
+        )
+
     def get_active_groups(self, user_id):
         """Get active (non-blacklisted) groups for a user"""
         return list(self.groups_collection.find({
@@ -25,6 +39,13 @@ class GroupService:
         """Alias for get_active_groups to maintain compatibility"""
         return self.get_active_groups(user_id)
 
+    async def get_user_active_groups_async(self, user_id):
+        """Get active groups for a user without blocking the event loop"""
+        return list(await self.async_groups_collection.find({
+            'user_id': user_id,
+            'blacklisted': {'$ne': True}
+        }))
+
     def get_blacklisted_groups(self, user_id):
         """Get blacklisted groups for a user"""
         return list(self.groups_collection.find({
@@ -50,6 +71,29 @@ class GroupService:
             logger.error(f"Error adding group: {str(e)}")
             return False
 
+    def add_groups(self, user_id, groups):
+        """
+        Add or update many groups in one transaction
+
+        Args:
+            user_id: The user ID
+            groups: List of dicts with 'id' and 'title'
+        """
+        try:
+            now = datetime.now()
+            self.groups_collection.bulk_write([
+                UpdateOne(
+                    {'user_id': user_id, 'group_id': str(group['id'])},
+                    {'$set': {'title': group['title'], 'updated_at': now}},
+                    upsert=True
+                )
+                for group in groups
+            ])
+            return True
+        except Exception as e:
+            logger.error(f"Error adding groups: {str(e)}")
+            return False
+
     def blacklist_group(self, user_id, group_id):
         """Add a group to blacklist"""
         try:
@@ -117,36 +161,42 @@ class GroupService:
             logger.error(f"Error toggling group blacklist: {str(e)}")
             return False, False
 
+    async def toggle_group_blacklist_async(self, user_id, group_id):
+        """toggle_group_blacklist for handlers, writes on the database threads"""
+        return await self.db.run_async(self.toggle_group_blacklist, user_id, group_id)
+
     def select_all_groups(self, user_id):
         """Select all groups (remove from blacklist)"""
         try:
-            # Fix: Since CollectionWrapper doesn't have update_many, we need to update each group individually
-            groups = self.groups_collection.find({'user_id': user_id})
-            for group in groups:
-                self.groups_collection.update_one(
-                    {'_id': group['_id']},  # تصحيح: استخدام _id بدلاً من id
-                    {'$set': {'blacklisted': False}}
-                )
+            self.groups_collection.update_many(
+                {'user_id': user_id},
+                {'$set': {'blacklisted': False}}
+            )
             return True
         except Exception as e:
             logger.error(f"Error in select_all_groups: {str(e)}")
             return False
 
+    async def select_all_groups_async(self, user_id):
+        """select_all_groups for handlers, writes on the database threads"""
+        return await self.db.run_async(self.select_all_groups, user_id)
+
     def deselect_all_groups(self, user_id):
         """Deselect all groups (add to blacklist)"""
         try:
-            # Fix: Since CollectionWrapper doesn't have update_many, we need to update each group individually
-            groups = self.groups_collection.find({'user_id': user_id})
-            for group in groups:
-                self.groups_collection.update_one(
-                    {'_id': group['_id']},  # تصحيح: استخدام _id بدلاً من id
-                    {'$set': {'blacklisted': True}}
-                )
+            self.groups_collection.update_many(
+                {'user_id': user_id},
+                {'$set': {'blacklisted': True}}
+            )
             return True
         except Exception as e:
             logger.error(f"Error in deselect_all_groups: {str(e)}")
             return False
 
+    async def deselect_all_groups_async(self, user_id):
+        """deselect_all_groups for handlers, writes on the database threads"""
+        return await self.db.run_async(self.deselect_all_groups, user_id)
+
     def delete_group(self, user_id, group_id):
         """Delete a group"""
         try:
@@ -159,6 +209,67 @@ class GroupService:
             logger.error(f"Error deleting group: {str(e)}")
             return False
 
+    def _find_session(self, user_id):
+        """
+        Look up the session string and API credentials of a user
+
+        Returns:
+            Tuple of (session_string, api_id, api_hash), None for anything not found
+        """
+        # تحسين: استخدام AuthService مباشرة للحصول على جلسة المستخدم
+        try:
+            from auth_service import AuthService
+            auth_service = AuthService()
+            session_string = auth_service.get_user_session(user_id)
+            
+            # الحصول على بيانات API من قاعدة البيانات
+            users_collection = self.db.get_collection('users')
+            user = users_collection.find_one({'user_id': user_id})
+            
+            if user:
+                api_id = user.get('api_id')
+                api_hash = user.get('api_hash')
+            else:
+                api_id = None
+                api_hash = None
+            
+            # إذا لم يتم العثور على بيانات API في جدول المستخدمين، حاول الحصول عليها من جدول الجلسات
+            if not api_id or not api_hash:
+                sessions_collection = self.db.get_collection('sessions')
+                session = sessions_collection.find_one({'user_id': user_id})
+                if session:
+                    api_id = api_id or session.get('api_id')
+                    api_hash = api_hash or session.get('api_hash')
+        except ImportError:
+            # إذا لم يكن AuthService متاحاً، استخدم الطريقة القديمة
+            from db import Database
+            db = Database()
+            
+            # الحصول على جلسة المستخدم من قاعدة البيانات
+            sessions_collection = db.get_collection('sessions')
+            users_collection = db.get_collection('users')
+            
+            # البحث عن الجلسة في جدول الجلسات أولاً
+            session = sessions_collection.find_one({'user_id': user_id})
+            
+            # إذا لم يتم العثور على الجلسة، ابحث في جدول المستخدمين
+            if not session or not session.get('session_string'):
+                user = users_collection.find_one({'user_id': user_id})
+                if user and user.get('session_string'):
+                    session_string = user.get('session_string')
+                    api_id = user.get('api_id')
+                    api_hash = user.get('api_hash')
+                else:
+                    session_string = None
+                    api_id = None
+                    api_hash = None
+            else:
+                session_string = session.get('session_string')
+                api_id = session.get('api_id')
+                api_hash = session.get('api_hash')
+
+        return session_string, api_id, api_hash
+
     async def fetch_user_groups(self, user_id):
         """
         Fetch user groups from Telegram API
@@ -173,57 +284,8 @@ class GroupService:
             - groups: List of groups if successful, None otherwise
         """
         try:
-            # تحسين: استخدام AuthService مباشرة للحصول على جلسة المستخدم
-            try:
-                from auth_service import AuthService
-                auth_service = AuthService()
-                session_string = auth_service.get_user_session(user_id)
-                
-                # الحصول على بيانات API من قاعدة البيانات
-                users_collection = self.db.get_collection('users')
-                user = users_collection.find_one({'user_id': user_id})
-                
-                if user:
-                    api_id = user.get('api_id')
-                    api_hash = user.get('api_hash')
-                else:
-                    api_id = None
-                    api_hash = None
-                
-                # إذا لم يتم العثور على بيانات API في جدول المستخدمين، حاول الحصول عليها من جدول الجلسات
-                if not api_id or not api_hash:
-                    sessions_collection = self.db.get_collection('sessions')
-                    session = sessions_collection.find_one({'user_id': user_id})
-                    if session:
-                        api_id = api_id or session.get('api_id')
-                        api_hash = api_hash or session.get('api_hash')
-            except ImportError:
-                # إذا لم يكن AuthService متاحاً، استخدم الطريقة القديمة
-                from db import Database
-                db = Database()
-                
-                # الحصول على جلسة المستخدم من قاعدة البيانات
-                sessions_collection = db.get_collection('sessions')
-                users_collection = db.get_collection('users')
-                
-                # البحث عن الجلسة في جدول الجلسات أولاً
-                session = sessions_collection.find_one({'user_id': user_id})
-                
-                # إذا لم يتم العثور على الجلسة، ابحث في جدول المستخدمين
-                if not session or not session.get('session_string'):
-                    user = users_collection.find_one({'user_id': user_id})
-                    if user and user.get('session_string'):
-                        session_string = user.get('session_string')
-                        api_id = user.get('api_id')
-                        api_hash = user.get('api_hash')
-                    else:
-                        session_string = None
-                        api_id = None
-                        api_hash = None
-                else:
-                    session_string = session.get('session_string')
-                    api_id = session.get('api_id')
-                    api_hash = session.get('api_hash')
+            # قراءة الجلسة من قاعدة البيانات على خيوط قاعدة البيانات
+            session_string, api_id, api_hash = await self.db.run_async(self._find_session, user_id)
 
             # تحسين: إذا لم يتم العثور على جلسة، حاول استخدام جلسة البوت نفسه
             if not session_string:
@@ -233,7 +295,7 @@ class GroupService:
                 # تحقق مما إذا كان المستخدم مشرفاً
                 from subscription_service import SubscriptionService
                 subscription_service = SubscriptionService()
-                db_user = subscription_service.get_user(user_id)
+                db_user = await subscription_service.get_user_async(user_id)
                 is_admin = db_user and db_user.is_admin
                 
                 if is_admin:
@@ -281,20 +343,41 @@ class GroupService:
             if not api_id or not api_hash:
                 return False, "بيانات الجلسة غير مكتملة. يرجى تسجيل الدخول مرة أخرى.", None
 
-            # استيراد مكتبة Telegram
-            from telethon.sync import TelegramClient
-            from telethon.sessions import StringSession
-            from telethon.tl.types import Channel, Chat
+            # جلب المجموعات عبر العميل المشترك على حلقة الأحداث المشتركة
+            from background_loop import BackgroundLoop
+            groups = await BackgroundLoop().run_async(
+                self._fetch_dialog_groups(user_id, session_string, api_id, api_hash)
+            )
 
-            # إنشاء العميل
-            client = TelegramClient(StringSession(session_string), api_id, api_hash)
+            if groups is None:
+                return False, "انتهت صلاحية الجلسة. يرجى تسجيل الدخول مرة أخرى.", None
 
-            # الاتصال بـ Telegram
-            await client.connect()
+            # حفظ في قاعدة البيانات دفعة واحدة
+            await self.db.run_async(self.add_groups, user_id, groups)
 
-            if not await client.is_user_authorized():
-                await client.disconnect()
-                return False, "انتهت صلاحية الجلسة. يرجى تسجيل الدخول مرة أخرى.", None
+            if groups:
+                return True, f"تم جلب {len(groups)} مجموعة بنجاح", groups
+            else:
+                return False, "لم يتم العثور على مجموعات", []
+
+        except Exception as e:
+            logger.error(f"خطأ أثناء جلب مجموعات المستخدم: {str(e)}")
+            return False, f"حدث خطأ أثناء جلب المجموعات: {str(e)}", None
+
+    async def _fetch_dialog_groups(self, user_id, session_string, api_id, api_hash):
+        """
+        Read the user's groups using the pooled client
+        Must run on the shared posting loop
+
+        Returns:
+            List of group dicts, or None if the session is not authorized
+        """
+        from telethon.tl.types import Channel, Chat
+        from client_pool import ClientPool
+
+        async with ClientPool().client(user_id, session_string, api_id, api_hash) as client:
+            if client is None:
+                return None
 
             # الحصول على المحادثات (الدردشات والمجموعات)
             dialogs = await client.get_dialogs()
@@ -315,28 +398,10 @@ class GroupService:
                 )
 
                 if is_group:
-                    group_data = {
+                    groups.append({
                         'id': str(dialog.id),  # تحويل إلى نص للاتساق
                         'title': dialog.title,
                         'left': False
-                    }
-                    groups.append(group_data)
+                    })
 
-                    # حفظ في قاعدة البيانات
-                    self.add_group(
-                        user_id=user_id,
-                        group_id=group_data['id'],
-                        title=group_data['title']
-                    )
-
-            # قطع الاتصال
-            await client.disconnect()
-
-            if groups:
-                return True, f"تم جلب {len(groups)} مجموعة بنجاح", groups
-            else:
-                return False, "لم يتم العثور على مجموعات", []
-
-        except Exception as e:
-            logger.error(f"خطأ أثناء جلب مجموعات المستخدم: {str(e)}")
-            return False, f"حدث خطأ أثناء جلب المجموعات: {str(e)}", None
+            return groups
@@ -0,0 +1,457 @@
+"""
+Versioned schema migrations for Database
+
+Each function in MIGRATIONS upgrades the schema by one version. run_migrations
+applies the ones above PRAGMA user_version in order, each in its own transaction
+together with the new user_version, so every migration runs exactly once and a
+failed one leaves the database at the previous version.
+
+Add new schema changes as a new function at the end of MIGRATIONS, never edit
+one that has already shipped.
+"""
+import re
+
+def _columns(cursor, table_name):
+    # Column name -> declared type
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return {row['name']: row['type'] for row in cursor.fetchall()}
+
+def _add_columns(cursor, table_name, columns):
+    existing = _columns(cursor, table_name)
+    for column, definition in columns:
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {definition}")
+            print(f"Added {column} column to {table_name} table")
+
+def create_tables(cursor):
+    """Tables and fixes that the startup used to check on every boot"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        is_admin INTEGER DEFAULT 0,
+        referral_code TEXT,
+        referred_by INTEGER,
+        subscription_end INTEGER,
+        api_id INTEGER,
+        api_hash TEXT,
+        phone_number TEXT,
+        phone_code_hash TEXT,
+        code_request_time TEXT,
+        code_resend_attempts INTEGER DEFAULT 0,
+        code_input_attempts INTEGER DEFAULT 0,
+        session_string TEXT,
+        telegram_user_id INTEGER,
+        telegram_username TEXT,
+        telegram_first_name TEXT,
+        telegram_last_name TEXT,
+        auto_response_active INTEGER DEFAULT 0,
+        created_at INTEGER,
+        updated_at INTEGER,
+        FOREIGN KEY (referred_by) REFERENCES users (user_id) ON DELETE SET NULL
+    )
+    ''')
+
+    # Columns added to users after its first release
+    _add_columns(cursor, 'users', (
+        ('phone_code_hash', 'TEXT'),
+        ('code_request_time', 'TEXT'),
+        ('code_resend_attempts', 'INTEGER DEFAULT 0'),
+        ('code_input_attempts', 'INTEGER DEFAULT 0'),
+        ('auto_response_active', 'INTEGER DEFAULT 0'),
+    ))
+
+    # Auto-responses
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS responses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        response_type TEXT,
+        response_text TEXT,
+        is_active INTEGER DEFAULT 1,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        days INTEGER,
+        added_by INTEGER,
+        created_at INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+        FOREIGN KEY (added_by) REFERENCES users (user_id) ON DELETE SET NULL
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        api_id INTEGER,
+        api_hash TEXT,
+        phone TEXT,
+        phone_code_hash TEXT,
+        session_string TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS groups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        group_id TEXT,
+        title TEXT,
+        blacklisted INTEGER DEFAULT 0,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )
+    ''')
+
+    # تصحيح: تغيير نوع عمود group_id من INTEGER إلى TEXT للتوافق مع الكود
+    if _columns(cursor, 'groups').get('group_id', 'TEXT').upper() != 'TEXT':
+        cursor.execute("ALTER TABLE groups RENAME TO groups_old")
+        cursor.execute('''
+        CREATE TABLE groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            group_id TEXT,
+            title TEXT,
+            blacklisted INTEGER DEFAULT 0,
+            created_at TEXT,
+            updated_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        )
+        ''')
+        cursor.execute('''
+        INSERT INTO groups (id, user_id, group_id, title, blacklisted, created_at, updated_at)
+        SELECT id, user_id, group_id, title, blacklisted, created_at, updated_at FROM groups_old
+        ''')
+        cursor.execute("DROP TABLE groups_old")
+        print("Fixed group_id column type in groups table")
+
+    # Cached Telegram peer for each user group
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS group_entities (
+        user_id INTEGER,
+        group_id TEXT,
+        peer_id INTEGER,
+        access_hash INTEGER,
+        peer_type TEXT,
+        title TEXT,
+        resolve_method TEXT,
+        failure_count INTEGER DEFAULT 0,
+        retry_after TEXT,
+        updated_at TEXT,
+        PRIMARY KEY (user_id, group_id),
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )
+    ''')
+
+    # Resolution strategy columns
+    _add_columns(cursor, 'group_entities', (
+        ('resolve_method', 'TEXT'),
+        ('failure_count', 'INTEGER DEFAULT 0'),
+        ('retry_after', 'TEXT'),
+    ))
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message TEXT,
+        group_ids TEXT,
+        delay_seconds INTEGER DEFAULT 0,
+        exact_time TEXT,
+        total_groups INTEGER DEFAULT 0,
+        progress INTEGER DEFAULT 0,
+        successful_posts INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'pending',
+        error TEXT,
+        start_time TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        completed_at TEXT,
+        timing_type TEXT DEFAULT 'delay',
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )
+    ''')
+
+    # تصحيح: نقل البيانات من جدول posts القديم (المفتاح _id) إلى الشكل الجديد
+    if '_id' in _columns(cursor, 'posts'):
+        print("Migrating data from old posts table to new format")
+        cursor.execute('''
+        CREATE TABLE posts_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message TEXT,
+            group_ids TEXT,
+            delay_seconds INTEGER DEFAULT 0,
+            exact_time TEXT,
+            total_groups INTEGER DEFAULT 0,
+            progress INTEGER DEFAULT 0,
+            successful_posts INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            start_time TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            completed_at TEXT,
+            timing_type TEXT DEFAULT 'delay',
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        )
+        ''')
+
+        # نقل البيانات مع تحويل أنواع البيانات
+        cursor.execute('''
+        INSERT INTO posts_new (
+            id, user_id, message, group_ids, delay_seconds, exact_time,
+            total_groups, progress, successful_posts, status, error,
+            start_time, created_at, updated_at, completed_at, timing_type
+        )
+        SELECT
+            _id,
+            CAST(user_id AS INTEGER),
+            message,
+            group_ids,
+            CAST(COALESCE(delay_seconds, 0) AS INTEGER),
+            exact_time,
+            CAST(COALESCE(total, 0) AS INTEGER),
+            CAST(COALESCE(progress, 0) AS INTEGER),
+            CAST(COALESCE(successful_posts, 0) AS INTEGER),
+            status,
+            error,
+            start_time,
+            created_at,
+            updated_at,
+            completed_at,
+            COALESCE(timing_type, 'delay')
+        FROM posts
+        ''')
+        cursor.execute("DROP TABLE posts")
+        cursor.execute("ALTER TABLE posts_new RENAME TO posts")
+        print("Successfully migrated posts table data")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        post_id INTEGER,
+        group_id TEXT,
+        message_id INTEGER,
+        timestamp INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+        FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS active_tasks (
+        task_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        post_id INTEGER,
+        message TEXT,
+        group_ids TEXT,
+        delay_seconds INTEGER DEFAULT 0,
+        exact_time TEXT,
+        status TEXT DEFAULT 'pending',
+        start_time INTEGER,
+        last_activity INTEGER,
+        message_count INTEGER DEFAULT 0,
+        message_id INTEGER,
+        is_recurring INTEGER DEFAULT 1,
+        next_run_at REAL,
+        last_run_at REAL,
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+        FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE
+    )
+    ''')
+
+    # Schedule columns of the posting scheduler
+    _add_columns(cursor, 'active_tasks', (
+        ('next_run_at', 'REAL'),
+        ('last_run_at', 'REAL'),
+    ))
+
+    # Message counters of the posting tasks, written by the write buffer
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS status_updates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id TEXT,
+        user_id INTEGER,
+        message_count INTEGER,
+        timestamp TEXT
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scheduled_posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message TEXT,
+        interval INTEGER,
+        is_active INTEGER DEFAULT 1,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )
+    ''')
+
+    # Many-to-many relationship of scheduled posts and groups
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS post_groups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id INTEGER,
+        group_id INTEGER,
+        FOREIGN KEY (post_id) REFERENCES scheduled_posts (id) ON DELETE CASCADE,
+        FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS referrals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referrer_id INTEGER,
+        referred_id INTEGER,
+        is_subscribed INTEGER DEFAULT 0,
+        reward_given INTEGER DEFAULT 0,
+        created_at INTEGER,
+        updated_at INTEGER,
+        FOREIGN KEY (referrer_id) REFERENCES users (user_id) ON DELETE CASCADE,
+        FOREIGN KEY (referred_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS settings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        type TEXT UNIQUE,
+        value TEXT,
+        created_at TEXT,
+        updated_at TEXT
+    )
+    ''')
+
+def convert_timestamps_to_epoch(cursor):
+    """Rebuild tables created with TEXT timestamps, SQLite can't change the type of a column"""
+    epoch_columns = {
+        'users': ('subscription_end', 'created_at', 'updated_at'),
+        'subscriptions': ('created_at',),
+        'referrals': ('created_at', 'updated_at'),
+        'messages': ('timestamp',),
+        'active_tasks': ('start_time', 'last_activity'),
+    }
+    for table_name, columns in epoch_columns.items():
+        table_columns = _columns(cursor, table_name)
+        text_columns = [
+            name for name, column_type in table_columns.items()
+            if name in columns and column_type.upper() != 'INTEGER'
+        ]
+        if not text_columns:
+            continue
+
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        create_sql = cursor.fetchone()['sql'].replace(table_name, f"{table_name}_epoch", 1)
+        for column in text_columns:
+            create_sql = re.sub(rf"\b{column}\s+\w+", f"{column} INTEGER", create_sql, count=1)
+
+        # ISO strings are local time like datetime.now(), 'utc' converts them to epoch seconds
+        select_list = ', '.join(
+            f"CASE WHEN typeof({name}) = 'text' THEN CAST(strftime('%s', {name}, 'utc') AS INTEGER) ELSE {name} END"
+            if name in text_columns else name
+            for name in table_columns
+        )
+        cursor.execute(create_sql)
+        cursor.execute(
+            f"INSERT INTO {table_name}_epoch ({', '.join(table_columns)}) SELECT {select_list} FROM {table_name}"
+        )
+        cursor.execute(f"DROP TABLE {table_name}")
+        cursor.execute(f"ALTER TABLE {table_name}_epoch RENAME TO {table_name}")
+        print(f"Converted {', '.join(text_columns)} columns of {table_name} table to epoch integers")
+
+def create_indexes(cursor):
+    """Secondary indexes for the query patterns of the services, and unique keys for upserts"""
+    indexes = (
+        ('idx_users_referral_code', 'users', 'referral_code'),
+        ('idx_users_subscription_end', 'users', 'subscription_end'),
+        ('idx_referrals_referrer_referred', 'referrals', 'referrer_id, referred_id'),
+        ('idx_messages_user', 'messages', 'user_id'),
+        ('idx_messages_post', 'messages', 'post_id'),
+        ('idx_subscriptions_user', 'subscriptions', 'user_id'),
+        ('idx_sessions_user', 'sessions', 'user_id'),
+    )
+    for index_name, table_name, columns in indexes:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+
+    # Superseded by the unique indexes below
+    cursor.execute("DROP INDEX IF EXISTS idx_groups_user_group")
+    cursor.execute("DROP INDEX IF EXISTS idx_responses_user_type")
+
+    # Keys of Database.UNIQUE_KEYS on tables created without a constraint
+    unique_indexes = (
+        ('uq_groups_user_group', 'groups', 'user_id, group_id'),
+        ('uq_responses_user_type', 'responses', 'user_id, response_type'),
+    )
+    for index_name, table_name, columns in unique_indexes:
+        # Keep only the newest row of each key before enforcing uniqueness
+        cursor.execute(f'''
+            DELETE FROM {table_name} WHERE id NOT IN (
+                SELECT MAX(id) FROM {table_name} GROUP BY {columns}
+            )
+        ''')
+        if cursor.rowcount > 0:
+            print(f"Removed {cursor.rowcount} duplicate rows from {table_name} table")
+
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+
+def add_group_details(cursor):
+    """Columns GroupService.add_group writes but the groups table never had"""
+    _add_columns(cursor, 'groups', (
+        ('username', 'TEXT'),
+        ('description', 'TEXT'),
+        ('member_count', 'INTEGER DEFAULT 0'),
+    ))
+
+def index_active_tasks_status(cursor):
+    """Tasks are restored by status on every start, without an index that scans the table"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_active_tasks_status ON active_tasks (status)")
+
+# Schema version N is reached by applying MIGRATIONS[N - 1]
+MIGRATIONS = (
+    create_tables,
+    convert_timestamps_to_epoch,
+    create_indexes,
+    add_group_details,
+    index_active_tasks_status,
+)
+
+def run_migrations(db):
+    """Apply the migrations above the database's user_version, returns the new version"""
+    conn = db.conn
+    cursor = db.cursor
+    with db.write_lock:
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            print(f"Applied database migration {number}: {migration.__name__}")
+            version = number
+
+    return version
@@ -1,6 +1,24 @@
 from datetime import datetime, timedelta
 import uuid
 
+def to_datetime(value):
+    """Datetime of a stored timestamp: datetime, epoch seconds or ISO string"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return datetime.fromisoformat(value)
+
+def epoch_seconds(value):
+    """Integer epoch seconds of a datetime or ISO string, for raw SQL on epoch columns"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return value
+
 class User:
     def __init__(self, user_id, username=None, first_name=None, last_name=None):
         self.user_id = user_id
@@ -35,25 +53,10 @@ class User:
         user.referral_code = data.get('referral_code')
         user.referred_by = data.get('referred_by')
         
-        # Convert subscription_end from string to datetime if it exists
-        if data.get('subscription_end'):
-            if isinstance(data['subscription_end'], str):
-                user.subscription_end = datetime.fromisoformat(data['subscription_end'])
-            else:
-                user.subscription_end = data['subscription_end']
-        
-        # Convert created_at and updated_at from string to datetime if they exist
-        if data.get('created_at'):
-            if isinstance(data['created_at'], str):
-                user.created_at = datetime.fromisoformat(data['created_at'])
-            else:
-                user.created_at = data['created_at']
-        
-        if data.get('updated_at'):
-            if isinstance(data['updated_at'], str):
-                user.updated_at = datetime.fromisoformat(data['updated_at'])
-            else:
-                user.updated_at = data['updated_at']
+        # The database returns datetimes already, to_datetime only converts older values
+        user.subscription_end = to_datetime(data.get('subscription_end'))
+        user.created_at = to_datetime(data.get('created_at')) or user.created_at
+        user.updated_at = to_datetime(data.get('updated_at')) or user.updated_at
         
         return user
     
@@ -66,9 +69,9 @@ class User:
             'is_admin': 1 if self.is_admin else 0,
             'referral_code': self.referral_code,
             'referred_by': self.referred_by,
-            'subscription_end': self.subscription_end.isoformat() if self.subscription_end else None,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'subscription_end': self.subscription_end,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class Subscription:
@@ -82,12 +85,7 @@ class Subscription:
     def from_dict(cls, data):
         subscription = cls(data['user_id'], data['days'], data.get('added_by'))
         
-        # Convert created_at from string to datetime if it exists
-        if data.get('created_at'):
-            if isinstance(data['created_at'], str):
-                subscription.created_at = datetime.fromisoformat(data['created_at'])
-            else:
-                subscription.created_at = data['created_at']
+        subscription.created_at = to_datetime(data.get('created_at')) or subscription.created_at
         
         return subscription
     
@@ -96,7 +94,7 @@ class Subscription:
             'user_id': self.user_id,
             'days': self.days,
             'added_by': self.added_by,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
 class Referral:
@@ -114,18 +112,8 @@ class Referral:
         referral.is_subscribed = bool(data.get('is_subscribed', False))
         referral.reward_given = bool(data.get('reward_given', False))
         
-        # Convert created_at and updated_at from string to datetime if they exist
-        if data.get('created_at'):
-            if isinstance(data['created_at'], str):
-                referral.created_at = datetime.fromisoformat(data['created_at'])
-            else:
-                referral.created_at = data['created_at']
-        
-        if data.get('updated_at'):
-            if isinstance(data['updated_at'], str):
-                referral.updated_at = datetime.fromisoformat(data['updated_at'])
-            else:
-                referral.updated_at = data['updated_at']
+        referral.created_at = to_datetime(data.get('created_at')) or referral.created_at
+        referral.updated_at = to_datetime(data.get('updated_at')) or referral.updated_at
         
         return referral
     
@@ -135,8 +123,8 @@ class Referral:
             'referred_id': self.referred_id,
             'is_subscribed': 1 if self.is_subscribed else 0,
             'reward_given': 1 if self.reward_given else 0,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class Session:
@@ -38,9 +38,8 @@ class MonitoringHandlers:
             header += f"👤 Username: @{username}\n"
             
             # Get subscription status
-            db_user = self.subscription_service.get_user(user_id)
-            is_subscribed = db_user and db_user.has_active_subscription() if db_user else False
-            is_admin = db_user and db_user.is_admin if db_user else False
+            is_subscribed = self.subscription_service.is_subscriber(user_id)
+            is_admin = self.subscription_service.is_admin(user_id)
             
             # Add subscription status to header
             if is_admin:
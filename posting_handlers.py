@@ -777,6 +777,14 @@ class PostingHandlers:
 
                     status_text += f"⏱ *بدأ في:* {task['start_time']}\n\n"
 
+                # Per-account send rate and flood waits
+                rate_limit = status.get('rate_limit')
+                if rate_limit:
+                    status_text += f"📈 *معدل الإرسال:* {rate_limit['messages_per_minute']} رسالة/دقيقة\n"
+                    if rate_limit['flood_waits']:
+                        status_text += f"⏸ *انتظار FloodWait:* {rate_limit['flood_waits']} مرة ({rate_limit['flood_wait_seconds']} ثانية)\n"
+                    status_text += "\n"
+
                 # Create keyboard
                 keyboard = [
                     [InlineKeyboardButton("⛔ إيقاف النشر", callback_data="stop_posting")]
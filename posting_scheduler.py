@@ -0,0 +1,82 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class PostingScheduler:
+    """
+    مجدول مركزي واحد لجميع مهام النشر
+
+    يحتفظ بكومة صغرى (min-heap) لأوقات التشغيل التالية ويعمل كـ coroutine واحدة
+    على حلقة الأحداث المشتركة، ويسلّم كل مهمة مستحقة إلى دالة dispatch.
+    تكلفة الجدولة والتسليم O(log n) مهما كان عدد المهام المجدولة.
+    """
+    def __init__(self, loop_runner, dispatch):
+        self.loop_runner = loop_runner
+        self.dispatch = dispatch
+        self.heap = []
+        # Current run time of each scheduled task, heap entries that don't match are stale
+        self.next_runs = {}
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._runner = None
+
+    def schedule(self, task_id, run_at):
+        """Schedule a task to run at an epoch timestamp, replacing any earlier schedule (thread-safe)"""
+        self.loop_runner.call_soon(self._push, task_id, run_at)
+
+    def cancel(self, task_id):
+        """Drop a task from the schedule (thread-safe)"""
+        self.loop_runner.call_soon(self._remove, task_id)
+
+    def _push(self, task_id, run_at):
+        self.next_runs[task_id] = run_at
+        heapq.heappush(self.heap, (run_at, next(self._sequence), task_id))
+        self._ensure_running()
+        self._wakeup.set()
+
+    def _remove(self, task_id):
+        # The heap entry is skipped lazily when it reaches the top
+        self.next_runs.pop(task_id, None)
+
+    def _ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.get_running_loop().create_task(self._run())
+
+    def _discard_stale(self):
+        while self.heap:
+            run_at, _, task_id = self.heap[0]
+            if self.next_runs.get(task_id) == run_at:
+                return
+            heapq.heappop(self.heap)
+
+    async def _run(self):
+        while True:
+            self._discard_stale()
+
+            if self.heap:
+                timeout = self.heap[0][0] - time.time()
+            else:
+                timeout = None
+
+            # Sleep until the earliest run is due or an earlier one is scheduled
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            run_at, _, task_id = heapq.heappop(self.heap)
+            del self.next_runs[task_id]
+
+            try:
+                self.dispatch(task_id, run_at)
+            except Exception as e:
+                logger.error(f"Error dispatching task {task_id}: {str(e)}")
@@ -6,17 +6,53 @@ import os
 import json
 import sqlite3
 from datetime import datetime, timedelta
-from telethon import TelegramClient
-from telethon.sessions import StringSession
 from telethon.errors import (
     ChatAdminRequiredError, ChannelPrivateError, 
-    ChatWriteForbiddenError, UserBannedInChannelError
+    ChatWriteForbiddenError, UserBannedInChannelError,
+    FloodWaitError, PeerIdInvalidError, ChannelInvalidError, ChatIdInvalidError
 )
 from db import Database
+from models import to_datetime, epoch_seconds
+from background_loop import BackgroundLoop
+from client_pool import ClientPool, ClientUnavailable
+from entity_index import EntityIndex, GroupUnreachable
+from rate_limiter import AccountRateLimiter, FloodLimited
+from write_buffer import WriteBehindBuffer
+from posting_scheduler import PostingScheduler
+from config import POSTING_FLOOD_WAIT_RETRIES, POSTING_MAX_CONCURRENT_TASKS, CLIENT_POOL_RETRY_SECONDS
 
 class PostingService:
+    # Group resolution forms, in the order they are tried when nothing is remembered
+    RESOLVE_METHODS = ('id', 'channel', 'negative', 'dialogs')
+
+    # Errors meaning the peer itself is wrong or stale, resolving the group again can fix them
+    PEER_ERRORS = (ValueError, PeerIdInvalidError, ChannelInvalidError, ChatIdInvalidError)
+
+    # Errors meaning the group won't take messages from this account, retrying next cycle won't help
+    REFUSED_ERRORS = (ChatWriteForbiddenError, ChatAdminRequiredError, ChannelPrivateError, UserBannedInChannelError)
+
+    # Process-wide engine: every handler shares one instance, so tasks are
+    # restored, restarted and auto-saved exactly once
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(PostingService, cls).__new__(cls)
+                cls._instance._initialized = False
+        return cls._instance
+
     def __init__(self):
-        """Initialize posting service"""
+        """Initialize posting service, later constructions return the shared engine as is"""
+        with self._lock:
+            if self._initialized:
+                return
+            self._setup()
+            self._initialized = True
+
+    def _setup(self):
+        """Set up the shared posting engine"""
         # Set up logging
         self.logger = logging.getLogger(__name__)
 
@@ -41,13 +77,14 @@ class PostingService:
             if self.active_tasks_collection is None:
                 self.logger.warning("Active tasks collection not available, using fallback")
                 self.active_tasks_collection = {}
-
-            # Check database schema
-            self.check_database_schema()
             self.logger.info("Database schema check completed")
+
+            # Buffer send-path writes and flush them in batches
+            self.write_buffer = WriteBehindBuffer(self.db)
         except Exception as e:
             self.logger.error(f"Error initializing database: {str(e)}")
             self.db = None
+            self.write_buffer = None
             self.users_collection = {}
             self.groups_collection = {}
             self.messages_collection = {}
@@ -57,9 +94,32 @@ class PostingService:
         self.active_tasks = {}
         self.tasks_lock = threading.Lock()
 
-        # Dictionary to track running task threads
-        self.task_threads = {}
-        self.task_events = {}
+        # Tasks changed since the last save, only these are written back
+        self.dirty_tasks = set()
+        self.save_lock = threading.Lock()
+
+        # Append-only journal that replaces the full active_tasks.json rewrite
+        self.journal_file = os.path.join(os.path.dirname(__file__), 'active_tasks.journal')
+        self.journal_entries = 0
+
+        # Shared event loop that runs every posting task as a coroutine
+        self.loop_runner = BackgroundLoop()
+
+        # Connected Telethon clients shared with auto-response and group refresh
+        self.client_pool = ClientPool()
+
+        # Persistent per-account index of resolved group peers
+        self.entity_index = EntityIndex()
+
+        # Send rate limiters by user_id
+        self.rate_limiters = {}
+
+        # Dictionary to track running task futures on the shared loop
+        self.task_futures = {}
+
+        # One heap scheduler for the exact-time and recurring runs of every task
+        self.scheduler = PostingScheduler(self.loop_runner, self.dispatch_task)
+        self.task_slots = None
 
         # Restore active tasks from database
         self.restore_active_tasks()
@@ -74,47 +134,6 @@ class PostingService:
         self.default_api_id = 12345  # قيمة افتراضية، سيتم تجاوزها
         self.default_api_hash = "0123456789abcdef0123456789abcdef"  # قيمة افتراضية، سيتم تجاوزها
 
-    def check_database_schema(self):
-        """Check and create database schema if needed"""
-        try:
-            if self.db and self.db.conn:
-                cursor = self.db.cursor
-
-                # Create active_tasks table if it doesn't exist
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS active_tasks (
-                        task_id TEXT PRIMARY KEY,
-                        user_id INTEGER,
-                        post_id TEXT,
-                        message TEXT,
-                        group_ids TEXT,
-                        delay_seconds INTEGER,
-                        exact_time TEXT,
-                        status TEXT,
-                        start_time TEXT,
-                        last_activity TEXT,
-                        message_count INTEGER,
-                        message_id INTEGER,
-                        is_recurring INTEGER
-                    )
-                ''')
-
-                # Create status_updates table if it doesn't exist
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS status_updates (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        task_id TEXT,
-                        user_id INTEGER,
-                        message_count INTEGER,
-                        timestamp TEXT
-                    )
-                ''')
-
-                # Commit changes
-                self.db.conn.commit()
-        except Exception as e:
-            self.logger.error(f"Error checking database schema: {str(e)}")
-
     def restore_active_tasks(self):
         """Restore active tasks from database"""
         try:
@@ -134,11 +153,13 @@ class PostingService:
                     delay_seconds = row[5]
                     exact_time = row[6]
                     status = row[7]
-                    start_time = datetime.fromisoformat(row[8])
-                    last_activity = datetime.fromisoformat(row[9])
+                    start_time = to_datetime(row[8])
+                    last_activity = to_datetime(row[9])
                     message_count = row[10]
                     message_id = row[11]
                     is_recurring = bool(row[12])
+                    next_run_at = row['next_run_at'] if 'next_run_at' in row.keys() else None
+                    last_run_at = row['last_run_at'] if 'last_run_at' in row.keys() else None
 
                     # Create task data
                     task_data = {
@@ -153,14 +174,14 @@ class PostingService:
                         'last_activity': last_activity,
                         'message_count': message_count,
                         'message_id': message_id,
-                        'is_recurring': is_recurring
+                        'is_recurring': is_recurring,
+                        'next_run_at': next_run_at,
+                        'last_run_at': last_run_at
                     }
 
                     # Add task to active tasks
                     with self.tasks_lock:
                         self.active_tasks[task_id] = task_data
-                        # Create stop event for this task
-                        self.task_events[task_id] = threading.Event()
 
                     restored_count += 1
 
@@ -168,12 +189,9 @@ class PostingService:
                 self.logger.info(f"Restored {restored_count} active posting tasks from database")
 
             # Restore from file (backup)
-            backup_file = os.path.join(os.path.dirname(__file__), 'active_tasks.json')
-            if os.path.exists(backup_file):
+            file_tasks = self.load_task_backup()
+            if file_tasks:
                 try:
-                    with open(backup_file, 'r') as f:
-                        file_tasks = json.load(f)
-
                     additional_count = 0
                     for task_id, task_data in file_tasks.items():
                         if task_id not in self.active_tasks and task_data.get('status') == 'running':
@@ -186,8 +204,8 @@ class PostingService:
                             # Add task to active tasks
                             with self.tasks_lock:
                                 self.active_tasks[task_id] = task_data
-                                # Create stop event for this task
-                                self.task_events[task_id] = threading.Event()
+                                # Write it back to the database on the next save
+                                self.dirty_tasks.add(task_id)
 
                             additional_count += 1
 
@@ -198,68 +216,143 @@ class PostingService:
         except Exception as e:
             self.logger.error(f"Error restoring active tasks: {str(e)}")
 
-    def save_active_tasks(self):
-        """Save active tasks to database"""
+    def load_task_backup(self):
+        """Load tasks from the journal, or from the legacy active_tasks.json backup"""
+        tasks = {}
         try:
-            # Save to database
-            if self.db and self.db.conn:
-                cursor = self.db.cursor
-
-                # Begin transaction
-                cursor.execute('BEGIN TRANSACTION')
+            if os.path.exists(self.journal_file):
+                # Replay the journal, the last entry of each task wins
+                with open(self.journal_file, 'r') as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # A torn last line after a crash, skip it
+                            continue
+                        task_id = entry.pop('task_id', None)
+                        if task_id:
+                            tasks[task_id] = entry
+                        self.journal_entries += 1
+            else:
+                legacy_file = os.path.join(os.path.dirname(__file__), 'active_tasks.json')
+                if os.path.exists(legacy_file):
+                    with open(legacy_file, 'r') as f:
+                        tasks = json.load(f)
+        except Exception as e:
+            self.logger.error(f"Error restoring tasks from file: {str(e)}")
+        return tasks
+
+    def serialize_task(self, task_data):
+        """Convert a task to a JSON-serializable dict"""
+        serializable_task = task_data.copy()
+        if isinstance(serializable_task.get('start_time'), datetime):
+            serializable_task['start_time'] = serializable_task['start_time'].isoformat()
+        if isinstance(serializable_task.get('last_activity'), datetime):
+            serializable_task['last_activity'] = serializable_task['last_activity'].isoformat()
+        return serializable_task
 
-                # Delete all active tasks
-                cursor.execute('DELETE FROM active_tasks')
+    def save_active_tasks(self):
+        """Save changed active tasks to database and append them to the journal"""
+        with self.save_lock:
+            # Take a snapshot of the changed tasks and release tasks_lock right away
+            with self.tasks_lock:
+                changed = {
+                    task_id: self.serialize_task(self.active_tasks[task_id])
+                    for task_id in self.dirty_tasks
+                    if task_id in self.active_tasks
+                }
+                self.dirty_tasks.clear()
+
+            if not changed:
+                return
 
-                # Insert active tasks
-                with self.tasks_lock:
-                    for task_id, task_data in self.active_tasks.items():
-                        cursor.execute('''
+            try:
+                # Save to database, one UPSERT per changed task in a single transaction
+                if self.db and self.db.conn:
+                    with self.db.write_lock:
+                        self.db.cursor.executemany('''
                             INSERT INTO active_tasks (
                                 task_id, user_id, post_id, message, group_ids, delay_seconds,
                                 exact_time, status, start_time, last_activity, message_count,
-                                message_id, is_recurring
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            task_id,
-                            task_data.get('user_id'),
-                            task_data.get('post_id'),
-                            task_data.get('message'),
-                            json.dumps(task_data.get('group_ids', [])),
-                            task_data.get('delay_seconds'),
-                            task_data.get('exact_time'),
-                            task_data.get('status'),
-                            task_data.get('start_time').isoformat(),
-                            task_data.get('last_activity').isoformat(),
-                            task_data.get('message_count'),
-                            task_data.get('message_id'),
-                            1 if task_data.get('is_recurring', False) else 0
-                        ))
-
-                # Commit transaction
-                cursor.execute('COMMIT')
-
-                self.logger.info(f"Saved {len(self.active_tasks)} active posting tasks to database")
-
-            # Save to file (backup)
-            backup_file = os.path.join(os.path.dirname(__file__), 'active_tasks.json')
-            with open(backup_file, 'w') as f:
-                # Convert datetime objects to strings
-                serializable_tasks = {}
-                with self.tasks_lock:
-                    for task_id, task_data in self.active_tasks.items():
-                        serializable_task = task_data.copy()
-                        if isinstance(serializable_task.get('start_time'), datetime):
-                            serializable_task['start_time'] = serializable_task['start_time'].isoformat()
-                        if isinstance(serializable_task.get('last_activity'), datetime):
-                            serializable_task['last_activity'] = serializable_task['last_activity'].isoformat()
-                        serializable_tasks[task_id] = serializable_task
+                                message_id, is_recurring, next_run_at, last_run_at
+                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(task_id) DO UPDATE SET
+                                status = excluded.status,
+                                last_activity = excluded.last_activity,
+                                message_count = excluded.message_count,
+                                message_id = excluded.message_id,
+                                group_ids = excluded.group_ids,
+                                delay_seconds = excluded.delay_seconds,
+                                exact_time = excluded.exact_time,
+                                is_recurring = excluded.is_recurring,
+                                next_run_at = excluded.next_run_at,
+                                last_run_at = excluded.last_run_at
+                        ''', [
+                            (
+                                task_id,
+                                task_data.get('user_id'),
+                                task_data.get('post_id'),
+                                task_data.get('message'),
+                                json.dumps(task_data.get('group_ids', [])),
+                                task_data.get('delay_seconds'),
+                                task_data.get('exact_time'),
+                                task_data.get('status'),
+                                epoch_seconds(task_data.get('start_time')),
+                                epoch_seconds(task_data.get('last_activity')),
+                                task_data.get('message_count'),
+                                task_data.get('message_id'),
+                                1 if task_data.get('is_recurring', False) else 0,
+                                task_data.get('next_run_at'),
+                                task_data.get('last_run_at')
+                            )
+                            for task_id, task_data in changed.items()
+                        ])
+                        self.db.conn.commit()
 
-                json.dump(serializable_tasks, f)
+                # Save to file (backup)
+                self.append_to_journal(changed)
 
-            self.logger.info(f"Saved {len(self.active_tasks)} active posting tasks")
-        except Exception as e:
-            self.logger.error(f"Error saving active tasks: {str(e)}")
+                self.logger.info(f"Saved {len(changed)} changed posting tasks")
+            except Exception as e:
+                if self.db and self.db.conn:
+                    self.db.conn.rollback()
+
+                # Keep the tasks dirty so the next save retries them
+                with self.tasks_lock:
+                    self.dirty_tasks.update(changed.keys())
+                self.logger.error(f"Error saving active tasks: {str(e)}")
+
+    async def save_active_tasks_async(self):
+        """save_active_tasks on a worker thread, for callers on the posting loop"""
+        # It waits on the database writer lock and writes the journal, the loop must not
+        await asyncio.get_running_loop().run_in_executor(None, self.save_active_tasks)
+
+    def append_to_journal(self, changed):
+        """Append changed tasks to the journal, compacting it once it grows too long"""
+        with open(self.journal_file, 'a') as f:
+            for task_id, task_data in changed.items():
+                f.write(json.dumps({'task_id': task_id, **task_data}) + '\n')
+        self.journal_entries += len(changed)
+
+        with self.tasks_lock:
+            snapshot = None
+            if self.journal_entries > max(1000, 4 * len(self.active_tasks)):
+                snapshot = {
+                    task_id: self.serialize_task(task_data)
+                    for task_id, task_data in self.active_tasks.items()
+                }
+
+        if snapshot is not None:
+            # Rewrite the journal as one entry per task, atomically
+            temp_file = self.journal_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                for task_id, task_data in snapshot.items():
+                    f.write(json.dumps({'task_id': task_id, **task_data}) + '\n')
+            os.replace(temp_file, self.journal_file)
+            self.journal_entries = len(snapshot)
 
     def start_auto_save_timer(self):
         """Start auto-save timer"""
@@ -272,58 +365,42 @@ class PostingService:
         threading.Thread(target=auto_save, daemon=True).start()
 
     def check_recurring_tasks(self):
-        """Check for recurring tasks"""
+        """Check for recurring tasks and scheduled runs that haven't fired yet"""
         try:
-            # Get recurring tasks
+            # Get recurring and scheduled tasks
             recurring_tasks = []
             with self.tasks_lock:
                 for task_id, task_data in self.active_tasks.items():
-                    if task_data.get('is_recurring', False) and task_data.get('status') == 'running':
+                    if task_data.get('status') != 'running':
+                        continue
+                    if task_data.get('is_recurring', False) or task_data.get('next_run_at') is not None:
                         recurring_tasks.append((task_id, task_data))
 
-            # Start recurring tasks
+            # Put them back on the scheduler, overdue runs fire once right away
             for task_id, task_data in recurring_tasks:
-                thread = threading.Thread(target=self.start_posting_task, args=(task_id,))
-                thread.daemon = True
-                thread.start()
-
-                # Store thread reference
-                with self.tasks_lock:
-                    self.task_threads[task_id] = thread
+                self.start_posting_task(task_id)
 
             self.logger.info("Checked for recurring tasks")
         except Exception as e:
             self.logger.error(f"Error restoring recurring tasks: {str(e)}")
 
     def add_status_update(self, task_id, user_id, message_count):
-        """Add status update to database"""
+        """Queue status update for the next batched database write"""
         try:
-            if not self.db or not self.db.conn:
+            if self.write_buffer is None:
                 self.logger.warning("Database not available for status update")
                 return
 
-            cursor = self.db.cursor
-            conn = self.db.conn
-
-            # إضافة تحديث حالة جديد
-            cursor.execute('''
-                INSERT INTO status_updates (
-                    task_id, user_id, message_count, timestamp
-                ) VALUES (?, ?, ?, ?)
-            ''', (
-                task_id,
-                user_id,
-                message_count,
-                datetime.now().isoformat()
-            ))
-
-            # حفظ التغييرات
-            conn.commit()
-
-            self.logger.info(f"Added status update for task {task_id}")
+            # إضافة تحديث حالة جديد، يُكتب مع الدفعة التالية
+            self.write_buffer.add_status_update(task_id, user_id, message_count, datetime.now())
         except Exception as e:
             self.logger.error(f"Error adding status update: {str(e)}")
 
+    def flush_writes(self):
+        """Write buffered messages and status updates now"""
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+
     def post_message(self, user_id, message, group_ids, delay_seconds=0, exact_time=None, message_id=None, timing_type=None, is_recurring=False):
         """Start posting a message to multiple groups"""
         try:
@@ -374,20 +451,13 @@ class PostingService:
             # Add task to active tasks
             with self.tasks_lock:
                 self.active_tasks[task_id] = task_data
-                # Create stop event for this task
-                self.task_events[task_id] = threading.Event()
+                self.dirty_tasks.add(task_id)
 
             # Save active tasks
             self.save_active_tasks()
 
-            # Start posting task in a separate thread
-            thread = threading.Thread(target=self.start_posting_task, args=(task_id,))
-            thread.daemon = True
-            thread.start()
-
-            # Store thread reference
-            with self.tasks_lock:
-                self.task_threads[task_id] = thread
+            # Start posting task on the shared posting loop
+            self.start_posting_task(task_id)
 
             # إضافة تحديث حالة أولي
             self.add_status_update(task_id, user_id, 0)
@@ -401,11 +471,48 @@ class PostingService:
             self.logger.error(f"Error starting posting: {str(e)}")
             return (False, f"حدث خطأ أثناء بدء النشر: {str(e)}")
 
+    def get_rate_limiter(self, user_id):
+        """Get the send rate limiter of an account"""
+        with self.tasks_lock:
+            limiter = self.rate_limiters.get(user_id)
+            if limiter is None:
+                limiter = AccountRateLimiter()
+                self.rate_limiters[user_id] = limiter
+            return limiter
+
     async def send_message_to_group(self, client, entity, message, task_id, user_id, post_id, group_id):
-        """إرسال رسالة إلى مجموعة واحدة بشكل متزامن"""
+        """
+        إرسال رسالة إلى مجموعة واحدة بشكل متزامن
+
+        Returns:
+            True if the message was sent, False if sending failed for a passing reason
+        Raises:
+            PEER_ERRORS if the peer is invalid or stale
+            GroupUnreachable if the group refuses messages from this account
+            FloodLimited if Telegram still answered FloodWait after every retry
+        """
         try:
-            # إرسال الرسالة باستخدام الكيان المباشر
-            sent_message = await client.send_message(entity, message)
+            limiter = self.get_rate_limiter(user_id)
+
+            # إرسال الرسالة باستخدام الكيان المباشر، مع الانتظار عند FloodWait ثم الاستئناف
+            sent_message = None
+            for attempt in range(POSTING_FLOOD_WAIT_RETRIES + 1):
+                await limiter.acquire()
+                # The wait for a token or a FloodWait can be long, a stopped task sends nothing more
+                if not self.is_task_running(task_id):
+                    self.logger.info(f"Task {task_id} was stopped, not sending to group {group_id}")
+                    return False
+                try:
+                    sent_message = await client.send_message(entity, message)
+                    limiter.record_send()
+                    break
+                except FloodWaitError as e:
+                    self.logger.warning(f"FloodWait of {e.seconds}s for user {user_id} while sending to group {group_id}")
+                    limiter.record_flood_wait(e.seconds)
+
+            if sent_message is None:
+                self.logger.error(f"Giving up on group {group_id} after {POSTING_FLOOD_WAIT_RETRIES + 1} flood waits")
+                raise FloodLimited(f"user {user_id} is flood limited")
 
             # حفظ الرسالة في قاعدة البيانات
             if self.messages_collection is not None:
@@ -417,20 +524,18 @@ class PostingService:
                         'message_id': sent_message.id,
                         'timestamp': datetime.now()
                     }
-                else:
-                    self.messages_collection.insert_one({
-                        'user_id': user_id,
-                        'post_id': post_id,
-                        'group_id': group_id,
-                        'message_id': sent_message.id,
-                        'timestamp': datetime.now()
-                    })
+                elif self.write_buffer is not None:
+                    # Batched with other sends instead of one commit per message
+                    self.write_buffer.add_message(
+                        user_id, post_id, group_id, sent_message.id, datetime.now()
+                    )
 
             # تحديث عدد الرسائل المرسلة
             with self.tasks_lock:
                 if task_id in self.active_tasks:
                     self.active_tasks[task_id]['message_count'] += 1
                     self.active_tasks[task_id]['last_activity'] = datetime.now()
+                    self.dirty_tasks.add(task_id)
 
             # إضافة تحديث حالة
             self.add_status_update(
@@ -440,240 +545,377 @@ class PostingService:
             )
 
             return True
+        except (FloodLimited,) + self.PEER_ERRORS:
+            raise
+        except self.REFUSED_ERRORS as e:
+            raise GroupUnreachable(f"{type(e).__name__}: {str(e)}")
         except Exception as e:
             self.logger.error(f"Error sending message to group {group_id}: {str(e)}")
             return False
 
+    async def resolve_group_entity(self, client, method, user_id, group_id, group_ids, cycle_state):
+        """Resolve a group entity using one resolution form"""
+        if method == 'id':
+            return await client.get_entity(int(group_id))
+        if method == 'channel':
+            # -100 prefix for supergroups/channels
+            return await client.get_entity(-1001000000000 + int(group_id) % 1000000000)
+        if method == 'negative':
+            return await client.get_entity(-int(group_id))
+        if method == 'dialogs':
+            # Scan dialogs as a last resort, this also matches by title
+            async with cycle_state['lock']:
+                if cycle_state['entities'] is None:
+                    self.logger.info(f"Fetching dialogs to refresh entity index for user {user_id}")
+                    groups_by_id = await self.db.run_async(self.get_groups_by_id, user_id)
+                    cycle_state['entities'] = await self.entity_index.refresh_from_dialogs(
+                        client, user_id, group_ids, groups_by_id
+                    )
+            return cycle_state['entities'].get(str(group_id))
+        return None
+
+    async def post_to_group(self, client, cached, message, task_id, user_id, post_id, group_id,
+                            group_ids, cycle_state):
+        """
+        Send a message to one group
+
+        Uses the cached peer first, then the resolution form that worked last
+        time, and only then the rest of the cascade. Only peer errors lead to
+        resolving the group again.
+
+        Returns:
+            True if the message was sent, False if it failed for a passing reason
+        Raises:
+            GroupUnreachable if no resolution form worked or the group refuses the account
+            FloodLimited if the account is flood limited
+        """
+        group_id_str = str(group_id)
+
+        # Try the cached peer from the entity index first
+        if self.entity_index.is_fresh(cached):
+            input_peer = self.entity_index.to_input_peer(cached)
+            if input_peer is not None:
+                try:
+                    sent = await self.send_message_to_group(
+                        client, input_peer, message, task_id, user_id, post_id, group_id
+                    )
+                except self.PEER_ERRORS as e:
+                    # The cached peer no longer works, resolve it again
+                    self.logger.warning(f"Cached peer of group {group_id} is no longer valid: {str(e)}")
+                    await self.entity_index.invalidate_async(user_id, group_id_str)
+                else:
+                    if not sent:
+                        # The peer is fine, the send failed for a passing reason
+                        return False
+
+                    self.logger.info(f"Message sent to group {group_id} using entity index")
+                    # A healthy group must not keep doubling its backoff from old failures
+                    if self.entity_index.has_failures(cached):
+                        await self.entity_index.clear_failures_async(user_id, group_id_str)
+                    return True
+
+        # Go straight to the form that worked last time
+        methods = list(self.RESOLVE_METHODS)
+        remembered = cached.get('resolve_method') if cached else None
+        if remembered in methods:
+            methods.remove(remembered)
+            methods.insert(0, remembered)
+
+        for method in methods:
+            try:
+                entity = await self.resolve_group_entity(
+                    client, method, user_id, group_id, group_ids, cycle_state
+                )
+            except Exception as e:
+                self.logger.warning(f"Failed to get entity for {group_id} using {method} form: {str(e)}")
+                continue
+
+            if entity is None:
+                continue
+
+            try:
+                sent = await self.send_message_to_group(
+                    client, entity, message, task_id, user_id, post_id, group_id
+                )
+            except self.PEER_ERRORS as e:
+                self.logger.warning(f"Peer from {method} form of group {group_id} is not valid: {str(e)}")
+                continue
+
+            if sent:
+                await self.entity_index.store_async(user_id, group_id_str, entity, resolve_method=method)
+                self.logger.info(f"Message sent to group {group_id} using {method} form")
+                return True
+
+            # The group resolved but the send failed for a passing reason, other forms point to the same chat
+            return False
+
+        raise GroupUnreachable("no resolution form reached the group")
+
+    def is_task_running(self, task_id):
+        """Check if a task is still running and not stopped"""
+        with self.tasks_lock:
+            if task_id not in self.active_tasks:
+                return False
+
+            return self.active_tasks[task_id]['status'] == 'running'
+
+    async def post_to_group_slot(self, limiter, client, message, task_id, user_id, post_id, group_id,
+                                 group_ids, cycle_state, index_rows):
+        """Post to one group while holding one of the account's concurrent send slots"""
+        async with limiter.slots:
+            # Check if task has been stopped while waiting for a slot
+            if not self.is_task_running(task_id):
+                return False
+
+            # The account hit a FloodWait it couldn't wait out, the rest of this cycle is skipped
+            if cycle_state['flood_limited']:
+                return False
+
+            # Skip groups that recently failed every resolution form
+            group_id_str = str(group_id)
+            cached = index_rows.get(group_id_str)
+            if self.entity_index.is_quarantined(cached):
+                self.logger.info(f"Skipping quarantined group {group_id} until {cached.get('retry_after')}")
+                return False
+
+            try:
+                success = await self.post_to_group(
+                    client, cached, message, task_id, user_id, post_id, group_id,
+                    group_ids, cycle_state
+                )
+            except FloodLimited:
+                # Not the group's fault, don't quarantine it
+                if not cycle_state['flood_limited']:
+                    self.logger.error(f"User {user_id} is flood limited, stopping this cycle of task {task_id}")
+                cycle_state['flood_limited'] = True
+                return False
+            except GroupUnreachable as e:
+                retry_after = await self.entity_index.record_failure_async(user_id, group_id_str, cached)
+                self.logger.error(f"Group {group_id} is unreachable ({str(e)}), quarantined until {retry_after}")
+                return False
+
+            if not success and self.is_task_running(task_id):
+                # Network errors, a dropped client or a timeout, the next cycle tries again
+                self.logger.warning(f"Failed to post to group {group_id}, retrying next cycle")
+
+            return success
+
+    def get_next_run_time(self, task_data):
+        """
+        Work out when a task should run next
+
+        Returns:
+            epoch seconds (in the past for a run missed while the bot was down),
+            or None if the only run of a one-shot task already fired
+        """
+        next_run_at = task_data.get('next_run_at')
+        last_run_at = task_data.get('last_run_at')
+
+        # A recorded run that hasn't fired yet
+        if next_run_at is not None and (last_run_at is None or next_run_at > last_run_at):
+            return next_run_at
+
+        if last_run_at is not None:
+            # The last run fired but the next one was never recorded
+            if task_data.get('is_recurring', False):
+                return last_run_at + int(task_data.get('delay_seconds') or 0)
+            return None
+
+        # Never scheduled before
+        exact_time = task_data.get('exact_time')
+        if exact_time:
+            try:
+                return datetime.strptime(exact_time, "%Y-%m-%d %H:%M").timestamp()
+            except ValueError as e:
+                self.logger.error(f"Error parsing exact time: {str(e)}")
+
+        return time.time()
+
     def start_posting_task(self, task_id):
-        """Start posting task"""
+        """Put a posting task on the scheduler"""
         try:
-            # Get task data
             with self.tasks_lock:
                 if task_id not in self.active_tasks:
                     self.logger.error(f"Task {task_id} not found")
                     return
 
                 task_data = self.active_tasks[task_id]
+                next_run_at = self.get_next_run_time(task_data)
+                if next_run_at is None:
+                    # Its only run started before a restart, don't send it twice
+                    task_data['status'] = 'completed'
+                else:
+                    task_data['next_run_at'] = next_run_at
+                self.dirty_tasks.add(task_id)
 
-            # Get task parameters
-            user_id = task_data.get('user_id')
-            post_id = task_data.get('post_id')
-            message = task_data.get('message')
-            group_ids = task_data.get('group_ids', [])
-            delay_seconds = task_data.get('delay_seconds', 0)
-            exact_time = task_data.get('exact_time')
-            is_recurring = task_data.get('is_recurring', False)
-
-            # Check if task should be scheduled for later
-            if exact_time:
-                try:
-                    # Parse exact time
-                    exact_time_dt = datetime.strptime(exact_time, "%Y-%m-%d %H:%M")
-
-                    # Calculate delay
-                    now = datetime.now()
-                    if exact_time_dt > now:
-                        delay = (exact_time_dt - now).total_seconds()
-
-                        # Sleep until exact time
-                        time.sleep(delay)
-                except Exception as e:
-                    self.logger.error(f"Error parsing exact time: {str(e)}")
+            # Persist the run time so it survives a restart
+            self.save_active_tasks()
 
-            # Get user session
-            if self.users_collection is None:
-                self.logger.error("Users collection not available")
+            if next_run_at is None:
+                self.logger.info(f"Task {task_id} already ran before the restart, marked as completed")
                 return
 
-            user = None
-            if isinstance(self.users_collection, dict):
-                user = self.users_collection.get(user_id)
-            else:
-                user = self.users_collection.find_one({'user_id': user_id})
+            self.scheduler.schedule(task_id, next_run_at)
+        except Exception as e:
+            self.logger.error(f"Error in posting task {task_id}: {str(e)}")
 
-            if not user or 'session_string' not in user:
-                self.logger.error(f"User session not found for user {user_id}")
+    def dispatch_task(self, task_id, run_at):
+        """Hand a due task to a send worker, called by the scheduler on the posting loop"""
+        with self.tasks_lock:
+            task_data = self.active_tasks.get(task_id)
+            if task_data is None or task_data.get('status') != 'running':
                 return
 
-            # Get session string
-            session_string = user.get('session_string')
+            # Never run two cycles of the same task at once
+            future = self.task_futures.get(task_id)
+            if future is not None and not future.done():
+                self.logger.info(f"Task {task_id} is already running")
+                return
 
-            # Try to get user's API credentials if available
-            api_id = user.get('api_id', self.default_api_id)
-            api_hash = user.get('api_hash', self.default_api_hash)
+            # Record the run before sending so a restart never fires it twice,
+            # run_task_cycle saves it before the first send
+            task_data['last_run_at'] = run_at
+            task_data['next_run_at'] = None
+            self.dirty_tasks.add(task_id)
 
-            # Run posting task
-            asyncio.run(self.run_posting_task(
-                task_id, user_id, post_id, message, group_ids,
-                delay_seconds, session_string, api_id, api_hash,
-                is_recurring
-            ))
-        except Exception as e:
-            self.logger.error(f"Error in posting task {task_id}: {str(e)}")
+            self.task_futures[task_id] = asyncio.get_running_loop().create_task(
+                self.run_task_cycle(task_id)
+            )
 
-    async def run_posting_task(self, task_id, user_id, post_id, message, group_ids,
-                              delay_seconds, session_string, api_id, api_hash,
-                              is_recurring):
-        # Run posting task
+    async def run_task_cycle(self, task_id):
+        """Run one posting cycle of a due task, then schedule its next run"""
         try:
-            # Create Telethon client with session string
-            client = TelegramClient(StringSession(session_string), api_id, api_hash)
-
-            # تسجيل محاولة الاتصال
-            self.logger.info(f"Attempting to connect with session for user {user_id}")
-
-            # الاتصال بالخادم
-            await client.connect()
+            await self.save_active_tasks_async()
 
-            # Check if client is authorized
-            if not await client.is_user_authorized():
-                self.logger.error(f"User {user_id} is not authorized")
+            if self.task_slots is None:
+                self.task_slots = asyncio.Semaphore(POSTING_MAX_CONCURRENT_TASKS)
 
-                # Update task status
+            async with self.task_slots:
+                # Get task data
                 with self.tasks_lock:
-                    if task_id in self.active_tasks:
-                        self.active_tasks[task_id]['status'] = 'failed'
+                    if task_id not in self.active_tasks:
+                        self.logger.error(f"Task {task_id} not found")
+                        return
 
-                # Save active tasks
-                self.save_active_tasks()
+                    task_data = self.active_tasks[task_id]
 
-                return
+                # Get task parameters
+                user_id = task_data.get('user_id')
+                post_id = task_data.get('post_id')
+                message = task_data.get('message')
+                group_ids = task_data.get('group_ids', [])
+                delay_seconds = task_data.get('delay_seconds', 0)
+                is_recurring = task_data.get('is_recurring', False)
 
-            # Fetch all dialogs to ensure we have access to all entities
-            self.logger.info(f"Fetching all dialogs to ensure entity access")
-            dialogs = await client.get_dialogs()
+                # Check if task has been stopped while waiting for a worker
+                if not self.is_task_running(task_id):
+                    return
 
-            # Create a mapping of group IDs to entities
-            dialog_entities = {}
-            for dialog in dialogs:
-                entity = dialog.entity
-                dialog_id = dialog.id
+                # Get user session
+                if self.users_collection is None:
+                    self.logger.error("Users collection not available")
+                    return
 
-                # Log dialog information for debugging
-                entity_type = type(entity).__name__
-                self.logger.debug(f"Found dialog: ID={dialog_id}, Name={dialog.name}, Type={entity_type}")
+                user = None
+                if isinstance(self.users_collection, dict):
+                    user = self.users_collection.get(user_id)
+                else:
+                    user = await self.db.run_async(self.users_collection.find_one, {'user_id': user_id})
 
-                # Store entity in mapping
-                dialog_entities[str(dialog_id).replace('-100', '')] = entity
+                if not user or 'session_string' not in user:
+                    self.logger.error(f"User session not found for user {user_id}")
+                    return
 
-                # Also store by title for fallback
-                if dialog.name:
-                    dialog_entities[dialog.name] = entity
+                # Get session string
+                session_string = user.get('session_string')
 
-            # Process each group
-            for group_id in group_ids:
-                # Check if task is still running and not stopped
-                with self.tasks_lock:
-                    if task_id not in self.active_tasks:
-                        self.logger.error(f"Task {task_id} not found")
-                        break
+                # Try to get user's API credentials if available
+                api_id = user.get('api_id', self.default_api_id)
+                api_hash = user.get('api_hash', self.default_api_hash)
 
-                    status = self.active_tasks[task_id]['status']
+                # Run one posting cycle, recurring tasks ask for another one
+                run_again = await self.run_posting_task(
+                    task_id, user_id, post_id, message, group_ids,
+                    delay_seconds, session_string, api_id, api_hash,
+                    is_recurring
+                )
 
-                # Check if task has been stopped
-                if status != 'running':
-                    self.logger.info(f"Task {task_id} is not running (status: {status})")
-                    break
+            if run_again and self.is_task_running(task_id):
+                next_run_at = time.time() + max(0, int(delay_seconds or 0))
+                with self.tasks_lock:
+                    if task_id in self.active_tasks:
+                        self.active_tasks[task_id]['next_run_at'] = next_run_at
+                        self.dirty_tasks.add(task_id)
+
+                await self.save_active_tasks_async()
+                self.scheduler.schedule(task_id, next_run_at)
+        except ClientUnavailable as e:
+            # A full pool or a dropped connection, the session is fine: try this run again later
+            self.logger.warning(f"No client available for task {task_id} ({str(e)}), retrying in {CLIENT_POOL_RETRY_SECONDS}s")
+            if self.is_task_running(task_id):
+                next_run_at = time.time() + CLIENT_POOL_RETRY_SECONDS
+                with self.tasks_lock:
+                    if task_id in self.active_tasks:
+                        self.active_tasks[task_id]['next_run_at'] = next_run_at
+                        self.dirty_tasks.add(task_id)
 
-                # Check if stop event is set
-                if task_id in self.task_events and self.task_events[task_id].is_set():
-                    self.logger.info(f"Stop event set for task {task_id}, stopping task")
-                    break
+                await self.save_active_tasks_async()
+                self.scheduler.schedule(task_id, next_run_at)
+        except asyncio.CancelledError:
+            self.logger.info(f"Posting task {task_id} cancelled")
+        except Exception as e:
+            self.logger.error(f"Error in posting task {task_id}: {str(e)}")
+        finally:
+            with self.tasks_lock:
+                self.task_futures.pop(task_id, None)
 
-                # Convert group_id to string if it's not already
-                group_id_str = str(group_id)
-
-                # Try different formats of group ID
-                success = False
-
-                # Try to find entity in our dialog mapping
-                if group_id_str in dialog_entities:
-                    try:
-                        entity = dialog_entities[group_id_str]
-                        success = await self.send_message_to_group(
-                            client, entity, message, task_id, user_id, post_id, group_id
-                        )
-                        if success:
-                            self.logger.info(f"Message sent to group {group_id} using dialog entity")
-                            continue
-                    except Exception as e:
-                        self.logger.error(f"Error sending message using dialog entity: {str(e)}")
+    async def run_posting_task(self, task_id, user_id, post_id, message, group_ids,
+                              delay_seconds, session_string, api_id, api_hash,
+                              is_recurring):
+        """
+        Run one posting cycle
+
+        Returns:
+            True if a recurring task should run another cycle, False otherwise
+        Raises:
+            ClientUnavailable if no client could be borrowed, the run should be retried
+        """
+        client = None
+        try:
+            # Borrow the user's connected client from the shared pool
+            client = await self.client_pool.acquire(user_id, session_string, api_id, api_hash)
 
-                # Try with original group ID
-                try:
-                    self.logger.debug(f"Trying to send message to group_id: {group_id}")
-                    entity = await client.get_entity(int(group_id))
-                    success = await self.send_message_to_group(
-                        client, entity, message, task_id, user_id, post_id, group_id
-                    )
-                    if success:
-                        self.logger.info(f"Message sent to group {group_id}")
-                        continue
-                except Exception as e:
-                    self.logger.warning(f"Failed to get entity for {group_id}: {str(e)}")
+            # Check if client is authorized
+            if client is None:
+                self.logger.error(f"User {user_id} is not authorized")
 
-                # Try with -100 prefix for supergroups/channels
-                try:
-                    channel_id = -1001000000000 + int(group_id) % 1000000000
-                    self.logger.debug(f"Trying to send message to channel_id: {channel_id}")
-                    entity = await client.get_entity(channel_id)
-                    success = await self.send_message_to_group(
-                        client, entity, message, task_id, user_id, post_id, group_id
-                    )
-                    if success:
-                        self.logger.info(f"Message sent to group {group_id} using channel format")
-                        continue
-                except Exception as e:
-                    self.logger.warning(f"Failed to get entity for channel {channel_id}: {str(e)}")
+                # Update task status
+                with self.tasks_lock:
+                    if task_id in self.active_tasks:
+                        self.active_tasks[task_id]['status'] = 'failed'
+                        self.dirty_tasks.add(task_id)
 
-                # Try with negative group ID
-                try:
-                    negative_id = -int(group_id)
-                    self.logger.debug(f"Trying to send message to negative group_id: {negative_id}")
-                    entity = await client.get_entity(negative_id)
-                    success = await self.send_message_to_group(
-                        client, entity, message, task_id, user_id, post_id, group_id
-                    )
-                    if success:
-                        self.logger.info(f"Message sent to group {group_id} using negative ID")
-                        continue
-                except Exception as e:
-                    self.logger.warning(f"Failed to get entity for negative ID {negative_id}: {str(e)}")
+                # Save active tasks
+                await self.save_active_tasks_async()
 
-                # Try to find group by title as last resort
-                try:
-                    # Get group from database to find title
-                    group = None
-                    if self.groups_collection is not None:
-                        if isinstance(self.groups_collection, dict):
-                            for g in self.groups_collection.values():
-                                if str(g.get('group_id')) == str(group_id) and g.get('user_id') == user_id:
-                                    group = g
-                                    break
-                        else:
-                            group = self.groups_collection.find_one({
-                                'user_id': user_id,
-                                'group_id': group_id
-                            })
-
-                    if group and 'title' in group:
-                        title = group['title']
-                        self.logger.debug(f"Trying to find group by title: {title}")
-
-                        # Try to find entity by title in our dialog mapping
-                        if title in dialog_entities:
-                            entity = dialog_entities[title]
-                            success = await self.send_message_to_group(
-                                client, entity, message, task_id, user_id, post_id, group_id
-                            )
-                            if success:
-                                self.logger.info(f"Successfully posted to group {title} by title match")
-                                continue
-                except Exception as e:
-                    self.logger.error(f"Error finding group by title: {str(e)}")
+                return
 
-                if not success:
-                    self.logger.error(f"Failed to post to group {group_id} after trying all methods")
+            # Dialogs are scanned at most once per cycle, and only if some group needs it.
+            # A flood give-up stops the sends of the cycle that haven't started yet
+            cycle_state = {'entities': None, 'lock': asyncio.Lock(), 'flood_limited': False}
+
+            # The account's whole entity index in one read off the loop, not one query per group
+            index_rows = await self.entity_index.get_all_async(user_id)
+
+            # Send to all groups concurrently, paced by the account rate limiter
+            limiter = self.get_rate_limiter(user_id)
+            await asyncio.gather(*(
+                self.post_to_group_slot(
+                    limiter, client, message, task_id, user_id, post_id, group_id,
+                    group_ids, cycle_state, index_rows
+                )
+                for group_id in group_ids
+            ))
 
             # Check if task should be recurring
             if is_recurring:
@@ -689,11 +931,6 @@ class PostingService:
                     self.logger.info(f"Recurring task {task_id} stopped (status: {status})")
                     return
 
-                # Check if stop event is set
-                if task_id in self.task_events and self.task_events[task_id].is_set():
-                    self.logger.info(f"Stop event set for recurring task {task_id}, stopping task")
-                    return
-
                 # Schedule next run
                 self.logger.info(f"Scheduling next run for recurring task {task_id}")
 
@@ -701,55 +938,21 @@ class PostingService:
                 with self.tasks_lock:
                     if task_id in self.active_tasks:
                         self.active_tasks[task_id]['last_activity'] = datetime.now()
+                        self.dirty_tasks.add(task_id)
 
-                # Save active tasks
-                self.save_active_tasks()
-
-                # Wait for delay
-                if delay_seconds > 0:
-                    # Use asyncio.sleep for async waiting
-                    try:
-                        # Check every second if task has been stopped
-                        for _ in range(delay_seconds):
-                            # Check if task is still running
-                            with self.tasks_lock:
-                                if task_id not in self.active_tasks:
-                                    return
-
-                                status = self.active_tasks[task_id]['status']
-
-                            # Check if task has been stopped
-                            if status != 'running':
-                                self.logger.info(f"Recurring task {task_id} stopped during delay (status: {status})")
-                                return
-
-                            # Check if stop event is set
-                            if task_id in self.task_events and self.task_events[task_id].is_set():
-                                self.logger.info(f"Stop event set for recurring task {task_id} during delay, stopping task")
-                                return
-
-                            # Wait for 1 second
-                            await asyncio.sleep(1)
-                    except asyncio.CancelledError:
-                        self.logger.info(f"Recurring task {task_id} cancelled during delay")
-                        return
-
-                # Start next run
-                thread = threading.Thread(target=self.start_posting_task, args=(task_id,))
-                thread.daemon = True
-                thread.start()
-
-                # Store thread reference
-                with self.tasks_lock:
-                    self.task_threads[task_id] = thread
+                # The scheduler starts the next run after delay_seconds
+                return True
             else:
                 # Update task status
                 with self.tasks_lock:
                     if task_id in self.active_tasks:
                         self.active_tasks[task_id]['status'] = 'completed'
+                        self.dirty_tasks.add(task_id)
 
                 # Save active tasks
-                self.save_active_tasks()
+                await self.save_active_tasks_async()
+        except ClientUnavailable:
+            raise
         except Exception as e:
             self.logger.error(f"Error in posting task {task_id}: {str(e)}")
 
@@ -757,15 +960,14 @@ class PostingService:
             with self.tasks_lock:
                 if task_id in self.active_tasks:
                     self.active_tasks[task_id]['status'] = 'failed'
+                    self.dirty_tasks.add(task_id)
 
             # Save active tasks
-            self.save_active_tasks()
+            await self.save_active_tasks_async()
         finally:
-            # Disconnect client
-            try:
-                await client.disconnect()
-            except:
-                pass
+            # Return client to the pool, it stays connected for the next cycle
+            if client is not None:
+                await self.client_pool.release(user_id, client)
 
     def stop_posting(self, user_id):
         """Stop posting for a user"""
@@ -787,10 +989,11 @@ class PostingService:
                     if task_id in self.active_tasks:
                         # Update task status
                         self.active_tasks[task_id]['status'] = 'stopped'
+                        self.dirty_tasks.add(task_id)
 
-                        # Set stop event to signal running tasks to stop
-                        if task_id in self.task_events:
-                            self.task_events[task_id].set()
+                        # A running cycle sees the status and stops sending,
+                        # drop its next run from the scheduler
+                        self.scheduler.cancel(task_id)
 
                         stopped_count += 1
 
@@ -830,9 +1033,13 @@ class PostingService:
 
                         active_tasks.append(task_status)
 
+            # Per-account send rate and flood-wait totals
+            limiter = self.rate_limiters.get(user_id)
+
             return {
                 'is_active': len(active_tasks) > 0,
-                'active_tasks': active_tasks
+                'active_tasks': active_tasks,
+                'rate_limit': limiter.get_stats() if limiter else None
             }
         except Exception as e:
             self.logger.error(f"Error getting posting status: {str(e)}")
@@ -841,6 +1048,22 @@ class PostingService:
                 'active_tasks': []
             }
 
+    def get_groups_by_id(self, user_id):
+        """Get user groups keyed by group_id string"""
+        try:
+            if self.groups_collection is None:
+                return {}
+
+            if isinstance(self.groups_collection, dict):
+                groups = [g for g in self.groups_collection.values() if g.get('user_id') == user_id]
+            else:
+                groups = self.groups_collection.find({'user_id': user_id})
+
+            return {str(group.get('group_id')): group for group in groups}
+        except Exception as e:
+            self.logger.error(f"Error getting user groups: {str(e)}")
+            return {}
+
     def get_user_groups(self, user_id):
         """Get user groups"""
         try:
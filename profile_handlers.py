@@ -26,9 +26,9 @@ class ProfileHandlers:
         chat_id = update.effective_chat.id
         
         # Get user from database
-        db_user = self.subscription_service.get_user(user_id)
+        db_user = await self.subscription_service.get_user_async(user_id)
         if not db_user:
-            db_user = self.subscription_service.create_user(
+            db_user = await self.subscription_service.create_user_async(
                 user_id,
                 user.username,
                 user.first_name,
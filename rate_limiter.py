@@ -0,0 +1,106 @@
+import asyncio
+import random
+import time
+from collections import deque
+from config import (
+    POSTING_RATE_PER_MINUTE, POSTING_BURST, POSTING_CONCURRENCY, POSTING_JITTER_SECONDS
+)
+
+class FloodLimited(Exception):
+    """Telegram kept answering FloodWait, the account should stop sending for now"""
+
+class TokenBucket:
+    """
+    دلو رموز غير متزامن لتحديد معدل الإرسال
+
+    يجب استخدامه من حلقة أحداث واحدة فقط (حلقة النشر المشتركة).
+    """
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = None
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Waiters are served in order so one group can't starve the others
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the given number of seconds"""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+class AccountRateLimiter:
+    """حدود الإرسال لحساب مستخدم واحد: دلو رموز وتوازي محدود وإحصائيات FloodWait"""
+    def __init__(self, rate_per_minute=POSTING_RATE_PER_MINUTE, burst=POSTING_BURST,
+                 concurrency=POSTING_CONCURRENCY, jitter_seconds=POSTING_JITTER_SECONDS):
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst)
+        self.concurrency = concurrency
+        self.jitter_seconds = jitter_seconds
+        self._slots = None
+        self.sent_times = deque()
+        self.sent_count = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    @property
+    def slots(self):
+        """Semaphore bounding in-flight sends for the account"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._slots
+
+    async def acquire(self):
+        """Wait for a send token, then a small random pause so sends don't look scripted"""
+        await self.bucket.acquire()
+        if self.jitter_seconds > 0:
+            await asyncio.sleep(random.uniform(0, self.jitter_seconds))
+
+    def record_send(self):
+        now = time.monotonic()
+        self.sent_count += 1
+        self.sent_times.append(now)
+        while self.sent_times and now - self.sent_times[0] > 60:
+            self.sent_times.popleft()
+
+    def record_flood_wait(self, seconds):
+        """Stop sending from the account until Telegram's FloodWait is over"""
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        self.bucket.pause(seconds)
+
+    def get_stats(self):
+        """Get send rate and flood-wait counters"""
+        now = time.monotonic()
+        recent = [t for t in list(self.sent_times) if now - t <= 60]
+        return {
+            'messages_per_minute': len(recent),
+            'messages_sent': self.sent_count,
+            'flood_waits': self.flood_waits,
+            'flood_wait_seconds': self.flood_wait_seconds,
+            'paused_for': max(0, int(self.bucket.paused_until - now))
+        }
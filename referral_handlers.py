@@ -33,7 +33,7 @@ class ReferralHandlers:
         user_id = update.effective_user.id
         
         # Generate referral link
-        referral_link = self.referral_service.generate_referral_link(user_id)
+        referral_link = await self.referral_service.generate_referral_link_async(user_id)
         
         if not referral_link:
             await context.bot.send_message(
@@ -43,7 +43,7 @@ class ReferralHandlers:
             return
         
         # Get referral stats
-        stats = self.referral_service.get_referral_stats(user_id)
+        stats = await self.referral_service.get_referral_stats_async(user_id)
         
         # Create message
         message = f"🔗 رابط الإحالة الخاص بك:\n{referral_link}\n\n"
@@ -77,7 +77,7 @@ class ReferralHandlers:
         user_id = update.effective_user.id
         
         # Get user referrals
-        referrals = self.referral_service.get_user_referrals(user_id)
+        referrals = await self.referral_service.get_user_referrals_async(user_id)
         
         if not referrals:
             await context.bot.send_message(
@@ -97,7 +97,7 @@ class ReferralHandlers:
             created_at = referral.get('created_at', datetime.now()).strftime('%Y-%m-%d')
             
             # Get user info
-            user = self.subscription_service.get_user(referred_id)
+            user = await self.subscription_service.get_user_async(referred_id)
             username = f"@{user.username}" if user and user.username else "غير معروف"
             name = f"{user.first_name} {user.last_name or ''}" if user and user.first_name else "غير معروف"
             
@@ -111,7 +111,7 @@ class ReferralHandlers:
             message += f"   تاريخ الإحالة: {created_at}\n\n"
         
         # Get stats
-        stats = self.referral_service.get_referral_stats(user_id)
+        stats = await self.referral_service.get_referral_stats_async(user_id)
         message += f"📊 إجمالي الإحالات: {stats['total_referrals']}\n"
         message += f"✅ الإحالات المشتركة: {stats['subscribed_referrals']}\n"
         message += f"🎁 الأيام المكافأة: {stats['total_reward_days']}\n\n"
@@ -156,7 +156,7 @@ class ReferralHandlers:
             return
         
         # Get referrer
-        referrer_id = self.referral_service.get_referrer_by_code(referral_code)
+        referrer_id = await self.referral_service.get_referrer_by_code_async(referral_code)
         
         if not referrer_id or referrer_id == user_id:
             # Invalid referrer or self-referral
@@ -170,7 +170,7 @@ class ReferralHandlers:
             return
         
         # Record referral
-        success, message = self.referral_service.record_referral(referrer_id, user_id)
+        success, message = await self.referral_service.record_referral_async(referrer_id, user_id)
         
         # Welcome message with referral info
         welcome_text = f"👋 مرحباً بك في البوت!\n\n"
@@ -204,7 +204,7 @@ class ReferralHandlers:
         
         if data == "referral_list":
             # Show referrals list
-            referrals = self.referral_service.get_user_referrals(user_id)
+            referrals = await self.referral_service.get_user_referrals_async(user_id)
             
             if not referrals:
                 await query.edit_message_text(
@@ -222,7 +222,7 @@ class ReferralHandlers:
                 reward_given = referral.get('reward_given', False)
                 
                 # Get user info
-                user = self.subscription_service.get_user(referred_id)
+                user = await self.subscription_service.get_user_async(referred_id)
                 username = f"@{user.username}" if user and user.username else "غير معروف"
                 
                 status = "✅ مشترك" if is_subscribed else "⏳ غير مشترك"
@@ -231,7 +231,7 @@ class ReferralHandlers:
                 message += f"{i}. {username} - {status} {reward}\n"
             
             # Get stats
-            stats = self.referral_service.get_referral_stats(user_id)
+            stats = await self.referral_service.get_referral_stats_async(user_id)
             message += f"\n📊 إجمالي الإحالات: {stats['total_referrals']}\n"
             message += f"✅ الإحالات المشتركة: {stats['subscribed_referrals']}\n"
             message += f"🎁 الأيام المكافأة: {stats['total_reward_days']}"
@@ -249,7 +249,7 @@ class ReferralHandlers:
         
         elif data == "referral_copy":
             # Generate referral link
-            referral_link = self.referral_service.generate_referral_link(user_id)
+            referral_link = await self.referral_service.generate_referral_link_async(user_id)
             
             # Update message to indicate copying
             await query.edit_message_text(
@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
 import uuid
 import hashlib
-from db import Database
+from db import Database, Count
 from models import User, Referral
+from subscription_service import SubscriptionService
 from config import BOT_TOKEN
 
 class ReferralService:
@@ -46,12 +47,17 @@ class ReferralService:
                     'updated_at': datetime.now()
                 }}
             )
+            SubscriptionService.invalidate_user(user_id)
         
         # Create referral link with bot username
         referral_link = f"https://t.me/{self.bot_username}?start=ref_{referral_code}"
         
         return referral_link
     
+    async def generate_referral_link_async(self, user_id):
+        """generate_referral_link for handlers, runs on the database threads"""
+        return await self.db.run_async(self.generate_referral_link, user_id)
+    
     def _generate_referral_code(self, user_id):
         """
         Generate a unique referral code
@@ -91,6 +97,10 @@ class ReferralService:
             return user['user_id']
         return None
     
+    async def get_referrer_by_code_async(self, referral_code):
+        """get_referrer_by_code for handlers, reads on the database threads"""
+        return await self.db.run_async(self.get_referrer_by_code, referral_code)
+    
     def record_referral(self, referrer_id, referred_id):
         """
         Record a new referral
@@ -98,103 +108,118 @@ class ReferralService:
             - (success, message) tuple
         """
         try:
-            # Check if referral already exists
-            existing_referral = self.referrals_collection.find_one({
-                'referrer_id': referrer_id,
-                'referred_id': referred_id
-            })
-            
-            if existing_referral:
-                return (False, "هذه الإحالة موجودة بالفعل.")
-            
-            # Create new referral
-            referral = Referral(referrer_id, referred_id)
-            
-            # Save to database
-            self.referrals_collection.insert_one(referral.to_dict())
-            
-            # Update user's referred_by field
-            self.users_collection.update_one(
-                {'user_id': referred_id},
-                {'$set': {
-                    'referred_by': referrer_id,
-                    'updated_at': datetime.now()
-                }}
-            )
-            
-            return (True, "تم تسجيل الإحالة بنجاح.")
+            # The referral and the user's referred_by are written together
+            with self.db.transaction():
+                # Check if referral already exists
+                existing_referral = self.referrals_collection.find_one({
+                    'referrer_id': referrer_id,
+                    'referred_id': referred_id
+                })
+                
+                if existing_referral:
+                    return (False, "هذه الإحالة موجودة بالفعل.")
+                
+                # Create new referral
+                referral = Referral(referrer_id, referred_id)
+                
+                # Save to database
+                self.referrals_collection.insert_one(referral.to_dict())
+                
+                # Update user's referred_by field
+                self.users_collection.update_one(
+                    {'user_id': referred_id},
+                    {'$set': {
+                        'referred_by': referrer_id,
+                        'updated_at': datetime.now()
+                    }}
+                )
+                SubscriptionService.invalidate_user(referred_id)
+                
+                return (True, "تم تسجيل الإحالة بنجاح.")
             
         except Exception as e:
             print(f"Error in record_referral: {str(e)}")
             return (False, f"حدث خطأ أثناء تسجيل الإحالة: {str(e)}")
     
+    async def record_referral_async(self, referrer_id, referred_id):
+        """record_referral for handlers, commits on the database threads"""
+        return await self.db.run_async(self.record_referral, referrer_id, referred_id)
+    
     def mark_referral_subscribed(self, referrer_id, referred_id):
         """
         Mark referral as subscribed and give reward
         Returns:
             - (success, message) tuple
         """
+        new_end_date = None
         try:
-            # Find referral
-            referral = self.referrals_collection.find_one({
-                'referrer_id': referrer_id,
-                'referred_id': referred_id
-            })
-            
-            if not referral:
-                return (False, "لم يتم العثور على الإحالة.")
-            
-            # Check if already marked as subscribed
-            if referral.get('is_subscribed', False):
-                return (False, "تم تسجيل الاشتراك بالفعل.")
-            
-            # Mark as subscribed
-            self.referrals_collection.update_one(
-                {'referrer_id': referrer_id, 'referred_id': referred_id},
-                {'$set': {
-                    'is_subscribed': True,
-                    'updated_at': datetime.now()
-                }}
-            )
-            
-            # Give reward if not already given
-            if not referral.get('reward_given', False):
-                # Add 1 day to referrer's subscription
-                referrer = self.users_collection.find_one({'user_id': referrer_id})
-                if referrer:
-                    # Calculate new subscription end date
-                    if referrer.get('subscription_end') and referrer['subscription_end'] > datetime.now():
-                        new_end_date = referrer['subscription_end'] + timedelta(days=1)
+            # The referral flags and the referrer's reward are written together
+            with self.db.transaction():
+                # Find referral
+                referral = self.referrals_collection.find_one({
+                    'referrer_id': referrer_id,
+                    'referred_id': referred_id
+                })
+                
+                if not referral:
+                    return (False, "لم يتم العثور على الإحالة.")
+                
+                # Check if already marked as subscribed
+                if referral.get('is_subscribed', False):
+                    return (False, "تم تسجيل الاشتراك بالفعل.")
+                
+                # Mark as subscribed
+                self.referrals_collection.update_one(
+                    {'referrer_id': referrer_id, 'referred_id': referred_id},
+                    {'$set': {
+                        'is_subscribed': True,
+                        'updated_at': datetime.now()
+                    }}
+                )
+                
+                # Give reward if not already given
+                if not referral.get('reward_given', False):
+                    # Add 1 day to referrer's subscription
+                    referrer = self.users_collection.find_one({'user_id': referrer_id})
+                    if referrer:
+                        # Calculate new subscription end date
+                        subscription_end = User.from_dict(referrer).subscription_end
+                        if subscription_end and subscription_end > datetime.now():
+                            new_end_date = subscription_end + timedelta(days=1)
+                        else:
+                            new_end_date = datetime.now() + timedelta(days=1)
+                        
+                        # Update subscription end date
+                        self.users_collection.update_one(
+                            {'user_id': referrer_id},
+                            {'$set': {
+                                'subscription_end': new_end_date,
+                                'updated_at': datetime.now()
+                            }}
+                        )
+                        
+                        # Mark reward as given
+                        self.referrals_collection.update_one(
+                            {'referrer_id': referrer_id, 'referred_id': referred_id},
+                            {'$set': {
+                                'reward_given': True,
+                                'updated_at': datetime.now()
+                            }}
+                        )
                     else:
-                        new_end_date = datetime.now() + timedelta(days=1)
-                    
-                    # Update subscription end date
-                    self.users_collection.update_one(
-                        {'user_id': referrer_id},
-                        {'$set': {
-                            'subscription_end': new_end_date,
-                            'updated_at': datetime.now()
-                        }}
-                    )
-                    
-                    # Mark reward as given
-                    self.referrals_collection.update_one(
-                        {'referrer_id': referrer_id, 'referred_id': referred_id},
-                        {'$set': {
-                            'reward_given': True,
-                            'updated_at': datetime.now()
-                        }}
-                    )
-                    
-                    return (True, "تم تسجيل الاشتراك ومنح المكافأة بنجاح.")
-                else:
-                    return (False, "لم يتم العثور على المستخدم المحيل.")
-            
-            return (True, "تم تسجيل الاشتراك بنجاح.")
+                        return (False, "لم يتم العثور على المستخدم المحيل.")
             
         except Exception as e:
             print(f"Error in mark_referral_subscribed: {str(e)}")
             return (False, f"حدث خطأ أثناء تسجيل الاشتراك: {str(e)}")
+        
+        if new_end_date is None:
+            return (True, "تم تسجيل الاشتراك بنجاح.")
+        
+        # المكافأة محفوظة الآن، نحدّث الحالة في الذاكرة بعد نجاح المعاملة فقط
+        SubscriptionService.invalidate_user(referrer_id)
+        SubscriptionService.track_subscription(referrer_id, new_end_date)
+        return (True, "تم تسجيل الاشتراك ومنح المكافأة بنجاح.")
     
     def get_user_referrals(self, user_id):
         """
@@ -205,19 +230,25 @@ class ReferralService:
         referrals = self.referrals_collection.find({'referrer_id': user_id})
         return list(referrals)
     
+    async def get_user_referrals_async(self, user_id):
+        """get_user_referrals for handlers, reads on the database threads"""
+        return await self.db.run_async(self.get_user_referrals, user_id)
+    
     def get_referral_stats(self, user_id):
         """
         Get referral statistics for user
         Returns:
             - dict with stats
         """
-        # Get all referrals
-        referrals = self.get_user_referrals(user_id)
-        
-        # Count total, subscribed, and rewarded referrals
-        total_referrals = len(referrals)
-        subscribed_referrals = sum(1 for r in referrals if r.get('is_subscribed', False))
-        rewarded_referrals = sum(1 for r in referrals if r.get('reward_given', False))
+        # Count total, subscribed, and rewarded referrals in one query
+        counts = self.referrals_collection.aggregate({
+            'total': Count(),
+            'subscribed': Count({'is_subscribed': True}),
+            'rewarded': Count({'reward_given': True})
+        }, {'referrer_id': user_id})
+        total_referrals = counts['total']
+        subscribed_referrals = counts['subscribed']
+        rewarded_referrals = counts['rewarded']
         
         # Calculate total reward days
         total_reward_days = rewarded_referrals
@@ -228,3 +259,7 @@ class ReferralService:
             'rewarded_referrals': rewarded_referrals,
             'total_reward_days': total_reward_days
         }
+    
+    async def get_referral_stats_async(self, user_id):
+        """get_referral_stats for handlers, aggregates on the database threads"""
+        return await self.db.run_async(self.get_referral_stats, user_id)
@@ -1,13 +1,12 @@
-from telethon import TelegramClient, events
-from telethon.sessions import StringSession
+from telethon import events
 import asyncio
 import logging
 import random
 from datetime import datetime
-import time
-import threading
 from db import Database
 from config import API_ID, API_HASH
+from background_loop import BackgroundLoop
+from client_pool import ClientPool
 
 class ResponseService:
     def __init__(self):
@@ -15,6 +14,9 @@ class ResponseService:
         self.users_collection = self.db.get_collection('users')
         self.responses_collection = self.db.get_collection('responses')
         self.active_clients = {}  # Store active client instances by user_id
+        self.active_handlers = {}  # Auto-response event handlers by user_id
+        self.loop_runner = BackgroundLoop()
+        self.client_pool = ClientPool()
         self.logger = logging.getLogger(__name__)
         
         # Default responses
@@ -45,81 +47,17 @@ class ResponseService:
             
             session_string = user['session_string']
             
-            # Create client with session string
-            client = TelegramClient(StringSession(session_string), API_ID, API_HASH)
-            await client.connect()
-            
-            # Check if session is valid
-            if not await client.is_user_authorized():
-                await client.disconnect()
-                return (False, "جلسة غير صالحة. يرجى تسجيل الدخول مرة أخرى.")
-            
             # Get user responses from database or use defaults
             user_responses = self.get_user_responses(user_id)
             
-            # Register event handlers for group messages
-            @client.on(events.NewMessage(incoming=True))
-            async def handle_new_message(event):
-                try:
-                    # Skip messages from self
-                    if event.message.out:
-                        return
-                    
-                    # Get message text
-                    message_text = event.message.text
-                    
-                    # Check if message is in a private chat (not a group or channel)
-                    if not event.is_group and not event.is_channel:
-                        # Handle private messages
-                        # Get random response for private messages
-                        response = self.get_random_response(user_responses, 'private')
-                        
-                        # Add natural delay (1-2 seconds for private messages)
-                        delay = random.uniform(1, 2)
-                        await asyncio.sleep(delay)
-                        
-                        # Send response
-                        if event and hasattr(event, 'reply'):
-                            reply = await event.reply(response)
-                            # Log response
-                            if reply:
-                                self.log_response(user_id, event.chat_id, message_text, response, is_private=True)
-                        return
-                    
-                    # For group messages, check if the user is mentioned
-                    me = await client.get_me()
-                    
-                    is_mentioned = False
-                    if event.message.mentioned:
-                        is_mentioned = True
-                    elif me.username and f"@{me.username}" in message_text:
-                        is_mentioned = True
-                    elif me.first_name and me.first_name.lower() in message_text.lower():
-                        is_mentioned = True
-                    
-                    if not is_mentioned:
-                        return
-                    
-                    # Determine response type based on message content
-                    response_type = self.determine_response_type(message_text)
-                    
-                    # Get random response for the type
-                    response = self.get_random_response(user_responses, response_type)
-                    
-                    # Add 10-second delay for group messages as requested
-                    await asyncio.sleep(10)
-                    
-                    # Send response
-                    if event and hasattr(event, 'reply'):
-                        reply = await event.reply(response)
-                        # Log response
-                        if reply:
-                            self.log_response(user_id, event.chat_id, message_text, response, is_private=False)
-                    else:
-                        self.logger.error("Event object does not have reply method or is None")
-                    
-                except Exception as e:
-                    self.logger.error(f"Error in handle_new_message: {str(e)}")
+            # Attach the handler to the user's pooled client on the shared loop
+            client = await self.loop_runner.run_async(
+                self._attach_auto_response(user_id, session_string, user_responses)
+            )
+            
+            # Check if session is valid
+            if client is None:
+                return (False, "جلسة غير صالحة. يرجى تسجيل الدخول مرة أخرى.")
             
             # Store client instance
             self.active_clients[user_id] = {
@@ -143,6 +81,97 @@ class ResponseService:
             self.logger.error(f"Error in start_auto_response: {str(e)}")
             return (False, f"حدث خطأ أثناء تفعيل الردود التلقائية: {str(e)}")
     
+    async def _attach_auto_response(self, user_id, session_string, user_responses):
+        """
+        Borrow the pooled client and register the auto-response handler on it
+        Must run on the shared posting loop
+        Returns:
+            - client or None if the session is not authorized
+        """
+        client = await self.client_pool.acquire(user_id, session_string, API_ID, API_HASH)
+        if client is None:
+            return None
+        
+        # Keep the client connected while auto-response is active
+        self.client_pool.pin(user_id)
+        await self.client_pool.release(user_id, client)
+        
+        # Handler for incoming messages, registered through the pool below
+        async def handle_new_message(event):
+            try:
+                # Skip messages from self
+                if event.message.out:
+                    return
+                
+                # Get message text
+                message_text = event.message.text
+                
+                # Check if message is in a private chat (not a group or channel)
+                if not event.is_group and not event.is_channel:
+                    # Handle private messages
+                    # Get random response for private messages
+                    response = self.get_random_response(user_responses, 'private')
+                    
+                    # Add natural delay (1-2 seconds for private messages)
+                    delay = random.uniform(1, 2)
+                    await asyncio.sleep(delay)
+                    
+                    # Send response
+                    if event and hasattr(event, 'reply'):
+                        reply = await event.reply(response)
+                        # Log response
+                        if reply:
+                            self.log_response(user_id, event.chat_id, message_text, response, is_private=True)
+                    return
+                
+                # For group messages, check if the user is mentioned
+                is_mentioned = False
+                if event.message.mentioned:
+                    is_mentioned = True
+                else:
+                    # Identity is cached on the pooled client, no get_me round trip per message
+                    me = await self.client_pool.get_identity(user_id)
+                    if me and me['username'] and f"@{me['username']}" in message_text:
+                        is_mentioned = True
+                    elif me and me['first_name'] and me['first_name'] in message_text.lower():
+                        is_mentioned = True
+                
+                if not is_mentioned:
+                    return
+                
+                # Determine response type based on message content
+                response_type = self.determine_response_type(message_text)
+                
+                # Get random response for the type
+                response = self.get_random_response(user_responses, response_type)
+                
+                # Add 10-second delay for group messages as requested
+                await asyncio.sleep(10)
+                
+                # Send response
+                if event and hasattr(event, 'reply'):
+                    reply = await event.reply(response)
+                    # Log response
+                    if reply:
+                        self.log_response(user_id, event.chat_id, message_text, response, is_private=False)
+                else:
+                    self.logger.error("Event object does not have reply method or is None")
+                
+            except Exception as e:
+                self.logger.error(f"Error in handle_new_message: {str(e)}")
+    
+        # The pool moves the handler to the new client if it replaces this one
+        self.client_pool.add_event_handler(user_id, handle_new_message, events.NewMessage(incoming=True))
+        self.active_handlers[user_id] = handle_new_message
+        return client
+    
+    async def _detach_auto_response(self, user_id):
+        """Remove the auto-response handler and let the pool manage the client again"""
+        handler = self.active_handlers.pop(user_id, None)
+        if handler is not None:
+            self.client_pool.remove_event_handler(user_id, handler)
+        await self.client_pool.unpin(user_id)
+    
     async def stop_auto_response(self, user_id):
         """
         Stop auto-response for user
@@ -153,9 +182,8 @@ class ResponseService:
             if user_id not in self.active_clients:
                 return (False, "الردود التلقائية غير نشطة حالياً.")
             
-            # Disconnect client
-            client = self.active_clients[user_id]['client']
-            await client.disconnect()
+            # Detach handler, the pooled client stays available for posting
+            await self.loop_runner.run_async(self._detach_auto_response(user_id))
             
             # Remove client instance
             del self.active_clients[user_id]
@@ -58,9 +58,9 @@ class StartHelpHandlers:
         user_id = user.id
 
         # Get or create user in database
-        db_user = self.subscription_service.get_user(user_id)
+        db_user = await self.subscription_service.get_user_async(user_id)
         if not db_user:
-            db_user = self.subscription_service.create_user(
+            db_user = await self.subscription_service.create_user_async(
                 user_id,
                 user.username,
                 user.first_name,
@@ -185,7 +185,7 @@ class StartHelpHandlers:
         user_id = user.id
 
         # Get user from database
-        db_user = self.subscription_service.get_user(user_id)
+        db_user = await self.subscription_service.get_user_async(user_id)
         is_admin = db_user and db_user.is_admin
         has_subscription = db_user and db_user.has_active_subscription()
 
@@ -235,7 +235,7 @@ class StartHelpHandlers:
         data = query.data
 
         # Get user from database
-        db_user = self.subscription_service.get_user(user_id)
+        db_user = await self.subscription_service.get_user_async(user_id)
         is_admin = db_user and db_user.is_admin
         has_subscription = db_user and db_user.has_active_subscription()
 
@@ -369,7 +369,7 @@ class StartHelpHandlers:
             else:
                 # إذا لم يكن معالج المجموعات متاحاً، عرض قائمة المجموعات
                 user_id = update.effective_user.id
-                groups = self.group_service.get_user_groups(user_id)
+                groups = await self.group_service.get_user_groups_async(user_id)
 
                 if not groups:
                     keyboard = [[InlineKeyboardButton("🔄 تحديث المجموعات", callback_data="start_refresh_groups")],
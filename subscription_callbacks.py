@@ -19,7 +19,8 @@ async def subscription_check_callback(update: Update, context: CallbackContext):
 
     # Check if user is subscribed to the channel
     required_channel = subscription_manager.get_required_channel()
-    is_subscribed = await subscription_manager.check_user_subscription(user_id, context.bot)
+    # The user asked for a re-check, don't answer from the membership cache
+    is_subscribed = await subscription_manager.check_user_subscription(user_id, context.bot, force=True)
 
     if is_subscribed:
         # User is subscribed, show success message
@@ -228,15 +228,15 @@ class SubscriptionHandlers:
                 return
 
             # Get or create user
-            user = self.subscription_service.get_user(user_id)
+            user = await self.subscription_service.get_user_async(user_id)
             if not user:
-                user = self.subscription_service.create_user(user_id)
+                user = await self.subscription_service.create_user_async(user_id)
 
             # Add subscription
-            success = self.subscription_service.add_subscription(user_id, days, added_by=update.effective_user.id)
+            success = await self.subscription_service.add_subscription_async(user_id, days, added_by=update.effective_user.id)
 
             if success:
-                end_date = self.subscription_service.get_subscription_end_date(user_id)
+                end_date = await self.subscription_service.get_subscription_end_date_async(user_id)
                 # Fix: Check if end_date is None before calling strftime
                 end_date_str = end_date.strftime('%Y-%m-%d %H:%M:%S') if end_date else "غير محدد"
                 await context.bot.send_message(
@@ -502,7 +502,7 @@ class SubscriptionHandlers:
             user_id = int(context.args[0])
 
             # Get user
-            user = self.subscription_service.get_user(user_id)
+            user = await self.subscription_service.get_user_async(user_id)
             if not user:
                 await context.bot.send_message(
                     chat_id=chat_id,
@@ -512,7 +512,7 @@ class SubscriptionHandlers:
 
             # Remove subscription
             user.subscription_end = None
-            self.subscription_service.save_user(user)
+            await self.subscription_service.save_user_async(user)
 
             await context.bot.send_message(
                 chat_id=chat_id,
@@ -557,7 +557,7 @@ class SubscriptionHandlers:
             user_id = int(context.args[0])
 
             # Get user
-            user = self.subscription_service.get_user(user_id)
+            user = await self.subscription_service.get_user_async(user_id)
             if not user:
                 await context.bot.send_message(
                     chat_id=chat_id,
@@ -647,7 +647,7 @@ class SubscriptionHandlers:
 
         try:
             # Get all users with active subscriptions
-            users = self.subscription_service.get_all_active_users()
+            users = await self.subscription_service.get_all_active_users_async()
 
             if not users:
                 await context.bot.send_message(
@@ -683,7 +683,7 @@ class SubscriptionHandlers:
 
         try:
             # Get user
-            user = self.subscription_service.get_user(user_id)
+            user = await self.subscription_service.get_user_async(user_id)
 
             if not user:
                 await context.bot.send_message(
@@ -1,20 +1,194 @@
+import copy
+import heapq
+import itertools
 import logging
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
 import uuid
-from db import Database
+from db import Database, Count
 from models import User, Subscription
-from config import ADMIN_USER_ID, DEFAULT_SUBSCRIPTION_DAYS
+from config import (
+    ADMIN_USER_ID, DEFAULT_SUBSCRIPTION_DAYS, USER_CACHE_SECONDS, USER_CACHE_MAX_ENTRIES,
+    DB_FIND_BATCH_SIZE
+)
 
 class SubscriptionService:
+    # سجلات المستخدمين المقروءة حديثاً، مشتركة بين كل نسخ الخدمة: user_id -> (User, وقت انتهاء الصلاحية)
+    _user_cache = OrderedDict()
+    _user_cache_lock = threading.Lock()
+
+    # حالة الصلاحيات في الذاكرة، مشتركة بين كل النسخ وتُحدّث عند كل كتابة:
+    # المشرفون، ونهاية الاشتراكات الفعالة (user_id -> epoch) مع كومة انتهائها
+    _admin_ids = set()
+    _subscription_ends = {}
+    _expiry_heap = []
+    _gating_loaded = False
+    _gating_changed = threading.Condition()
+
     def __init__(self):
         self.db = Database()
         self.users_collection = self.db.get_collection('users')
         self.subscriptions_collection = self.db.get_collection('subscriptions')
+        self.async_users_collection = self.db.get_async_collection('users')
+        self._load_gating()
+
+    def _load_gating(self):
+        # تحميل المشرفين والاشتراكات الفعالة مرة واحدة عند أول إنشاء للخدمة
+        cls = type(self)
+        if cls._gating_loaded:
+            return
+        with cls._gating_changed:
+            if cls._gating_loaded:
+                return
+            for user in self.users_collection.find({'is_admin': True}, projection=['user_id']):
+                cls._admin_ids.add(user['user_id'])
+            active = self.users_collection.find(
+                {'subscription_end': {'$gt': datetime.now()}},
+                projection=['user_id', 'subscription_end']
+            )
+            for user in active:
+                cls._set_subscription_end(user['user_id'], user['subscription_end'])
+            cls._gating_loaded = True
+        threading.Thread(target=cls._expire_periodically, name='subscription-expiry', daemon=True).start()
+
+    @classmethod
+    def _set_subscription_end(cls, user_id, subscription_end):
+        # Caller holds _gating_changed
+        end = subscription_end.timestamp() if subscription_end else None
+        if end is None or end <= time.time():
+            cls._subscription_ends.pop(user_id, None)
+            return
+        if cls._subscription_ends.get(user_id) == end:
+            # Unchanged, the heap already has this expiry
+            return
+        cls._subscription_ends[user_id] = end
+        heapq.heappush(cls._expiry_heap, (end, user_id))
+        # إيقاظ خيط الانتهاء إذا أصبح هذا الاشتراك أقرب انتهاء
+        if cls._expiry_heap[0] == (end, user_id):
+            cls._gating_changed.notify()
+
+    @classmethod
+    def track_user(cls, user_id, is_admin, subscription_end):
+        """Record a saved user's admin flag and subscription end in the in-memory state"""
+        with cls._gating_changed:
+            if is_admin:
+                cls._admin_ids.add(user_id)
+            else:
+                cls._admin_ids.discard(user_id)
+            cls._set_subscription_end(user_id, subscription_end)
+
+    @classmethod
+    def track_subscription(cls, user_id, subscription_end):
+        """Record a subscription end written outside this service"""
+        with cls._gating_changed:
+            cls._set_subscription_end(user_id, subscription_end)
+
+    @classmethod
+    def expire_subscriptions(cls):
+        """
+        Drop subscriptions whose end has passed
+        Returns:
+            - list of expired user ids
+        """
+        expired = []
+        with cls._gating_changed:
+            now = time.time()
+            while cls._expiry_heap and cls._expiry_heap[0][0] <= now:
+                end, user_id = heapq.heappop(cls._expiry_heap)
+                # الكومة قد تحتوي على نهايات قديمة تم تمديدها بعد ذلك
+                if cls._subscription_ends.get(user_id) == end:
+                    del cls._subscription_ends[user_id]
+                    expired.append(user_id)
+        for user_id in expired:
+            cls.invalidate_user(user_id)
+            logging.info(f"انتهى اشتراك المستخدم {user_id}")
+        return expired
+
+    @classmethod
+    def _expire_periodically(cls):
+        # ينتظر حتى أقرب انتهاء اشتراك بدلاً من اكتشافه عند الرسالة التالية
+        while True:
+            cls.expire_subscriptions()
+            with cls._gating_changed:
+                timeout = cls._expiry_heap[0][0] - time.time() if cls._expiry_heap else None
+                if timeout is None or timeout > 0:
+                    cls._gating_changed.wait(timeout)
+
+    def is_admin(self, user_id):
+        """Admin check from the in-memory admin ids, no database read"""
+        return user_id in self._admin_ids
+
+    def is_subscriber(self, user_id):
+        """Active subscription or admin, from the in-memory state"""
+        if user_id in self._admin_ids:
+            return True
+        end = self._subscription_ends.get(user_id)
+        return end is not None and end > time.time()
+
+    def refresh_user_state(self, user_id):
+        """Reload a user's cached record and in-memory state from the database"""
+        self.invalidate_user(user_id)
+        user = self.get_user(user_id)
+        if user:
+            self.track_user(user_id, user.is_admin, user.subscription_end)
+        else:
+            self.track_user(user_id, False, None)
+
+    @classmethod
+    def get_cached_user(cls, user_id):
+        """Copy of the cached user, or None if it is not cached or has expired"""
+        with cls._user_cache_lock:
+            entry = cls._user_cache.get(user_id)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.monotonic():
+                del cls._user_cache[user_id]
+                return None
+            cls._user_cache.move_to_end(user_id)
+            # نسخة حتى لا يغير المستدعي الكائن المحفوظ دون حفظه
+            return copy.copy(user)
+
+    @classmethod
+    def cache_user(cls, user):
+        with cls._user_cache_lock:
+            cls._user_cache[user.user_id] = (copy.copy(user), time.monotonic() + USER_CACHE_SECONDS)
+            cls._user_cache.move_to_end(user.user_id)
+            # حذف الأقل استخداماً عند امتلاء الذاكرة
+            while len(cls._user_cache) > USER_CACHE_MAX_ENTRIES:
+                cls._user_cache.popitem(last=False)
+
+    @classmethod
+    def invalidate_user(cls, user_id):
+        """Drop a cached user, call after writing to its row outside this service"""
+        with cls._user_cache_lock:
+            cls._user_cache.pop(user_id, None)
 
     def get_user(self, user_id):
+        user = self.get_cached_user(user_id)
+        if user:
+            return user
+
         user_data = self.users_collection.find_one({'user_id': user_id})
         if user_data:
-            return User.from_dict(user_data)
+            user = User.from_dict(user_data)
+            self.cache_user(user)
+            return user
+        return None
+
+    async def get_user_async(self, user_id):
+        """get_user for handlers, reads on the database threads instead of the event loop"""
+        user = self.get_cached_user(user_id)
+        if user:
+            return user
+
+        user_data = await self.async_users_collection.find_one({'user_id': user_id})
+        if user_data:
+            user = User.from_dict(user_data)
+            self.cache_user(user)
+            return user
         return None
 
     def save_user(self, user):
@@ -24,8 +198,15 @@ class SubscriptionService:
             {'$set': user.to_dict()},
             upsert=True
         )
+        # القراءة التالية تعيد تحميل السجل بعد الحفظ
+        self.invalidate_user(user.user_id)
+        self.track_user(user.user_id, user.is_admin, user.subscription_end)
         return user
 
+    async def save_user_async(self, user):
+        """save_user for handlers, writes on the database threads"""
+        return await self.db.run_async(self.save_user, user)
+
     def create_user(self, user_id, username=None, first_name=None, last_name=None):
         user = User(user_id, username, first_name, last_name)
 
@@ -45,33 +226,47 @@ class SubscriptionService:
 
         return self.save_user(user)
 
+    async def create_user_async(self, user_id, username=None, first_name=None, last_name=None):
+        """create_user for handlers, writes on the database threads"""
+        return await self.db.run_async(self.create_user, user_id, username, first_name, last_name)
+
     def _generate_referral_code(self, user_id):
         # Generate a unique referral code based on user_id and a random string
         unique_id = str(uuid.uuid4())[:8]
         return f"REF{user_id}{unique_id}"
 
     def check_subscription(self, user_id):
-        user = self.get_user(user_id)
-        if not user:
-            return False
-        return user.has_active_subscription()
+        return self.is_subscriber(user_id)
 
     def add_subscription(self, user_id, days=DEFAULT_SUBSCRIPTION_DAYS, added_by=None):
-        user = self.get_user(user_id)
-        if not user:
-            # إنشاء مستخدم جديد إذا لم يكن موجوداً
-            user = self.create_user(user_id)
-
-        # Add subscription days to user
-        user.add_subscription_days(days)
-        self.save_user(user)
-
-        # Record subscription history
-        subscription = Subscription(user_id, days, added_by)
-        self.subscriptions_collection.insert_one(subscription.to_dict())
-
+        # The new end date and its history record are committed together
+        try:
+            with self.db.transaction():
+                user = self.get_user(user_id)
+                if not user:
+                    # إنشاء مستخدم جديد إذا لم يكن موجوداً
+                    user = self.create_user(user_id)
+
+                # Add subscription days to user
+                user.add_subscription_days(days)
+                self.save_user(user)
+
+                # Record subscription history
+                subscription = Subscription(user_id, days, added_by)
+                self.subscriptions_collection.insert_one(subscription.to_dict())
+        except Exception:
+            # المعاملة أُلغيت، الحالة في الذاكرة تعود إلى ما هو محفوظ
+            self.refresh_user_state(user_id)
+            raise
+
+        # قد يكون السجل قُرئ أثناء المعاملة، لا نحتفظ إلا بما تم حفظه
+        self.invalidate_user(user_id)
         return True
 
+    async def add_subscription_async(self, user_id, days=DEFAULT_SUBSCRIPTION_DAYS, added_by=None):
+        """add_subscription for handlers, commits on the database threads"""
+        return await self.db.run_async(self.add_subscription, user_id, days, added_by)
+
     def remove_subscription(self, user_id):
         """
         إلغاء اشتراك المستخدم
@@ -85,12 +280,22 @@ class SubscriptionService:
         self.save_user(user)
         return True
 
+    async def remove_subscription_async(self, user_id):
+        """remove_subscription for handlers, writes on the database threads"""
+        return await self.db.run_async(self.remove_subscription, user_id)
+
     def get_subscription_end_date(self, user_id):
         user = self.get_user(user_id)
         if not user or not user.subscription_end:
             return None
         return user.subscription_end
 
+    async def get_subscription_end_date_async(self, user_id):
+        user = await self.get_user_async(user_id)
+        if not user or not user.subscription_end:
+            return None
+        return user.subscription_end
+
     def get_all_subscribers(self):
         current_time = datetime.now()
         subscribers = self.users_collection.find({
@@ -114,14 +319,33 @@ class SubscriptionService:
         """
         return self.get_all_subscribers()
 
+    async def get_active_users_async(self):
+        """get_active_users for handlers, reads on the database threads"""
+        return await self.db.run_async(self.get_active_users)
+
     def get_all_users(self):
         """
         Get all users in the database
         Returns:
-            - list of User objects
+            - iterator of User objects, read from the database in batches
         """
-        users = self.users_collection.find({})
-        return [User.from_dict(user) for user in users]
+        return (User.from_dict(user) for user in self.users_collection.find({}))
+
+    async def iter_user_ids_async(self, batch_size=DB_FIND_BATCH_SIZE):
+        """
+        Get the ids of all users, reading each page on the database threads
+        Returns:
+            - async iterator of user ids
+        """
+        # One cursor for the whole scan, so an error after the first page is raised instead of
+        # ending it early. Each page is pulled on a database thread, no read stays open between them
+        users = iter(self.users_collection.find({}, projection=['user_id'], batch_size=batch_size))
+        while True:
+            page = await self.db.run_async(lambda: list(itertools.islice(users, batch_size)))
+            for user in page:
+                yield user['user_id']
+            if len(page) < batch_size:
+                return
 
     def get_total_users_count(self):
         """
@@ -133,6 +357,10 @@ class SubscriptionService:
             logging.error(f"خطأ في الحصول على عدد المستخدمين: {str(e)}")
             return 0
 
+    async def get_total_users_count_async(self):
+        """get_total_users_count for handlers, counts on the database threads"""
+        return await self.db.run_async(self.get_total_users_count)
+
     def get_active_users_count(self):
         """
         الحصول على عدد المستخدمين النشطين (ذوي الاشتراك الفعال)
@@ -158,6 +386,34 @@ class SubscriptionService:
             logging.error(f"خطأ في الحصول على عدد المشرفين: {str(e)}")
             return 0
 
+    def get_users_counts(self):
+        """
+        الحصول على عدد المستخدمين الإجمالي والنشطين والمشرفين في استعلام واحد
+        Returns:
+            - dict with total, active and admins
+        """
+        try:
+            return self.users_collection.aggregate({
+                'total': Count(),
+                'active': Count({'subscription_end': {'$gt': datetime.now()}}),
+                'admins': Count({'is_admin': True})
+            })
+        except Exception as e:
+            logging.error(f"خطأ في الحصول على إحصائيات المستخدمين: {str(e)}")
+            return {'total': 0, 'active': 0, 'admins': 0}
+
+    async def get_users_counts_async(self):
+        """get_users_counts for handlers, aggregates on the database threads"""
+        try:
+            return await self.async_users_collection.aggregate({
+                'total': Count(),
+                'active': Count({'subscription_end': {'$gt': datetime.now()}}),
+                'admins': Count({'is_admin': True})
+            })
+        except Exception as e:
+            logging.error(f"خطأ في الحصول على إحصائيات المستخدمين: {str(e)}")
+            return {'total': 0, 'active': 0, 'admins': 0}
+
     def get_all_active_users(self):
         """
         الحصول على جميع المستخدمين النشطين
@@ -172,6 +428,10 @@ class SubscriptionService:
             logging.error(f"خطأ في الحصول على المستخدمين النشطين: {str(e)}")
             return []
 
+    async def get_all_active_users_async(self):
+        """get_all_active_users for handlers, reads on the database threads"""
+        return await self.db.run_async(self.get_all_active_users)
+
     def disable_channel_subscription(self):
         """
         Disable required channel subscription
@@ -241,8 +501,7 @@ class SubscriptionService:
             - True if allowed, False otherwise
         """
         # Check if user is admin
-        user = self.get_user(user_id)
-        if user and user.is_admin:
+        if self.is_admin(user_id):
             return True  # Admins can use all commands
 
         # Commands allowed for all users
@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import channel_subscription
+from channel_subscription import EnhancedChannelSubscription
+
+class FakeBot:
+    """Answers get_chat_member with a fixed status, counting calls and how many overlap"""
+    def __init__(self, status='member', delay=0):
+        self.status = status
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls += 1
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        return SimpleNamespace(status=self.status)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(channel_subscription, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+@pytest.fixture
+def manager():
+    manager = EnhancedChannelSubscription()
+    # Set directly, set_required_channel would rewrite channel_settings.json
+    manager.required_channel = '@required_channel'
+    manager.is_mandatory = True
+    manager.expiry_date = None
+    manager.membership_cache.clear()
+    return manager
+
+@pytest.mark.parametrize('status, ttl, expected', [
+    ('member', channel_subscription.CHANNEL_MEMBER_CACHE_SECONDS, True),
+    ('left', channel_subscription.CHANNEL_NON_MEMBER_CACHE_SECONDS, False),
+])
+def test_membership_is_cached_for_its_ttl(manager, clock, status, ttl, expected):
+    bot = FakeBot(status)
+
+    async def check():
+        return await manager.check_user_subscription(1, bot)
+
+    assert asyncio.run(check()) is expected
+    clock[0] += ttl - 1
+    assert asyncio.run(check()) is expected
+    assert bot.calls == 1
+
+    clock[0] += 2
+    assert asyncio.run(check()) is expected
+    assert bot.calls == 2
+
+def test_force_asks_telegram_and_refreshes_the_cache(manager, clock):
+    bot = FakeBot('left')
+    assert asyncio.run(manager.check_user_subscription(1, bot)) is False
+
+    # The user just joined and pressed "check subscription"
+    bot.status = 'member'
+    assert asyncio.run(manager.check_user_subscription(1, bot, force=True)) is True
+    assert asyncio.run(manager.check_user_subscription(1, bot)) is True
+    assert bot.calls == 2
+
+def test_concurrent_checks_of_a_user_share_one_request(manager, clock):
+    bot = FakeBot('member', delay=0.05)
+
+    async def scenario():
+        return await asyncio.gather(*(manager.check_user_subscription(1, bot) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == [True] * 5
+    assert bot.calls == 1
+    assert not manager.pending_checks
+
+def test_checks_of_different_users_are_bounded(manager, clock):
+    bot = FakeBot('member', delay=0.02)
+
+    async def scenario():
+        manager.check_slots = asyncio.Semaphore(2)
+        return await asyncio.gather(*(manager.check_user_subscription(user_id, bot) for user_id in range(6)))
+
+    assert asyncio.run(scenario()) == [True] * 6
+    assert bot.calls == 6
+    assert bot.peak == 2
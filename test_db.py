@@ -0,0 +1,275 @@
+import sqlite3
+from datetime import datetime
+import pytest
+from db import Database
+
+@pytest.mark.parametrize('collection, query', [
+    ('users', {'user_id': 1}),
+    ('groups', {'user_id': 1}),
+    ('active_tasks', {'status': 'running'}),
+    ('group_entities', {'user_id': 1, 'group_id': '-1001'}),
+])
+def test_hot_queries_use_an_index(db, collection, query):
+    plan = db.get_collection(collection).explain(query)
+
+    assert plan
+    for detail in plan:
+        assert not detail.startswith('SCAN'), plan
+        assert 'USING' in detail, plan
+
+# Tables as the original Database._init_tables created them: TEXT timestamps, no unique keys
+BASELINE_SCHEMA = '''
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    is_admin INTEGER DEFAULT 0,
+    referral_code TEXT,
+    referred_by INTEGER,
+    subscription_end TEXT,
+    session_string TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE responses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    response_type TEXT,
+    response_text TEXT,
+    is_active INTEGER DEFAULT 1,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE groups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    group_id TEXT,
+    title TEXT,
+    blacklisted INTEGER DEFAULT 0,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE INDEX idx_groups_user_group ON groups (user_id, group_id);
+'''
+
+def test_migrations_upgrade_a_baseline_database(tmp_path, monkeypatch):
+    from migrations import MIGRATIONS, run_migrations
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    conn = sqlite3.connect('data/telegram_bot.db')
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute(
+        "INSERT INTO users (user_id, username, subscription_end, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (1, 'alice', '2030-01-02T03:04:05', '2024-05-06T07:08:09.123456', None)
+    )
+    conn.executemany("INSERT INTO groups (user_id, group_id, title) VALUES (?, ?, ?)", [
+        (1, '-100', 'old title'),
+        (1, '-100', 'new title'),
+        (1, '-200', 'other group'),
+    ])
+    conn.executemany("INSERT INTO responses (user_id, response_type, response_text) VALUES (?, ?, ?)", [
+        (1, 'greetings', 'hi'),
+        (1, 'greetings', 'hello'),
+    ])
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(Database, '_instance', None)
+    db = Database()
+    cursor = db.conn.cursor()
+
+    assert cursor.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+
+    # ISO strings become integer epoch seconds of the same local time
+    user = dict(cursor.execute("SELECT * FROM users WHERE user_id = 1").fetchone())
+    assert user['subscription_end'] == int(datetime(2030, 1, 2, 3, 4, 5).timestamp())
+    assert user['created_at'] == int(datetime(2024, 5, 6, 7, 8, 9).timestamp())
+    assert user['updated_at'] is None
+    assert db.get_collection('users').find_one({'user_id': 1})['subscription_end'] == datetime(2030, 1, 2, 3, 4, 5)
+
+    # Duplicate keys keep their newest row before the unique index is created
+    groups = cursor.execute("SELECT group_id, title FROM groups ORDER BY group_id").fetchall()
+    assert [tuple(row) for row in groups] == [('-100', 'new title'), ('-200', 'other group')]
+    responses = cursor.execute("SELECT response_text FROM responses").fetchall()
+    assert [row[0] for row in responses] == ['hello']
+    with pytest.raises(sqlite3.IntegrityError):
+        cursor.execute("INSERT INTO groups (user_id, group_id, title) VALUES (1, '-200', 'dupe')")
+
+    # Upserts on the new unique key work
+    db.get_collection('groups').update_one(
+        {'user_id': 1, 'group_id': '-200'}, {'$set': {'title': 'renamed'}}, upsert=True
+    )
+    assert db.get_collection('groups').count_documents({'user_id': 1}) == 2
+
+    # A second run finds nothing to do
+    assert run_migrations(db) == len(MIGRATIONS)
+
+def test_transaction_commits_all_writes_together(db):
+    users = db.get_collection('users')
+    subscriptions = db.get_collection('subscriptions')
+
+    with db.transaction():
+        users.insert_one({'user_id': 1, 'username': 'alice'})
+        with db.transaction():
+            subscriptions.insert_one({'user_id': 1, 'days': 30})
+        # The inner block does not commit, a second connection can't see the rows yet
+        other = sqlite3.connect(db.db_path)
+        assert other.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+        other.close()
+
+    assert users.count_documents({'user_id': 1}) == 1
+    assert subscriptions.count_documents({'user_id': 1}) == 1
+    assert not db.in_transaction()
+
+def test_transaction_rolls_back_every_write_on_error(db):
+    users = db.get_collection('users')
+    subscriptions = db.get_collection('subscriptions')
+
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            users.insert_one({'user_id': 1, 'username': 'alice'})
+            subscriptions.insert_one({'user_id': 1, 'days': 30})
+            raise RuntimeError("reward failed")
+
+    assert users.count_documents({}) == 0
+    assert subscriptions.count_documents({}) == 0
+    assert not db.in_transaction()
+
+def test_failed_write_inside_a_transaction_rolls_back_the_block(db):
+    users = db.get_collection('users')
+    users.insert_one({'user_id': 1, 'username': 'alice'})
+
+    # Outside a transaction the wrappers log and return, inside they re-raise
+    with pytest.raises(sqlite3.Error):
+        with db.transaction():
+            users.update_one({'user_id': 1}, {'$set': {'username': 'bob'}})
+            users.insert_one({'user_id': 1, 'username': 'duplicate'})
+
+    assert users.find_one({'user_id': 1})['username'] == 'alice'
+
+def test_find_raises_when_a_later_page_fails(db):
+    users = db.get_collection('users')
+    for user_id in (1, 2, 3):
+        users.insert_one({'user_id': user_id})
+
+    cursor = iter(users.find({}, projection=['user_id'], batch_size=1))
+    assert next(cursor) == {'user_id': 1}
+
+    # A read that fails after the first page must not pass for the end of the results
+    db.conn.execute("ALTER TABLE users RENAME TO users_gone")
+    with pytest.raises(sqlite3.Error):
+        list(cursor)
+
+    # Failing before any row is read still returns nothing, as find always did
+    assert list(users.find({})) == []
+
+def test_write_buffer_keeps_the_latest_status_per_task(db):
+    from write_buffer import WriteBehindBuffer
+
+    buffer = WriteBehindBuffer(db, max_items=100, max_age_seconds=60)
+    now = datetime.now()
+    buffer.add_status_update('a', 1, 1, now)
+    buffer.add_status_update('a', 1, 2, now)
+    buffer.add_status_update('b', 2, 5, now)
+    buffer.add_message(1, 'post', '-100', 10, now)
+    buffer.flush()
+    buffer.stop_event.set()
+
+    rows = db.conn.execute("SELECT task_id, message_count FROM status_updates ORDER BY task_id").fetchall()
+    assert [tuple(row) for row in rows] == [('a', 2), ('b', 5)]
+    assert db.get_collection('messages').count_documents({'user_id': 1}) == 1
+
+def test_full_write_buffer_is_flushed_by_its_thread(db):
+    import threading
+    from write_buffer import WriteBehindBuffer
+
+    buffer = WriteBehindBuffer(db, max_items=2, max_age_seconds=60)
+    flushed = threading.Event()
+    flushed_by = []
+    flush = buffer.flush
+
+    def recording_flush():
+        flushed_by.append(threading.current_thread().name)
+        flush()
+        flushed.set()
+    buffer.flush = recording_flush
+
+    buffer.add_message(1, 'post', '-100', 10, datetime.now())
+    buffer.add_message(1, 'post', '-200', 11, datetime.now())
+
+    # The caller only signals, the write happens on the flush thread
+    assert flushed.wait(5)
+    assert flushed_by == ['write-buffer']
+    assert db.get_collection('messages').count_documents({'user_id': 1}) == 2
+    buffer.stop_event.set()
+    buffer.flush_event.set()
+
+def test_bulk_write_counts_upsert_inserts_and_updates_apart(db):
+    from db import UpdateOne
+
+    groups = db.get_collection('groups')
+    groups.insert_one({'user_id': 1, 'group_id': '-100', 'title': 'old'})
+
+    result = groups.bulk_write([
+        UpdateOne({'user_id': 1, 'group_id': group_id}, {'$set': {'title': title}}, upsert=True)
+        for group_id, title in [('-100', 'renamed'), ('-200', 'b'), ('-300', 'c'), ('-300', 'c again')]
+    ])
+
+    assert (result.inserted_count, result.modified_count) == (2, 2)
+    assert groups.count_documents({'user_id': 1}) == 3
+
+    result = groups.update_one({'user_id': 1, 'group_id': '-400'}, {'$set': {'title': 'd'}}, upsert=True)
+    assert result.modified_count == 0 and result.upserted_id
+    result = groups.update_one({'user_id': 1, 'group_id': '-400'}, {'$set': {'title': 'e'}}, upsert=True)
+    assert result.modified_count == 1 and not result.upserted_id
+
+def test_bulk_write_rejects_unsupported_operations_before_writing(db):
+    from db import InsertOne
+
+    users = db.get_collection('users')
+    with pytest.raises(TypeError):
+        users.bulk_write([InsertOne({'user_id': 1}), {'user_id': 2}])
+
+    # Nothing was left uncommitted for the next write to persist
+    users.insert_one({'user_id': 3})
+    assert [user['user_id'] for user in users.find({})] == [3]
+
+def test_upsert_inserts_then_updates_in_place(db):
+    groups = db.get_collection('groups')
+    key = {'user_id': 1, 'group_id': '-100'}
+
+    groups.update_one(key, {'$set': {'title': 'first', 'blacklisted': True}}, upsert=True)
+    groups.update_one(key, {'$set': {'title': 'second'}}, upsert=True)
+
+    assert groups.count_documents({'user_id': 1}) == 1
+    group = groups.find_one(key)
+    assert group['title'] == 'second'
+    # Fields the update doesn't mention keep their value
+    assert group['blacklisted']
+
+def test_aggregate_counts_and_sums_with_filters(db):
+    from db import Count, Sum
+
+    tasks = db.get_collection('active_tasks')
+    for task_id, user_id, status, message_count in [
+        ('a', 1, 'running', 5), ('b', 1, 'stopped', 7), ('c', 2, 'running', 11), ('d', 3, 'running', 0)
+    ]:
+        tasks.insert_one({'task_id': task_id, 'user_id': user_id, 'status': status, 'message_count': message_count})
+
+    fields = {
+        'total': Count(),
+        'running': Count({'status': 'running'}),
+        'sent': Sum('message_count'),
+        'sent_running': Sum('message_count', {'status': 'running'}),
+    }
+    assert tasks.aggregate(fields) == {'total': 4, 'running': 3, 'sent': 23, 'sent_running': 16}
+    assert tasks.aggregate(fields, {'user_id': {'$in': [1, 2]}}) == {
+        'total': 3, 'running': 2, 'sent': 23, 'sent_running': 16
+    }
+    # No matching rows gives zeros rather than None
+    assert tasks.aggregate(fields, {'user_id': 9}) == {'total': 0, 'running': 0, 'sent': 0, 'sent_running': 0}
+
+    per_user = tasks.aggregate({'running': Count({'status': 'running'})}, group_by='user_id')
+    assert sorted((row['user_id'], row['running']) for row in per_user) == [(1, 1), (2, 1), (3, 1)]
@@ -0,0 +1,375 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+import pytest
+from telethon.errors import ChatWriteForbiddenError, FloodWaitError
+from client_pool import ClientPool, ClientUnavailable, PooledClient
+from posting_scheduler import PostingScheduler
+from posting_service import PostingService
+from rate_limiter import TokenBucket, AccountRateLimiter
+
+class CurrentLoop:
+    """Stands in for BackgroundLoop, runs callbacks on the test's own loop"""
+    def call_soon(self, callback, *args):
+        asyncio.get_running_loop().call_soon(callback, *args)
+
+def test_scheduler_dispatches_in_run_time_order():
+    async def scenario():
+        dispatched = []
+        scheduler = PostingScheduler(CurrentLoop(), lambda task_id, run_at: dispatched.append(task_id))
+        now = time.time()
+
+        scheduler.schedule('late', now + 0.15)
+        scheduler.schedule('early', now + 0.05)
+        scheduler.schedule('overdue', now - 10)
+        # Rescheduling replaces the earlier run, cancelling drops it
+        scheduler.schedule('moved', now + 0.01)
+        scheduler.schedule('moved', now + 0.10)
+        scheduler.schedule('cancelled', now + 0.02)
+        scheduler.cancel('cancelled')
+
+        await asyncio.sleep(0.25)
+        return dispatched
+
+    assert asyncio.run(scenario()) == ['overdue', 'early', 'moved', 'late']
+
+def test_scheduler_wakes_up_for_an_earlier_run():
+    async def scenario():
+        dispatched = {}
+        scheduler = PostingScheduler(
+            CurrentLoop(), lambda task_id, run_at: dispatched.setdefault(task_id, time.time())
+        )
+        start = time.time()
+        scheduler.schedule('far', start + 60)
+        await asyncio.sleep(0.01)
+
+        # The runner is sleeping until 'far', a nearer run must interrupt that sleep
+        scheduler.schedule('near', start + 0.05)
+        await asyncio.sleep(0.15)
+        return start, dispatched
+
+    start, dispatched = asyncio.run(scenario())
+    assert list(dispatched) == ['near']
+    assert dispatched['near'] - start < 0.12
+
+def test_token_bucket_allows_a_burst_then_paces():
+    async def scenario():
+        bucket = TokenBucket(rate_per_second=20, capacity=2)
+        start = time.monotonic()
+        times = []
+        for _ in range(4):
+            await bucket.acquire()
+            times.append(time.monotonic() - start)
+        return times
+
+    times = asyncio.run(scenario())
+    # Two tokens right away, then one every 1/20 s
+    assert times[1] < 0.02
+    assert 0.04 <= times[2] < 0.09
+    assert 0.09 <= times[3] < 0.15
+
+def test_token_bucket_pause_holds_every_waiter():
+    async def scenario():
+        bucket = TokenBucket(rate_per_second=1000, capacity=5)
+        bucket.pause(0.1)
+        start = time.monotonic()
+        await asyncio.gather(bucket.acquire(), bucket.acquire())
+        return time.monotonic() - start
+
+    assert asyncio.run(scenario()) >= 0.1
+
+def test_account_rate_limiter_counts_and_bounds_sends():
+    async def scenario():
+        limiter = AccountRateLimiter(rate_per_minute=6000, burst=10, concurrency=2, jitter_seconds=0)
+        in_flight = 0
+        peak = 0
+
+        async def send():
+            nonlocal in_flight, peak
+            async with limiter.slots:
+                await limiter.acquire()
+                in_flight += 1
+                peak = max(peak, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+                limiter.record_send()
+
+        await asyncio.gather(*(send() for _ in range(6)))
+        limiter.record_flood_wait(3)
+        return peak, limiter.get_stats()
+
+    peak, stats = asyncio.run(scenario())
+    assert peak == 2
+    assert stats['messages_sent'] == 6
+    assert stats['messages_per_minute'] == 6
+    assert stats['flood_waits'] == 1
+    assert stats['flood_wait_seconds'] == 3
+    assert 2 <= stats['paused_for'] <= 3
+
+class FakeClient:
+    """Stands in for a connected TelegramClient"""
+    def __init__(self):
+        self.connected = True
+        self.handlers = []
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.connected = True
+
+    async def is_user_authorized(self):
+        return True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def add_event_handler(self, callback, event):
+        self.handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [handler for handler in self.handlers if handler[0] is not callback]
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(ClientPool, '_instance', None)
+    pool = ClientPool()
+    pool._start_evictor = lambda: None
+    return pool
+
+def test_full_pool_does_not_evict_a_client_being_acquired(pool):
+    async def scenario():
+        pool.max_connections = 1
+        entry = PooledClient(1, 'session-1', FakeClient())
+        pool.entries[1] = entry
+
+        # User 1's acquire holds its lock, e.g. while _check_health awaits
+        async with pool._get_user_lock(1):
+            with pytest.raises(ClientUnavailable):
+                await pool.acquire(2, 'session-2', 1, 'hash', timeout=0.05)
+        return entry
+
+    entry = asyncio.run(scenario())
+    assert pool.entries[1] is entry
+    assert entry.client.connected
+
+def test_replaced_client_hands_its_pins_and_handlers_over(pool, monkeypatch):
+    import client_pool
+    monkeypatch.setattr(client_pool, 'StringSession', lambda session_string: session_string)
+    monkeypatch.setattr(client_pool, 'TelegramClient', lambda session, api_id, api_hash: FakeClient())
+
+    async def on_message(event):
+        pass
+
+    async def scenario():
+        old = await pool.acquire(1, 'session-1', 1, 'hash')
+        pool.pin(1)
+        pool.add_event_handler(1, on_message, 'new-message')
+
+        # A new login replaces the client while a posting cycle still borrows the old one
+        new = await pool.acquire(1, 'session-2', 1, 'hash')
+        assert new is not old
+        assert old.connected
+        assert (on_message, 'new-message') in new.handlers
+        assert (on_message, 'new-message') not in old.handlers
+
+        # The old client closes on its last release, the pin keeps the new one open
+        await pool.release(1, old)
+        await pool.release(1, new)
+        assert not old.connected
+        assert pool.entries[1].pinned == 1
+
+        pool.remove_event_handler(1, on_message)
+        await pool.unpin(1)
+        return new
+
+    new = asyncio.run(scenario())
+    assert pool.entries[1].is_idle()
+    assert (on_message, 'new-message') not in new.handlers
+
+class FakeEntityIndex:
+    """Stands in for EntityIndex, nothing is cached and failures are recorded"""
+    def __init__(self):
+        self.failures = []
+
+    def is_quarantined(self, row):
+        return False
+
+    def is_fresh(self, row):
+        return False
+
+    async def record_failure_async(self, user_id, group_id, row=None):
+        self.failures.append(group_id)
+        return 'later'
+
+class SendingClient:
+    """A client whose send_message raises the given error"""
+    def __init__(self, error):
+        self.error = error
+
+    async def send_message(self, entity, message):
+        raise self.error
+
+def posting_engine(task_status='running'):
+    """A PostingService with only what posting to one group needs, no restore or timers"""
+    engine = object.__new__(PostingService)
+    engine.logger = logging.getLogger('test_posting')
+    engine.tasks_lock = threading.Lock()
+    engine.active_tasks = {'task': {'status': task_status}}
+    engine.rate_limiters = {1: AccountRateLimiter(rate_per_minute=6000, burst=10, concurrency=2, jitter_seconds=0)}
+    engine.entity_index = FakeEntityIndex()
+
+    async def resolve_group_entity(client, method, user_id, group_id, group_ids, cycle_state):
+        return 'entity' if method == 'id' else None
+    engine.resolve_group_entity = resolve_group_entity
+    return engine
+
+@pytest.mark.parametrize('error, quarantined', [
+    (ConnectionError('connection reset'), []),
+    (asyncio.TimeoutError(), []),
+    (ChatWriteForbiddenError(request=None), ['-100']),
+])
+def test_only_unreachable_groups_are_quarantined(error, quarantined):
+    engine = posting_engine()
+    limiter = engine.rate_limiters[1]
+    cycle_state = {'entities': None, 'lock': None, 'flood_limited': False}
+
+    success = asyncio.run(engine.post_to_group_slot(
+        limiter, SendingClient(error), 'hi', 'task', 1, 'post', '-100', ['-100'], cycle_state, {}
+    ))
+
+    assert success is False
+    assert engine.entity_index.failures == quarantined
+
+def test_group_no_resolution_form_reaches_is_quarantined():
+    engine = posting_engine()
+
+    async def resolve_group_entity(client, method, user_id, group_id, group_ids, cycle_state):
+        raise ValueError(f"no entity for {group_id}")
+    engine.resolve_group_entity = resolve_group_entity
+
+    asyncio.run(engine.post_to_group_slot(
+        engine.rate_limiters[1], SendingClient(None), 'hi', 'task', 1, 'post', '-100', ['-100'],
+        {'entities': None, 'lock': None, 'flood_limited': False}, {}
+    ))
+    assert engine.entity_index.failures == ['-100']
+
+def test_task_stopped_during_a_flood_wait_sends_nothing_more():
+    engine = posting_engine()
+    calls = []
+
+    class FloodedClient:
+        async def send_message(self, entity, message):
+            calls.append(entity)
+            # stop_posting arrives while the account waits out the FloodWait
+            asyncio.get_running_loop().call_later(0.02, engine.active_tasks['task'].update, {'status': 'stopped'})
+            error = FloodWaitError(request=None, capture=0)
+            error.seconds = 0.1
+            raise error
+
+    sent = asyncio.run(engine.send_message_to_group(FloodedClient(), 'entity', 'hi', 'task', 1, 'post', '-100'))
+
+    assert sent is False
+    assert calls == ['entity']
+
+def saving_engine(db, tmp_path):
+    """A PostingService with only the task persistence state"""
+    engine = object.__new__(PostingService)
+    engine.logger = logging.getLogger('test_posting')
+    engine.db = db
+    engine.tasks_lock = threading.Lock()
+    engine.save_lock = threading.Lock()
+    engine.active_tasks = {}
+    engine.dirty_tasks = set()
+    engine.journal_file = str(tmp_path / 'active_tasks.journal')
+    engine.journal_entries = 0
+    return engine
+
+def posting_task(user_id, message_count=0):
+    return {
+        'user_id': user_id, 'post_id': 'post', 'message': 'hi', 'group_ids': ['-100'],
+        'delay_seconds': 60, 'exact_time': None, 'status': 'running',
+        'start_time': datetime(2024, 1, 1), 'last_activity': datetime(2024, 1, 1),
+        'message_count': message_count, 'message_id': None, 'is_recurring': True
+    }
+
+def test_save_writes_only_the_dirty_tasks(db, tmp_path):
+    engine = saving_engine(db, tmp_path)
+    engine.active_tasks = {'a': posting_task(1), 'b': posting_task(2)}
+    engine.dirty_tasks = {'a'}
+    engine.save_active_tasks()
+
+    tasks = db.get_collection('active_tasks')
+    assert [task['task_id'] for task in tasks.find({})] == ['a']
+    assert not engine.dirty_tasks
+
+    # A change nobody marked dirty is not written, the marked one is
+    engine.active_tasks['a']['message_count'] = 7
+    engine.active_tasks['b']['message_count'] = 3
+    engine.dirty_tasks.add('b')
+    engine.save_active_tasks()
+
+    assert tasks.find_one({'task_id': 'a'})['message_count'] == 0
+    assert tasks.find_one({'task_id': 'b'})['message_count'] == 3
+    with open(engine.journal_file) as f:
+        assert [json.loads(line)['task_id'] for line in f] == ['a', 'b']
+
+def test_journal_replay_keeps_the_last_entry_of_each_task(db, tmp_path):
+    engine = saving_engine(db, tmp_path)
+    with open(engine.journal_file, 'w') as f:
+        f.write(json.dumps({'task_id': 'a', 'message_count': 1}) + '\n')
+        f.write(json.dumps({'task_id': 'b', 'message_count': 2}) + '\n')
+        f.write(json.dumps({'task_id': 'a', 'message_count': 5}) + '\n')
+        # A torn last line after a crash
+        f.write('{"task_id": "c", "mess')
+
+    tasks = engine.load_task_backup()
+
+    assert tasks == {'a': {'message_count': 5}, 'b': {'message_count': 2}}
+    assert engine.journal_entries == 3
+
+def test_long_journal_is_compacted_to_one_entry_per_task(db, tmp_path):
+    engine = saving_engine(db, tmp_path)
+    engine.active_tasks = {'a': posting_task(1, 4), 'b': posting_task(2)}
+    engine.journal_entries = 1000
+
+    engine.append_to_journal({'a': engine.serialize_task(engine.active_tasks['a'])})
+
+    with open(engine.journal_file) as f:
+        entries = [json.loads(line) for line in f]
+    assert sorted(entry['task_id'] for entry in entries) == ['a', 'b']
+    assert engine.journal_entries == 2
+    assert engine.load_task_backup()['a']['message_count'] == 4
+
+def test_identity_is_cached_until_the_account_changes(pool):
+    client = FakeClient()
+    client.get_me_calls = 0
+
+    async def get_me():
+        client.get_me_calls += 1
+        return SimpleNamespace(id=42, username='alice', first_name='Alice')
+    client.get_me = get_me
+
+    async def scenario():
+        entry = PooledClient(1, 'session-1', client)
+        pool.entries[1] = entry
+        pool._track_identity(entry)
+        (on_user_update, _), = client.handlers
+
+        assert await pool.get_identity(1) == {'id': 42, 'username': 'alice', 'first_name': 'alice'}
+        await pool.get_identity(1)
+        assert client.get_me_calls == 1
+
+        # Another account's update keeps the cache, a rename of this one drops it
+        await on_user_update(SimpleNamespace(user_id=7))
+        await pool.get_identity(1)
+        assert client.get_me_calls == 1
+        await on_user_update(SimpleNamespace(user_id=42))
+        await pool.get_identity(1)
+        assert client.get_me_calls == 2
+
+    asyncio.run(scenario())
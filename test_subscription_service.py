@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import pytest
+from subscription_service import SubscriptionService
+
+@pytest.fixture
+def service(db, monkeypatch):
+    """A SubscriptionService on a fresh database, with empty class-level caches"""
+    monkeypatch.setattr(SubscriptionService, '_user_cache', OrderedDict())
+    monkeypatch.setattr(SubscriptionService, '_admin_ids', set())
+    monkeypatch.setattr(SubscriptionService, '_subscription_ends', {})
+    monkeypatch.setattr(SubscriptionService, '_expiry_heap', [])
+    monkeypatch.setattr(SubscriptionService, '_gating_loaded', False)
+    return SubscriptionService()
+
+def test_subscription_expires_when_its_end_passes(service):
+    service.create_user(1)
+    SubscriptionService.track_subscription(1, datetime.now() + timedelta(seconds=0.1))
+    assert service.is_subscriber(1)
+
+    # The expiry thread wakes up for the nearest end instead of its previous timeout
+    deadline = time.time() + 2
+    while 1 in SubscriptionService._subscription_ends and time.time() < deadline:
+        time.sleep(0.02)
+    assert 1 not in SubscriptionService._subscription_ends
+    assert not service.is_subscriber(1)
+
+def test_saving_an_unchanged_end_does_not_grow_the_expiry_heap(service):
+    user = service.create_user(1)
+    user.subscription_end = datetime.now() + timedelta(days=3)
+    service.save_user(user)
+    service.save_user(user)
+    service.save_user(user)
+
+    assert SubscriptionService._expiry_heap == [(user.subscription_end.timestamp(), 1)]
+
+def test_failed_add_subscription_reloads_the_saved_state(service, monkeypatch):
+    service.create_user(1)
+
+    def failing_insert(document):
+        raise RuntimeError("history write failed")
+    monkeypatch.setattr(service.subscriptions_collection, 'insert_one', failing_insert)
+
+    with pytest.raises(RuntimeError):
+        service.add_subscription(1, 30)
+
+    # save_user tracked the new end before the rollback, the reload drops it again
+    assert not service.is_subscriber(1)
+    assert service.get_user(1).subscription_end is None
+
+def test_user_ids_are_streamed_a_page_at_a_time(service):
+    for user_id in (3, 1, 7, 5, 9):
+        service.create_user(user_id)
+
+    async def read_ids():
+        return [user_id async for user_id in service.iter_user_ids_async(batch_size=2)]
+
+    assert asyncio.run(read_ids()) == [1, 3, 5, 7, 9]
+
+def test_cached_users_are_copies(service):
+    service.create_user(1, 'alice')
+    user = service.get_user(1)
+
+    # Changing a returned user without saving it must not change what others read
+    user.username = 'mallory'
+    assert service.get_user(1).username == 'alice'
+    assert service.get_user(1) is not service.get_user(1)
+
+def test_save_user_invalidates_the_cached_record(service):
+    service.create_user(1, 'alice')
+    assert service.get_user(1).username == 'alice'
+
+    user = service.get_user(1)
+    user.username = 'bob'
+    service.save_user(user)
+    assert service.get_user(1).username == 'bob'
+
+    # A write behind the service's back is only seen once the user is invalidated
+    service.users_collection.update_one({'user_id': 1}, {'$set': {'username': 'carol'}})
+    assert service.get_user(1).username == 'bob'
+    SubscriptionService.invalidate_user(1)
+    assert service.get_user(1).username == 'carol'
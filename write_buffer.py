@@ -0,0 +1,116 @@
+import atexit
+import logging
+import threading
+import time
+from models import epoch_seconds
+from config import WRITE_BUFFER_MAX_ITEMS, WRITE_BUFFER_MAX_AGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindBuffer:
+    """
+    مخزن مؤقت لكتابات مسار الإرسال
+
+    يجمع سجلات الرسائل المرسلة وعدادات الحالة ويكتبها دفعة واحدة في معاملة
+    واحدة عند امتلاء المخزن أو مرور أقصى عمر، وعند إيقاف البرنامج.
+    """
+    def __init__(self, db, max_items=WRITE_BUFFER_MAX_ITEMS, max_age_seconds=WRITE_BUFFER_MAX_AGE_SECONDS):
+        self.db = db
+        self.max_items = max_items
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.messages = []
+        # Only the latest counter of each task is kept until the next flush
+        self.status_updates = {}
+        self.oldest = None
+        self.stop_event = threading.Event()
+        # Wakes the flush thread early when the buffer fills up
+        self.flush_event = threading.Event()
+
+        threading.Thread(target=self._flush_periodically, name='write-buffer', daemon=True).start()
+        atexit.register(self.close)
+
+    def add_message(self, user_id, post_id, group_id, message_id, timestamp):
+        """Queue a sent-message record"""
+        with self.lock:
+            self.messages.append((user_id, post_id, group_id, message_id, epoch_seconds(timestamp)))
+            self._mark_pending()
+
+    def add_status_update(self, task_id, user_id, message_count, timestamp):
+        """Queue a status counter for a task"""
+        with self.lock:
+            self.status_updates[task_id] = (task_id, user_id, message_count, timestamp.isoformat())
+            self._mark_pending()
+
+    def _mark_pending(self):
+        # Caller holds self.lock. A full buffer is written by the flush thread, never by
+        # the caller, which is usually the shared posting loop
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if self._is_full():
+            self.flush_event.set()
+
+    def _is_full(self):
+        return len(self.messages) + len(self.status_updates) >= self.max_items
+
+    def flush(self):
+        """Write everything buffered in one transaction"""
+        with self.flush_lock:
+            with self.lock:
+                messages, self.messages = self.messages, []
+                status_updates, self.status_updates = list(self.status_updates.values()), {}
+                self.oldest = None
+
+            if not messages and not status_updates:
+                return
+
+            try:
+                with self.db.write_lock:
+                    cursor = self.db.conn.cursor()
+                    if messages:
+                        cursor.executemany('''
+                            INSERT INTO messages (user_id, post_id, group_id, message_id, timestamp)
+                            VALUES (?, ?, ?, ?, ?)
+                        ''', messages)
+                    if status_updates:
+                        cursor.executemany('''
+                            INSERT INTO status_updates (task_id, user_id, message_count, timestamp)
+                            VALUES (?, ?, ?, ?)
+                        ''', status_updates)
+                    self.db.conn.commit()
+                logger.debug(f"Flushed {len(messages)} messages and {len(status_updates)} status updates")
+            except Exception as e:
+                logger.error(f"Error flushing write buffer: {str(e)}")
+                try:
+                    self.db.conn.rollback()
+                except Exception:
+                    pass
+
+                # Put the records back so the next flush retries them
+                with self.lock:
+                    self.messages = messages + self.messages
+                    for row in status_updates:
+                        self.status_updates.setdefault(row[0], row)
+                    if self.oldest is None:
+                        self.oldest = time.monotonic()
+
+    def _flush_periodically(self):
+        while not self.stop_event.is_set():
+            self.flush_event.wait(self.max_age_seconds / 2)
+            self.flush_event.clear()
+            if self.stop_event.is_set():
+                return
+
+            with self.lock:
+                due = self.oldest is not None and (
+                    self._is_full() or time.monotonic() - self.oldest >= self.max_age_seconds
+                )
+            if due:
+                self.flush()
+
+    def close(self):
+        """Flush pending writes on shutdown"""
+        self.stop_event.set()
+        self.flush_event.set()
+        self.flush()